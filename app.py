@@ -7,15 +7,166 @@ Run:
 The app serves static files from `web/` and exposes simple API endpoints under `/api/`.
 This is a prototype: authentication is minimal and passwords are stored as plain text for demo purposes only.
 """
-from flask import Flask, request, jsonify, send_from_directory, session, redirect
+from flask import Flask, Response, g, request, jsonify, send_from_directory, session, redirect, stream_with_context
 from pathlib import Path
 import db
-from datetime import datetime
+import events
+import exports
+import metrics
+import profiling
+from datetime import datetime, timedelta, timezone
 import os
+import time
 
 app = Flask(__name__, static_folder='web', static_url_path='')
 app.secret_key = 'dev-secret-erp'  # change for production
 
+# upper bound on rows returned by one page of /api/orders or /api/movements
+MAX_PAGE_SIZE = int(os.environ.get('ERP_API_MAX_PAGE', 5000))
+
+
+if metrics.ENABLED:
+    @app.before_request
+    def _start_metrics():
+        metrics.start_request()
+
+    @app.after_request
+    def _record_metrics(resp):
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        stats = metrics.finish_request(request.method, rule, resp.status_code)
+        if stats is not None:
+            total = (time.perf_counter() - stats.started) * 1000
+            resp.headers['Server-Timing'] = f'db;dur={stats.sql_seconds * 1000:.2f};desc="{stats.statements} queries", total;dur={total:.2f}'
+        return resp
+
+    @app.teardown_request
+    def _drop_metrics(exc):
+        # no-op after _record_metrics; counts a request that never got a response as a 500
+        metrics.finish_request(request.method, request.url_rule.rule if request.url_rule else 'unmatched', 500)
+
+
+@app.before_request
+def _start_profile():
+    # off unless asked for: a header lookup and a rate comparison
+    wanted = (request.headers.get(profiling.HEADER, '').strip().lower() in profiling.HEADER_ON
+              and (session.get('user') or {}).get('role') == 'admin')
+    if wanted or profiling.sampling.pick(request.url_rule.rule if request.url_rule else None):
+        g.profiler = profiling.StackProfiler()
+        g.profiler.start()
+
+
+@app.after_request
+def _save_profile(resp):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        resp.headers['X-Profile-Id'] = profiling.store.save(profiler, {
+            'method': request.method, 'route': request.url_rule.rule if request.url_rule else None,
+            'path': request.full_path.rstrip('?'), 'status': resp.status_code,
+            'user': (session.get('user') or {}).get('username'),
+        })
+    return resp
+
+
+@app.teardown_request
+def _stop_profile(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+
+
+def _page_args(default_limit):
+    """Parse ?after_id=&limit=&fields= (comma separated). Raises ValueError on bad input."""
+    after_id = request.args.get('after_id')
+    limit = request.args.get('limit')
+    fields = request.args.get('fields')
+    try:
+        after_id = int(after_id) if after_id else None
+        limit = int(limit) if limit else default_limit
+    except ValueError:
+        raise ValueError('after_id and limit must be integers')
+    if limit <= 0:
+        limit = default_limit
+    limit = min(limit, MAX_PAGE_SIZE)
+    return after_id, limit, fields.split(',') if fields else None
+
+
+def _paged(rows, total, limit):
+    """JSON array response with X-Total-Count and, when the page is full, X-Next-After-Id."""
+    resp = jsonify(rows)
+    resp.headers['X-Total-Count'] = str(total)
+    if len(rows) >= limit and rows and 'id' in rows[-1]:
+        resp.headers['X-Next-After-Id'] = str(rows[-1]['id'])
+    return resp
+
+
+def _cached_json(tables, build):
+    """JSON response validated by the change counters of `tables`.
+
+    The ETag/Last-Modified come from db.table_versions(), so a matching
+    If-None-Match or If-Modified-Since gets a 304 before `build` runs.
+    If-None-Match, when sent, decides alone (RFC 9110 13.1.3).
+    """
+    versions = db.table_versions()
+    etag = '-'.join(f"{t}.{versions.get(t, (0, None))[0]}" for t in tables)
+    stamps = [versions[t][1] for t in tables if t in versions and versions[t][1]]
+    last_modified = None
+    if stamps:
+        # updated_at has whole seconds: a change lands somewhere in that second,
+        # so Last-Modified is its end, and until that has passed another change
+        # can still get the same stamp and If-Modified-Since proves nothing
+        changed = datetime.strptime(max(stamps), '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+        last_modified = changed + timedelta(seconds=1)
+        if last_modified.timestamp() > time.time():
+            last_modified = None
+    if 'If-None-Match' in request.headers:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        ims = request.if_modified_since
+        not_modified = bool(ims and last_modified and last_modified <= ims)
+    resp = Response(status=304) if not_modified else jsonify(build())
+    resp.set_etag(etag)
+    if stamps:
+        # not later than now while the second is still running
+        resp.last_modified = last_modified or changed
+    # let browsers/service worker keep the body but always revalidate
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
+
+
+def _order_args(data):
+    """Turn an order JSON payload into db.record_order keyword arguments. Raises ValueError."""
+    try:
+        product_id = int(data.get('product_id'))
+    except Exception:
+        raise ValueError('invalid product_id')
+    try:
+        quantity = float(data.get('quantity', 1))
+    except Exception:
+        raise ValueError('invalid quantity')
+    try:
+        bottle_price = float(data.get('bottle_price', 0))
+    except Exception:
+        bottle_price = 0
+    try:
+        bottles_used = data.get('bottles_used')
+        bottles_used = int(bottles_used) if bottles_used is not None else None
+    except Exception:
+        bottles_used = None
+    key = data.get('idempotency_key')
+    if key is not None and (not isinstance(key, str) or not 0 < len(key) <= 128):
+        raise ValueError('idempotency_key must be a string of at most 128 characters')
+    return {
+        'idempotency_key': key,
+        'product_id': product_id,
+        'quantity': quantity,
+        'payment_method': data.get('payment_method', 'Cash'),
+        'order_date': data.get('order_date'),
+        'use_bottle': bool(data.get('use_bottle')),
+        'bottles_used': bottles_used,
+        'bottle_price': bottle_price,
+    }
+
 
 @app.route('/')
 def index():
@@ -65,8 +216,7 @@ def api_logout():
 
 @app.route('/api/products')
 def api_products():
-    prods = db.list_products()
-    return jsonify(prods)
+    return _cached_json(('products',), db.list_products)
 
 
 @app.route('/api/products', methods=['POST'])
@@ -93,12 +243,10 @@ def api_update_product(product_id):
     unit_price = data.get('unit_price')
 
     if unit_price is not None and name is None:
-        cur = db.connect().cursor()
-        cur.execute("SELECT name FROM products WHERE id = ?", (product_id,))
-        row = cur.fetchone()
+        row = db.get_catalog()['products'].get(product_id)
         if not row:
             return jsonify({'error': 'product not found'}), 404
-        name = row[0]
+        name = row['name']
 
     if not name or unit_price is None:
         return jsonify({'error': 'name and unit_price required'}), 400
@@ -135,42 +283,32 @@ def api_orders():
         return jsonify({'error': 'unauthenticated'}), 401
     if request.method == 'GET':
         date = request.args.get('date')
-        if u.get('role') == 'admin':
-            return jsonify(db.list_orders(date_iso=date))
-        else:
-            return jsonify(db.list_orders(date_iso=date, user_id=u.get('id')))
+        user_id = None if u.get('role') == 'admin' else u.get('id')
+        try:
+            after_id, limit, fields = _page_args(default_limit=MAX_PAGE_SIZE)
+            rows = db.list_orders(date_iso=date, user_id=user_id, after_id=after_id, limit=limit, fields=fields)
+            total = db.count_orders(date_iso=date, user_id=user_id)
+        except ValueError as ve:
+            return jsonify({'error': str(ve)}), 400
+        return _paged(rows, total, limit)
     data = request.get_json() or {}
+    if request.headers.get('Idempotency-Key'):
+        data = dict(data, idempotency_key=request.headers['Idempotency-Key'])
     try:
-        product_id = int(data.get('product_id'))
-    except Exception:
-        return jsonify({'error': 'invalid product_id'}), 400
-    try:
-        quantity = float(data.get('quantity', 1))
-    except Exception:
-        return jsonify({'error': 'invalid quantity'}), 400
-    payment_method = data.get('payment_method', 'Cash')
-    order_date = data.get('order_date')
-    try:
-        bottle_price = float(data.get('bottle_price', 0))
-    except Exception:
-        bottle_price = 0
+        order_args = _order_args(data)
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+    key = order_args.get('idempotency_key')
+    if key:
+        existing = db.get_order_by_idempotency_key(key)
+        if existing is not None:
+            if u.get('role') != 'admin' and existing.get('created_by') != u.get('id'):
+                return jsonify({'error': 'idempotency key already used'}), 409
+            resp = jsonify(existing)
+            resp.headers['Idempotent-Replayed'] = 'true'
+            return resp
     try:
-        use_bottle = bool(data.get('use_bottle'))
-        try:
-            bottles_used = data.get('bottles_used')
-            bottles_used = int(bottles_used) if bottles_used is not None else None
-        except Exception:
-            bottles_used = None
-        order = db.record_order(
-            product_id=product_id,
-            quantity=quantity,
-            payment_method=payment_method,
-            order_date=order_date,
-            created_by=u.get('id'),
-            use_bottle=use_bottle,
-            bottles_used=bottles_used,
-            bottle_price=bottle_price
-        )
+        order = db.record_order(created_by=u.get('id'), **order_args)
     except ValueError as ve:
         return jsonify({'error': str(ve)}), 400
     except Exception as e:
@@ -178,12 +316,51 @@ def api_orders():
     return jsonify(order)
 
 
+# most orders accepted by one /api/orders/batch request
+MAX_BATCH_ORDERS = 500
+
+
+@app.route('/api/orders/batch', methods=['POST'])
+def api_orders_batch():
+    """Record many orders (e.g. an offline outbox) in one transaction with per-order results."""
+    u = session.get('user')
+    if not u:
+        return jsonify({'error': 'unauthenticated'}), 401
+    data = request.get_json() or {}
+    items = data.get('orders') if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return jsonify({'error': 'orders must be a list'}), 400
+    if len(items) > MAX_BATCH_ORDERS:
+        return jsonify({'error': f'at most {MAX_BATCH_ORDERS} orders per batch'}), 400
+    parsed = []
+    errors = {}
+    for i, item in enumerate(items):
+        try:
+            parsed.append(_order_args(item if isinstance(item, dict) else {}))
+        except ValueError as ve:
+            errors[i] = {'ok': False, 'error': str(ve)}
+            parsed.append(None)
+    try:
+        recorded = iter(db.record_orders([p for p in parsed if p is not None], created_by=u.get('id')))
+    except Exception as e:
+        return jsonify({'error': 'failed to record batch', 'detail': str(e)}), 500
+    results = [errors[i] if p is None else next(recorded) for i, p in enumerate(parsed)]
+    if u.get('role') != 'admin':
+        # a replayed key must not hand back someone else's sale
+        results = [
+            {'ok': False, 'error': 'idempotency key already used'}
+            if r.get('ok') and r['order'].get('created_by') != u.get('id') else r
+            for r in results
+        ]
+    return jsonify({'results': results})
+
+
 @app.route('/api/stock', methods=['GET'])
 def api_list_stock():
     u = session.get('user')
     if not u:
         return jsonify({'error': 'unauthenticated'}), 401
-    return jsonify(db.list_inventory())
+    return _cached_json(('inventory', 'products'), db.list_inventory)
 
 
 @app.route('/api/stock', methods=['POST'])
@@ -215,6 +392,71 @@ def api_update_stock(product_id):
     return jsonify(rec)
 
 
+# most days one /api/stock/history request returns
+MAX_HISTORY_DAYS = 366
+
+
+def _stock_ref_args():
+    kind = request.args.get('kind', 'source')
+    try:
+        ref_id = int(request.args.get('ref_id'))
+    except (TypeError, ValueError):
+        raise ValueError('ref_id required')
+    return kind, ref_id
+
+
+@app.route('/api/stock/as_of', methods=['GET'])
+def api_stock_as_of():
+    """Level of a source (`kind=source`) or bottle stock (`kind=inventory`) at `at` (UTC; a bare date is its start)."""
+    u = session.get('user')
+    if not u:
+        return jsonify({'error': 'unauthenticated'}), 401
+    try:
+        kind, ref_id = _stock_ref_args()
+        at = request.args.get('at') or datetime.utcnow().isoformat()
+        quantity = db.stock_as_of(kind, ref_id, at)
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+    if quantity is None:
+        return jsonify({'error': 'not found'}), 404
+    return jsonify({'kind': kind, 'ref_id': ref_id, 'at': at, 'quantity': quantity})
+
+
+@app.route('/api/stock/history', methods=['GET'])
+def api_stock_history():
+    """End-of-day levels for the last `days` days (UTC), oldest first."""
+    u = session.get('user')
+    if not u:
+        return jsonify({'error': 'unauthenticated'}), 401
+    try:
+        kind, ref_id = _stock_ref_args()
+        days = int(request.args.get('days', 30))
+        if not 1 <= days <= MAX_HISTORY_DAYS:
+            raise ValueError(f'days must be between 1 and {MAX_HISTORY_DAYS}')
+        today = datetime.utcnow().date()
+        dates = [(today - timedelta(days=n)).isoformat() for n in range(days - 1, -1, -1)]
+        levels = db.stock_levels(kind, ref_id, [d + 'T23:59:59.999999' for d in dates])
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+    if levels[-1] is None:
+        return jsonify({'error': 'not found'}), 404
+    return jsonify([{'date': d, 'quantity': q} for d, q in zip(dates, levels)])
+
+
+@app.route('/api/stock/reconcile', methods=['GET', 'POST'])
+def api_stock_reconcile():
+    """Counters that differ from the movement ledger; POST {"repair": "ledger"|"counters"} fixes them."""
+    u = session.get('user')
+    if not u or u.get('role') != 'admin':
+        return jsonify({'error': 'forbidden'}), 403
+    repair = None
+    if request.method == 'POST':
+        repair = (request.get_json(silent=True) or {}).get('repair')
+        if repair not in db.RECONCILE_REPAIRS:
+            return jsonify({'error': f"repair must be one of {', '.join(db.RECONCILE_REPAIRS)}"}), 400
+    return jsonify(db.reconcile_stock(repair=repair, user_id=u.get('id')))
+
+
 @app.route('/api/stock/<int:product_id>', methods=['DELETE'])
 def api_delete_stock(product_id):
     u = session.get('user')
@@ -231,7 +473,7 @@ def api_list_sources():
     u = session.get('user')
     if not u:
         return jsonify({'error': 'unauthenticated'}), 401
-    return jsonify(db.list_sources())
+    return _cached_json(('sources',), db.list_sources)
 
 
 @app.route('/api/sources', methods=['POST'])
@@ -287,7 +529,7 @@ def api_list_product_sources():
     u = session.get('user')
     if not u:
         return jsonify({'error': 'unauthenticated'}), 401
-    return jsonify(db.list_product_sources())
+    return _cached_json(('product_sources', 'products', 'sources'), db.list_product_sources)
 
 
 @app.route('/api/product_sources', methods=['POST'])
@@ -311,12 +553,7 @@ def api_delete_product_source(product_id):
     u = session.get('user')
     if not u or u.get('role') != 'admin':
         return jsonify({'error': 'forbidden'}), 403
-    conn = db.connect()
-    cur = conn.cursor()
-    cur.execute('DELETE FROM product_sources WHERE product_id = ?', (product_id,))
-    changed = cur.rowcount
-    conn.commit(); conn.close()
-    if not changed:
+    if not db.delete_product_source(product_id):
         return jsonify({'error': 'not found'}), 404
     return jsonify({'ok': True})
 
@@ -326,18 +563,132 @@ def api_list_movements():
     u = session.get('user')
     if not u or u.get('role') != 'admin':
         return jsonify({'error': 'forbidden'}), 403
-    try:
-        limit = int(request.args.get('limit', 100))
-    except Exception:
-        limit = 100
     kind = request.args.get('kind')
     ref_id = request.args.get('ref_id')
     try:
         ref_id_val = int(ref_id) if ref_id is not None and ref_id != '' else None
     except Exception:
         ref_id_val = None
-    rows = db.list_movements(limit=limit, kind=kind or None, ref_id=ref_id_val)
-    return jsonify(rows)
+    try:
+        after_id, limit, fields = _page_args(default_limit=100)
+        rows = db.list_movements(limit=limit, kind=kind or None, ref_id=ref_id_val, after_id=after_id, fields=fields)
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+    total = db.count_movements(kind=kind or None, ref_id=ref_id_val)
+    return _paged(rows, total, limit)
+
+
+@app.route('/api/export/<kind>')
+def api_export(kind):
+    u = session.get('user')
+    if not u or u.get('role') != 'admin':
+        return jsonify({'error': 'forbidden'}), 403
+    if kind not in ('sales', 'movements'):
+        return jsonify({'error': 'not found'}), 404
+    fmt = request.args.get('format', 'ndjson')
+    fields = request.args.get('fields')
+    try:
+        chunks = exports.stream_export(
+            kind, fmt,
+            date_from=request.args.get('from') or None,
+            date_to=request.args.get('to') or None,
+            fields=fields.split(',') if fields else None,
+        )
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+    filename = f"{kind}.{'csv' if fmt == 'csv' else 'ndjson'}"
+    return Response(
+        stream_with_context(chunks),
+        mimetype=exports.FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
+
+@app.route('/api/events')
+def api_events():
+    """Server-Sent Events: order-created, source-adjusted and inventory-changed (see events.py)."""
+    u = session.get('user')
+    if not u:
+        return jsonify({'error': 'unauthenticated'}), 401
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+    user_id = None if u.get('role') == 'admin' else u.get('id')
+    # every stream holds a request thread; leave the rest for orders
+    if events.MAX_STREAMS and events.hub.subscribers >= events.MAX_STREAMS:
+        return jsonify({'error': 'too many event streams'}), 503, {'Retry-After': '30'}
+    return Response(
+        events.hub.stream(last_id, user_id=user_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@app.route('/api/events/stats')
+def api_events_stats():
+    u = session.get('user')
+    if not u or u.get('role') != 'admin':
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify(events.stats())
+
+
+@app.route('/api/db/pool')
+def api_db_pool():
+    u = session.get('user')
+    if not u or u.get('role') != 'admin':
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify(db.pool_stats())
+
+
+@app.route('/api/metrics')
+def api_metrics():
+    """Prometheus text format; for admins, or with `Authorization: Bearer $ERP_METRICS_TOKEN`."""
+    u = session.get('user')
+    token_ok = metrics.TOKEN is not None and request.headers.get('Authorization') == f'Bearer {metrics.TOKEN}'
+    if not token_ok and (not u or u.get('role') != 'admin'):
+        return jsonify({'error': 'forbidden'}), 403
+    extra = {'erp_events_subscribers': ('gauge', 'Open /api/events streams.', events.hub.subscribers)}
+    if db.GROUP_COMMIT:
+        lanes = db.group_commit_stats()
+        extra['erp_group_commit_batches_total'] = ('counter', 'Transactions committed by the order writer lane.', lanes['batches'])
+        extra['erp_group_commit_orders_total'] = ('counter', 'Orders handled by the order writer lane.', lanes['orders'])
+    return Response(metrics.registry.render(db.pool_stats(), extra), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/profiles')
+def api_profiles():
+    u = session.get('user')
+    if not u or u.get('role') != 'admin':
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify(profiling.store.list())
+
+
+@app.route('/api/profiles/<profile_id>')
+def api_profile(profile_id):
+    """One profile as collapsed stacks (flamegraph.pl / speedscope input)."""
+    u = session.get('user')
+    if not u or u.get('role') != 'admin':
+        return jsonify({'error': 'forbidden'}), 403
+    text = profiling.store.collapsed(profile_id)
+    if text is None:
+        return jsonify({'error': 'profile not found'}), 404
+    return Response(text, mimetype='text/plain', headers={'Content-Disposition': f'inline; filename="{profile_id}.collapsed"'})
+
+
+@app.route('/api/profiles/sampling', methods=['GET', 'PUT'])
+def api_profile_sampling():
+    u = session.get('user')
+    if not u or u.get('role') != 'admin':
+        return jsonify({'error': 'forbidden'}), 403
+    if request.method == 'PUT':
+        data = request.get_json() or {}
+        try:
+            profiling.sampling.set(data.get('rate', 0), data.get('route'))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'rate must be a number between 0 and 1'}), 400
+    return jsonify(profiling.sampling.as_dict())
 
 
 @app.route('/api/upload_image', methods=['POST'])
@@ -361,7 +712,46 @@ def api_daily_summary():
     if not u or u.get('role') != 'admin':
         return jsonify({'error': 'forbidden'}), 403
     date = request.args.get('date')
-    return jsonify(db.daily_summary(date))
+    try:
+        return jsonify(db.daily_summary(date))
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+
+
+def _sales_report(group_by):
+    u = session.get('user')
+    if not u:
+        return jsonify({'error': 'unauthenticated'}), 401
+    # non-admins only ever see their own sales, as with /api/orders
+    user_id = None if u.get('role') == 'admin' else u.get('id')
+    try:
+        rows = db.sales_report(group_by, date_from=request.args.get('from') or None, date_to=request.args.get('to') or None, user_id=user_id, split=request.args.get('split') or None)
+    except ValueError as ve:
+        return jsonify({'error': str(ve)}), 400
+    return jsonify(rows)
+
+
+@app.route('/api/reports/daily')
+def api_report_daily():
+    return _sales_report('day')
+
+
+@app.route('/api/reports/products')
+def api_report_products():
+    return _sales_report('product')
+
+
+@app.route('/api/reports/payments')
+def api_report_payments():
+    return _sales_report('payment_method')
+
+
+@app.route('/api/reports/users')
+def api_report_users():
+    u = session.get('user')
+    if not u or u.get('role') != 'admin':
+        return jsonify({'error': 'forbidden'}), 403
+    return _sales_report('user')
 
 
 @app.route('/api/images')
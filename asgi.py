@@ -0,0 +1,311 @@
+"""ASGI entry point: the same Flask routes and `web/` files behind an event loop.
+
+Run:
+  pip install -r requirements.txt
+  python asgi.py                       # or: uvicorn asgi:app --port 5000
+
+Connections are held by the event loop, not by threads. Each request is
+read in full, then the Flask app (and the db.py calls it makes) runs on a
+bounded thread pool; the response is written back asynchronously. Chunks
+of streamed responses such as `/api/export/<kind>` are pulled one at a
+time, so a slow download does not pin a worker between chunks.
+`/api/events` is served natively from the events hub and holds no thread.
+
+Backpressure: at most ERP_ASGI_DB_WORKERS requests run at once and at most
+ERP_ASGI_QUEUE wait for a worker, each for at most ERP_ASGI_QUEUE_TIMEOUT
+seconds. Beyond that the server answers 503 with Retry-After instead of
+queueing without bound.
+"""
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app as flask_app
+import db
+import events
+
+DB_WORKERS = int(os.environ.get("ERP_ASGI_DB_WORKERS", min(32, (os.cpu_count() or 1) + 4)))
+# a waiting request is just a coroutine, so the queue can be far longer than the pool
+QUEUE_LIMIT = int(os.environ.get("ERP_ASGI_QUEUE", 1000))
+QUEUE_TIMEOUT = float(os.environ.get("ERP_ASGI_QUEUE_TIMEOUT", 10))
+# largest request body read into memory (image uploads are the biggest)
+MAX_BODY = int(os.environ.get("ERP_ASGI_MAX_BODY", 16 * 1024 * 1024))
+# buffered responses up to this size are sent without another trip to the pool
+INLINE_BODY = 64 * 1024
+
+
+class Overloaded(Exception):
+    pass
+
+
+class BoundedExecutor:
+    """Thread pool that admits `workers` jobs at once and lets at most `queue_limit` wait."""
+
+    def __init__(self, workers: int = DB_WORKERS, queue_limit: int = QUEUE_LIMIT, queue_timeout: float = QUEUE_TIMEOUT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="erp-db")
+        self._slots = None
+        self.waiting = 0
+        self.running = 0
+        self.rejected = 0
+
+    async def run(self, fn, *args, admit: bool = True):
+        """Run fn(*args) on the pool. Raises Overloaded when the wait queue is full or times out.
+
+        admit=False is for work on an already admitted request (the next chunk
+        of a streamed response): it waits for a worker without a limit.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        if admit and self._slots.locked():
+            if self.waiting >= self.queue_limit:
+                self.rejected += 1
+                raise Overloaded()
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise Overloaded()
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        return {'workers': self.workers, 'running': self.running, 'waiting': self.waiting,
+                'queue_limit': self.queue_limit, 'rejected': self.rejected}
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+class EventRelay:
+    """Wakes every awaiting SSE client from one future per publish, whatever the client count."""
+
+    def __init__(self, hub: events.EventHub):
+        self.hub = hub
+        self._loop = None
+        self._changed = None
+
+    def attach(self, loop):
+        if self._loop is None:
+            self.hub.add_listener(self._on_publish)
+        self._loop = loop
+        self._changed = loop.create_future()
+
+    def detach(self):
+        self.hub.remove_listener(self._on_publish)
+        self._loop = None
+
+    def _on_publish(self):
+        # called on whichever thread committed the write; never fail that write
+        try:
+            self._loop.call_soon_threadsafe(self._wake)
+        except (AttributeError, RuntimeError):
+            pass
+
+    def _wake(self):
+        fut, self._changed = self._changed, self._loop.create_future()
+        fut.set_result(None)
+
+    async def wait(self, last_id: int, timeout: float, disconnected):
+        """Events after `last_id` once there are some, `timeout` passes or the client goes away."""
+        if self.hub.last_id <= last_id:
+            await asyncio.wait((self._changed, disconnected), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        return self.hub.since(last_id)
+
+
+def _environ(scope, body: bytes) -> dict:
+    headers = {}
+    for k, v in scope['headers']:
+        key = k.decode('latin-1').upper().replace('-', '_')
+        value = v.decode('latin-1')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        headers[key] = f"{headers[key]},{value}" if key in headers else value
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    environ.update(headers)
+    environ.setdefault('CONTENT_LENGTH', str(len(body)))
+    return environ
+
+
+_END = object()
+
+
+def _call_wsgi(environ):
+    """Run the Flask app up to its first body chunk; returns (status, headers, iterable, iterator, first)."""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    result = flask_app.wsgi_app(environ, start_response)
+    chunks = iter(result)
+    first = next(chunks, _END)
+    return started['status'], started['headers'], result, chunks, first
+
+
+def _close(result):
+    if hasattr(result, 'close'):
+        result.close()
+
+
+async def _send_simple(send, status: int, body: bytes, headers=()):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), *headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class ERPServer:
+    """The ASGI application."""
+
+    def __init__(self, executor: BoundedExecutor | None = None, hub: events.EventHub | None = None):
+        self.executor = executor or BoundedExecutor()
+        self.relay = EventRelay(hub or events.hub)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        if self.relay._loop is not asyncio.get_running_loop():
+            # servers that skip lifespan still get live events
+            self.relay.attach(asyncio.get_running_loop())
+        if scope['path'] == '/api/events' and scope['method'] == 'GET':
+            return await self._events(scope, receive, send)
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if len(body) > MAX_BODY:
+                return await _send_simple(send, 413, b'{"error":"request body too large"}')
+            if not message.get('more_body'):
+                break
+        try:
+            status, headers, result, chunks, first = await self.executor.run(_call_wsgi, _environ(scope, bytes(body)))
+        except Overloaded:
+            return await _send_simple(send, 503, b'{"error":"server busy"}', [(b'retry-after', b'1')])
+        try:
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]})
+            length = next((int(v) for k, v in headers if k.lower() == 'content-length'), None)
+            # buffered bodies are already in memory; only streamed ones go back to the pool
+            inline = length is not None and length <= INLINE_BODY
+            chunk = first
+            while chunk is not _END:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = next(chunks, _END) if inline else await self.executor.run(next, chunks, _END, admit=False)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            _close(result)
+
+    async def _events(self, scope, receive, send):
+        user = _session_user(scope)
+        if not user:
+            return await _send_simple(send, 401, b'{"error":"unauthenticated"}')
+        user_id = None if user.get('role') == 'admin' else user.get('id')
+        headers = dict(scope['headers'])
+        try:
+            last_id = int(headers.get(b'last-event-id', b'').decode() or 0) or None
+        except ValueError:
+            last_id = None
+        hub = self.relay.hub
+        last_id, stale = hub.start(last_id)
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+        disconnected = asyncio.ensure_future(_until_disconnect(receive))
+        hub.count_subscriber(1)
+        try:
+            chunk = events.RETRY + (events.resync(last_id) if stale else '')
+            while not disconnected.done():
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+                batch = await self.relay.wait(last_id, events.HEARTBEAT, disconnected)
+                last_id, chunk = hub.render(batch, last_id, user_id)
+        except OSError:
+            # the client went away mid-write
+            pass
+        finally:
+            hub.count_subscriber(-1)
+            disconnected.cancel()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await asyncio.get_running_loop().run_in_executor(None, db.init_db)
+                self.relay.attach(asyncio.get_running_loop())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.relay.detach()
+                self.executor.shutdown()
+                db.close_pool()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+async def _until_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def _session_user(scope):
+    """The logged-in user from Flask's signed session cookie, or None."""
+    cookie_name = flask_app.config['SESSION_COOKIE_NAME']
+    for k, v in scope['headers']:
+        if k != b'cookie':
+            continue
+        for part in v.decode('latin-1').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == cookie_name:
+                serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+                try:
+                    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+                    return serializer.loads(value, max_age=max_age).get('user')
+                except Exception:
+                    return None
+    return None
+
+
+app = ERPServer()
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("asgi.py needs uvicorn: pip install -r requirements.txt")
+    port = int(os.environ.get("PORT", 5000))
+    uvicorn.run("asgi:app", host="0.0.0.0", port=port, log_level=os.environ.get("ERP_LOG_LEVEL", "info"))
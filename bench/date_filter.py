@@ -0,0 +1,65 @@
+"""Benchmark: date-filtered order queries as sales history grows.
+
+Sales arrive at a fixed rate per day, so a bigger table means more years of
+history rather than a busier day. With the timestamp indexes and half-open
+range filter, list_orders/daily_summary for one day should stay flat; the old
+`timestamp LIKE 'YYYY-MM-DD%'` filter is timed alongside for comparison.
+
+Run from the project root:
+    python -m bench.date_filter --sizes 10000 100000 1000000
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import db
+from bench.fixtures import fill_sales
+
+
+def timed(fn, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best * 1000
+
+
+def run(sizes, repeat: int = 5):
+    results = []
+    with tempfile.TemporaryDirectory() as d:
+        for n in sizes:
+            path = Path(d) / f"bench_{n}.db"
+            db.init_db(path)
+            day = fill_sales(path, n)
+            conn = db.connect(path)
+            legacy = lambda: conn.execute("SELECT SUM(quantity), SUM(total) FROM sales WHERE timestamp LIKE ?", (f"{day}%",)).fetchone()
+            row = {
+                "rows": n,
+                "list_orders_day_ms": timed(lambda: db.list_orders(path, date_iso=day), repeat),
+                "list_orders_day_user_ms": timed(lambda: db.list_orders(path, date_iso=day, user_id=1), repeat),
+                "daily_summary_ms": timed(lambda: db.daily_summary(day, path), repeat),
+                "legacy_like_summary_ms": timed(legacy, repeat),
+            }
+            conn.close()
+            results.append(row)
+        db.close_pool()
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description="date filter benchmark")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+    cols = ["rows", "list_orders_day_ms", "list_orders_day_user_ms", "daily_summary_ms", "legacy_like_summary_ms"]
+    print("  ".join(f"{c:>24}" for c in cols))
+    for r in run(args.sizes, args.repeat):
+        print("  ".join(f"{r[c]:>24.2f}" if isinstance(r[c], float) else f"{r[c]:>24}" for c in cols))
+
+
+if __name__ == "__main__":
+    main()
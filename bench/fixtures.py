@@ -0,0 +1,169 @@
+"""Synthetic databases for the benchmarks.
+
+`build()` creates a database through db.init_db() and fills it the way a
+busy shop would after a few years: extra products sold by the litre from
+several tanks, bottle stock, a handful of till users, sales every day of the
+history spread over opening hours, and the stock movement each sale writes
+plus periodic tank refills. The rollup and the weekly stock checkpoints are
+rebuilt at the end, so reports and history read what a live database would.
+
+Generation is seeded, so the same parameters always give the same rows
+(dated back from the day they are built).
+The parameters are stored in the database (`bench_fixture`), and
+`load_or_build()` reuses an existing file when they match.
+"""
+import json
+import random
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import db
+
+DEFAULTS = {
+    'products': 12,
+    'sources': 4,
+    'users': 6,
+    'days': 730,
+    'sales_per_day': 1400,
+    'refills_per_day': 2,
+    'seed': 1,
+}
+
+PAYMENTS = (('Cash', 6), ('Mpesa', 4), ('Card', 1))
+
+
+def fill_sales(db_path, rows: int, per_day: int = 300):
+    """Append `rows` plain sales, `per_day` per day, ending today. Returns a day in the middle."""
+    conn = db.connect(db_path)
+    pids = [r[0] for r in conn.execute("SELECT id FROM products")]
+    days = max(1, rows // per_day)
+    start = datetime.utcnow().replace(hour=6, minute=0, second=0, microsecond=0) - timedelta(days=days)
+    step = timedelta(hours=14) / per_day
+
+    def gen():
+        for i in range(rows):
+            ts = start + timedelta(days=i // per_day) + step * (i % per_day)
+            yield (pids[i % len(pids)], 1.0, 40.0, 40.0, 'Cash', ts.isoformat() + 'Z', 1 + i % 2)
+
+    conn.executemany("INSERT INTO sales (product_id, quantity, unit_price, total, payment_method, timestamp, created_by) VALUES (?, ?, ?, ?, ?, ?, ?)", gen())
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    db.rebuild_rollup(db_path=db_path)
+    return (start + timedelta(days=days // 2)).date().isoformat()
+
+
+def _catalog(conn, params, rng, now):
+    """Add tanks, products mapped to them and till users.
+
+    Returns ({product id: (source id, factor, price)}, source ids, user ids).
+    """
+    source_ids = [r[0] for r in conn.execute("SELECT id FROM sources ORDER BY id")]
+    for n in range(len(source_ids), params['sources']):
+        cur = conn.execute("INSERT INTO sources (name, unit, quantity, last_updated) VALUES (?, 'L', 0, ?)", (f"Tank {n + 1}", now))
+        source_ids.append(cur.lastrowid)
+    for n in range(params['products']):
+        litres = rng.choice((0.5, 1, 5, 10, 20))
+        cur = conn.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", (f"Bench {litres}L water #{n + 1}", round(8 * litres + rng.uniform(0, 10))))
+        conn.execute("INSERT INTO product_sources (product_id, source_id, factor) VALUES (?, ?, ?)", (cur.lastrowid, rng.choice(source_ids), litres))
+    # every tank holds far more than a benchmark run can sell
+    conn.execute("UPDATE sources SET quantity = 1e12, last_updated = ?", (now,))
+    conn.execute("UPDATE inventory SET quantity = 1e9, last_updated = ?", (now,))
+    for n in range(params['users']):
+        conn.execute("INSERT OR IGNORE INTO users (username, password, role) VALUES (?, 'bench', 'user')", (f"till{n + 1}",))
+    mapped = {r[0]: (r[1], r[2], r[3]) for r in conn.execute(
+        "SELECT p.id, ps.source_id, ps.factor, p.unit_price FROM products p JOIN product_sources ps ON ps.product_id = p.id")}
+    users = [r[0] for r in conn.execute("SELECT id FROM users ORDER BY id")]
+    return mapped, source_ids, users
+
+
+def build(db_path, **params) -> dict:
+    """Create and fill a benchmark database at `db_path`. Returns the parameters used."""
+    params = {**DEFAULTS, **{k: v for k, v in params.items() if v is not None}}
+    db_path = Path(db_path)
+    for suffix in ('', '-wal', '-shm'):
+        Path(f"{db_path}{suffix}").unlink(missing_ok=True)
+    db.init_db(db_path)
+    rng = random.Random(params['seed'])
+    now = datetime.utcnow().isoformat() + 'Z'
+    conn = db.connect(db_path)
+    db.begin_write(conn)
+    mapped, source_ids, users = _catalog(conn, params, rng, now)
+    products = list(mapped)
+    # a few best sellers take most of the volume
+    weights = [1 / (rank + 1) for rank in range(len(products))]
+    pay_names, pay_weights = zip(*PAYMENTS)
+    start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=params['days'])
+    open_secs = 14 * 3600
+
+    sales = []
+    movements = []
+    for day in range(params['days']):
+        midnight = start + timedelta(days=day, hours=6)
+        # weekends are busier
+        count = int(params['sales_per_day'] * (1.3 if midnight.weekday() >= 5 else 1) * rng.uniform(0.8, 1.2))
+        offsets = sorted(rng.randrange(open_secs) for _ in range(count))
+        picks = rng.choices(products, weights, k=count)
+        pays = rng.choices(pay_names, pay_weights, k=count)
+        for offset, pid, pay in zip(offsets, picks, pays):
+            ts = (midnight + timedelta(seconds=offset)).isoformat() + 'Z'
+            qty = float(rng.choice((1, 1, 1, 2, 2, 3, 5)))
+            source_id, factor, price = mapped[pid]
+            user = rng.choice(users)
+            sales.append((pid, qty, price, price * qty, pay, ts, user))
+            movements.append(('source', source_id, -qty * factor, f'order:{pid}', ts, user))
+        for _ in range(params['refills_per_day']):
+            ts = (midnight + timedelta(seconds=rng.randrange(open_secs))).isoformat() + 'Z'
+            movements.append(('source', rng.choice(source_ids), 5000.0, 'refill', ts, users[0]))
+        if len(sales) >= 200_000:
+            _flush(conn, sales, movements)
+    _flush(conn, sales, movements)
+    conn.execute("CREATE TABLE IF NOT EXISTS bench_fixture (params TEXT NOT NULL)")
+    conn.execute("DELETE FROM bench_fixture")
+    conn.execute("INSERT INTO bench_fixture (params) VALUES (?)", (json.dumps(params, sort_keys=True),))
+    # the counters were set without movements: they are the opening levels
+    conn.execute("DELETE FROM stock_checkpoints")
+    for kind, (table, key) in db._STOCK_ROWS.items():
+        for (ref_id,) in conn.execute(f"SELECT {key} FROM {table}").fetchall():
+            db._checkpoint(conn, kind, ref_id, now)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    db.rebuild_rollup(db_path=db_path)
+    db.backfill_checkpoints(db_path=db_path)
+    return params
+
+
+def _flush(conn, sales, movements):
+    conn.executemany("INSERT INTO sales (product_id, quantity, unit_price, total, payment_method, timestamp, created_by) VALUES (?, ?, ?, ?, ?, ?, ?)", sales)
+    # movements are stored in time order, as they would have been written
+    movements.sort(key=lambda m: m[4])
+    conn.executemany("INSERT INTO movements (kind, ref_id, delta, reason, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?)", movements)
+    sales.clear()
+    movements.clear()
+
+
+def fixture_params(db_path) -> dict | None:
+    """The parameters a benchmark database was built with, or None if it is not one."""
+    if not Path(db_path).exists():
+        return None
+    conn = db.connect(db_path)
+    try:
+        row = conn.execute("SELECT params FROM bench_fixture").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    conn.close()
+    return json.loads(row[0]) if row else None
+
+
+def load_or_build(db_path, **params) -> dict:
+    """Reuse the database at `db_path` if it was built with the same parameters, else rebuild it."""
+    wanted = {**DEFAULTS, **{k: v for k, v in params.items() if v is not None}}
+    if fixture_params(db_path) == wanted:
+        db.init_db(db_path)
+        return wanted
+    db.close_pool()
+    return build(db_path, **wanted)
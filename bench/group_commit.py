@@ -0,0 +1,136 @@
+"""Orders per second with and without the group-commit writer lane.
+
+`clients` threads record orders back to back for `--duration` seconds, each
+waiting for its order like a till does, first with one transaction per
+order (record_order as it runs by default) and then through
+db.GroupCommitWriter for each `--max-wait` given. Throughput, latency
+percentiles and the mean batch size are printed per run.
+
+The fixture is a small synthetic database from bench/fixtures.py (30 days by
+default) whose tanks hold far more than any run sells. With the default
+ERP_DB_SYNCHRONOUS=NORMAL under WAL a commit does not fsync, so the gain is
+in the transactions and lock hand-offs saved; run with
+ERP_DB_SYNCHRONOUS=FULL to see what batching does to fsyncs.
+
+Run from the project root:
+    python -m bench.group_commit
+    python -m bench.group_commit --clients 1 8 32 --max-wait 0 2 5 --json
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+import db
+from bench import fixtures
+from bench.load import percentile
+
+DEFAULT_DB = ROOT / "bench" / "data" / "group_commit.db"
+
+
+def _orders(path) -> list:
+    conn = db.connect(path)
+    rows = conn.execute("SELECT ps.product_id, u.id FROM product_sources ps, users u ORDER BY ps.product_id, u.id").fetchall()
+    conn.close()
+    return [{'product_id': pid, 'quantity': 1, 'created_by': uid} for pid, uid in rows]
+
+
+def run_level(path, clients: int, duration: float, writer: db.GroupCommitWriter | None = None) -> dict:
+    """Record orders from `clients` threads for `duration` seconds, directly or through `writer`."""
+    orders = _orders(path)
+    latencies = [[] for _ in range(clients)]
+    errors = [0] * clients
+    start = threading.Barrier(clients + 1)
+    stop_at = [0.0]
+
+    def client(n):
+        mine = latencies[n]
+        start.wait()
+        i = n
+        while time.perf_counter() < stop_at[0]:
+            order = orders[i % len(orders)]
+            i += clients
+            t = time.perf_counter()
+            try:
+                if writer is None:
+                    db.record_order(db_path=path, **order)
+                else:
+                    writer.submit(order).result()
+            except Exception:
+                errors[n] += 1
+                continue
+            mine.append(time.perf_counter() - t)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for t in threads:
+        t.start()
+    before = writer.stats() if writer else None
+    stop_at[0] = time.perf_counter() + duration
+    t0 = time.perf_counter()
+    start.wait()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    done = sorted(x for per_client in latencies for x in per_client)
+    result = {
+        'clients': clients,
+        'orders': len(done),
+        'orders_per_sec': round(len(done) / elapsed, 1),
+        'p50_ms': round(percentile(done, 50) * 1000, 3),
+        'p99_ms': round(percentile(done, 99) * 1000, 3),
+        'errors': sum(errors),
+    }
+    if writer is not None:
+        after = writer.stats()
+        batches = after['batches'] - before['batches']
+        result['mean_batch'] = round((after['orders'] - before['orders']) / batches, 2) if batches else 0
+    return result
+
+
+def run(path, clients=(1, 8, 32), duration: float = 3.0, max_waits=(0.0, 2.0), max_batch: int = db.GROUP_COMMIT_MAX_BATCH) -> list:
+    """Every client count once per transaction and once per max wait (ms) through a writer lane."""
+    out = []
+    for n in clients:
+        out.append(dict(mode='per-order', **run_level(path, n, duration)))
+        for wait_ms in max_waits:
+            writer = db.GroupCommitWriter(path, max_batch=max_batch, max_wait=wait_ms / 1000)
+            try:
+                out.append(dict(mode=f'group {wait_ms:g}ms', **run_level(path, n, duration, writer)))
+            finally:
+                writer.close()
+    return out
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="group commit throughput benchmark")
+    ap.add_argument("--db", default=str(DEFAULT_DB), help="benchmark database, rebuilt when the fixture parameters change")
+    ap.add_argument("--days", type=int, default=30, help="fixture days of history (default 30)")
+    ap.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    ap.add_argument("--duration", type=float, default=3.0, help="seconds per run")
+    ap.add_argument("--max-wait", type=float, nargs="+", default=[0.0, 2.0], help="writer lane max wait in ms, one run each")
+    ap.add_argument("--max-batch", type=int, default=db.GROUP_COMMIT_MAX_BATCH)
+    ap.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = ap.parse_args(argv)
+    # per-order runs queue on the write lock long enough to fill the slow query log
+    logging.getLogger("erp.sql").setLevel(logging.ERROR)
+
+    Path(args.db).parent.mkdir(parents=True, exist_ok=True)
+    fixtures.load_or_build(args.db, days=args.days)
+    results = run(args.db, args.clients, args.duration, args.max_wait, args.max_batch)
+    db.close_pool()
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+    print(f"{'mode':<14}{'clients':>8}{'orders/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'batch':>7}{'errors':>8}")
+    for r in results:
+        print(f"{r['mode']:<14}{r['clients']:>8}{r['orders_per_sec']:>10.1f}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}{r.get('mean_batch', 1):>7}{r['errors']:>8}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
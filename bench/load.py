@@ -0,0 +1,326 @@
+"""HTTP load generator: till traffic against a running server at increasing concurrency.
+
+Each simulated client keeps one keep-alive connection and the session
+cookie from `/api/login`, and sends requests back to back (closed loop), so
+throughput at a level is what the server can sustain for that many tills.
+The default mix:
+
+- 25  POST /api/orders          one order on a product sold from a tank
+- 20  GET  /api/orders          newest page
+- 10  GET  /api/orders?date=    today's orders
+- 20  GET  /api/products
+- 15  GET  /api/stock
+- 10  GET  /api/daily_summary
+
+Per level: requests, req/s, p50/p90/p99/max latency, errors (exceptions and
+other 4xx/5xx), 503s shed by backpressure (`rejected`) and the share of both,
+plus the same per route with `--routes`. The level after which req/s stops
+growing by 10% is reported as the knee.
+
+Recorded traffic replaces the mix with `--traffic FILE`, one JSON object per
+line (as in requests.jsonl):
+
+    {"method": "POST", "path": "/api/orders", "body": {"product_id": "$product", "quantity": 2}, "weight": 5}
+
+`weight` (default 1) is the share when picking at random; `--in-order`
+replays the lines in sequence instead, each client from its own offset.
+`$product` (a product sold from a tank) and `$today` are filled in.
+
+Run from the project root:
+    python -m bench.load --url http://127.0.0.1:5000 --clients 1 5 10 25 50 100
+    python -m bench.load --serve flask --days 90 --duration 20
+    python -m bench.load --traffic peak.jsonl --in-order --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import date
+from pathlib import Path
+from urllib.parse import urlsplit
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+# (weight, method, path, json body)
+TILL_MIX = [
+    (25, 'POST', '/api/orders', {'product_id': '$product', 'quantity': 1, 'payment_method': 'Cash'}),
+    (20, 'GET', '/api/orders?limit=50', None),
+    (10, 'GET', '/api/orders?date=$today&limit=50', None),
+    (20, 'GET', '/api/products', None),
+    (15, 'GET', '/api/stock', None),
+    (10, 'GET', '/api/daily_summary', None),
+]
+# a level that adds less throughput than this over the previous one is past the knee
+KNEE_GAIN = 0.10
+
+
+class Connection:
+    """Minimal HTTP/1.1 keep-alive client; reconnects when the server closes."""
+
+    def __init__(self, host: str, port: int, cookie: str = ''):
+        self.host, self.port, self.cookie = host, port, cookie
+        self.reader = self.writer = None
+
+    async def request(self, method: str, path: str, body: bytes | None = None):
+        reused = self.writer is not None
+        try:
+            return await self._request(method, path, body)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            if not reused:
+                raise
+            # the server dropped a kept-alive connection before answering
+            # (e.g. a recycled worker); retry once on a fresh one, as browsers do
+            return await self._request(method, path, body)
+
+    async def _request(self, method: str, path: str, body: bytes | None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nConnection: keep-alive\r\n"
+        if self.cookie:
+            head += f"Cookie: {self.cookie}\r\n"
+        if body is not None:
+            head += f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        self.writer.write(head.encode() + b"\r\n" + (body or b""))
+        try:
+            raw = await self.reader.readuntil(b"\r\n\r\n")
+            lines = raw.decode('latin-1').split("\r\n")
+            version, status = lines[0].split(" ")[:2]
+            headers = {}
+            for line in lines[1:]:
+                if line:
+                    k, _, v = line.partition(":")
+                    headers.setdefault(k.strip().lower(), v.strip())
+            if 'content-length' in headers:
+                data = await self.reader.readexactly(int(headers['content-length']))
+            elif headers.get('transfer-encoding') == 'chunked':
+                data = b''
+                while True:
+                    size = int((await self.reader.readuntil(b"\r\n")).strip(), 16)
+                    data += await self.reader.readexactly(size + 2)
+                    if size == 0:
+                        break
+            else:
+                data = await self.reader.read()
+            if headers.get('connection', '').lower() == 'close' or (version == 'HTTP/1.0' and headers.get('connection', '').lower() != 'keep-alive'):
+                self.close()
+            return int(status), headers, data
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def login(host: str, port: int, username: str = 'admin', password: str = 'admin') -> str:
+    conn = Connection(host, port)
+    status, headers, _ = await conn.request('POST', '/api/login', json.dumps({'username': username, 'password': password}).encode())
+    conn.close()
+    if status != 200:
+        raise RuntimeError(f"login failed: HTTP {status}")
+    return headers['set-cookie'].split(';', 1)[0]
+
+
+async def sellable_products(host: str, port: int, cookie: str) -> list:
+    """Ids of products sold from a tank, so generated orders draw on source stock."""
+    conn = Connection(host, port, cookie)
+    status, _, data = await conn.request('GET', '/api/product_sources')
+    if status == 200 and json.loads(data):
+        ids = [r['product_id'] for r in json.loads(data)]
+    else:
+        status, _, data = await conn.request('GET', '/api/products')
+        ids = [r['id'] for r in json.loads(data)] if status == 200 else []
+    conn.close()
+    return ids
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def load_traffic(path) -> list:
+    """Read a recorded traffic file into (weight, method, path, body) entries."""
+    mix = []
+    with open(path, encoding='utf-8') as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                r = json.loads(line)
+                mix.append((float(r.get('weight', 1)), r.get('method', 'GET').upper(), r['path'], r.get('body')))
+            except (ValueError, KeyError, AttributeError) as e:
+                raise ValueError(f"{path}:{n}: not a traffic entry ({e})")
+    if not mix:
+        raise ValueError(f"{path}: no traffic entries")
+    return mix
+
+
+def _render(method: str, path: str, body, rnd, products: list):
+    today = date.today().isoformat()
+    path = path.replace('$today', today)
+    if body is None:
+        return method, path, None
+    text = json.dumps(body).replace('"$today"', f'"{today}"')
+    while '"$product"' in text:
+        text = text.replace('"$product"', str(rnd.choice(products) if products else 1), 1)
+    return method, path, text.encode()
+
+
+def _summary(latencies, errors: int, rejected: int) -> dict:
+    total = len(latencies) + errors + rejected
+    return {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies, default=0) * 1000,
+        'errors': errors,
+        'rejected': rejected,
+        'error_pct': 100 * (errors + rejected) / total if total else 0.0,
+    }
+
+
+async def run_level(host: str, port: int, cookie: str, clients: int, duration: float, mix=None,
+                    products: list | None = None, in_order: bool = False) -> dict:
+    """Drive `clients` connections through `mix` for `duration` seconds and summarise."""
+    mix = mix or TILL_MIX
+    weights = [m[0] for m in mix]
+    routes = {}
+    latencies, counts = [], {'errors': 0, 'rejected': 0}
+    deadline = time.perf_counter() + duration
+
+    def record(route, outcome, latency=None):
+        r = routes.setdefault(route, {'latencies': [], 'errors': 0, 'rejected': 0})
+        if latency is None:
+            r[outcome] += 1
+            counts[outcome] += 1
+        else:
+            r['latencies'].append(latency)
+            latencies.append(latency)
+
+    async def client(seed):
+        rnd = random.Random(seed)
+        conn = Connection(host, port, cookie)
+        step = seed * len(mix) // max(clients, 1)
+        while time.perf_counter() < deadline:
+            if in_order:
+                entry, step = mix[step % len(mix)], step + 1
+            else:
+                entry = rnd.choices(mix, weights)[0]
+            method, path, body = _render(*entry[1:], rnd, products or [])
+            route = f"{method} {path.split('?', 1)[0]}"
+            t = time.perf_counter()
+            try:
+                status, _, _ = await conn.request(method, path, body)
+            except Exception:
+                record(route, 'errors')
+                await asyncio.sleep(0.01)
+                continue
+            if status == 503:
+                record(route, 'rejected')
+            elif status >= 400:
+                record(route, 'errors')
+            else:
+                record(route, None, time.perf_counter() - t)
+        conn.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(clients)))
+    elapsed = time.perf_counter() - started
+    result = {'clients': clients, **_summary(latencies, counts['errors'], counts['rejected'])}
+    result['rps'] = len(latencies) / elapsed
+    result['routes'] = {route: _summary(r['latencies'], r['errors'], r['rejected']) for route, r in sorted(routes.items())}
+    return result
+
+
+def knee(results) -> int | None:
+    """Clients at the last level that still raised throughput by KNEE_GAIN, or None if every level did."""
+    for before, after in zip(results, results[1:]):
+        if after['rps'] < before['rps'] * (1 + KNEE_GAIN):
+            return before['clients']
+    return None
+
+
+def run(url: str, levels, duration: float, mix=None, in_order: bool = False, username: str = 'admin', password: str = 'admin'):
+    parts = urlsplit(url)
+    host, port = parts.hostname or '127.0.0.1', parts.port or 80
+    cookie = asyncio.run(login(host, port, username, password))
+    products = asyncio.run(sellable_products(host, port, cookie))
+    return [asyncio.run(run_level(host, port, cookie, clients, duration, mix, products, in_order)) for clients in levels]
+
+
+def _serve(name: str, port: int, **fixture):
+    """Start bench.servers' `name` launcher on a synthetic database; returns the process."""
+    import db
+    from bench import fixtures
+    from bench.servers import SERVERS, _wait_ready
+    path = ROOT / "bench" / "data" / "load.db"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fixtures.load_or_build(path, **fixture)
+    db.close_pool()
+    env = dict(os.environ, ERP_DB_PATH=str(path), PORT=str(port))
+    proc = subprocess.Popen([c.format(port=port) for c in SERVERS[name]], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_ready(port, proc)
+    except Exception:
+        proc.terminate()
+        raise
+    return proc
+
+
+def main():
+    ap = argparse.ArgumentParser(description="HTTP load generator")
+    ap.add_argument("--url", default="http://127.0.0.1:5000", help="server to load (default %(default)s)")
+    ap.add_argument("--serve", help="start this bench.servers launcher (flask, gunicorn, asgi, ...) on a synthetic database first")
+    ap.add_argument("--days", type=int, default=90, help="history in the --serve database (default 90)")
+    ap.add_argument("--clients", type=int, nargs="+", default=[1, 5, 10, 25, 50, 100])
+    ap.add_argument("--duration", type=float, default=10, help="seconds per level")
+    ap.add_argument("--traffic", help="recorded traffic file (JSON lines) instead of the till mix")
+    ap.add_argument("--in-order", action="store_true", help="replay --traffic in sequence rather than by weight")
+    ap.add_argument("--user", default="admin")
+    ap.add_argument("--password", default="admin")
+    ap.add_argument("--routes", action="store_true", help="also print each route's numbers")
+    ap.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = ap.parse_args()
+
+    mix = load_traffic(args.traffic) if args.traffic else None
+    proc = None
+    if args.serve:
+        port = urlsplit(args.url).port or 8765
+        proc = _serve(args.serve, port, days=args.days)
+    try:
+        results = run(args.url, args.clients, args.duration, mix, args.in_order, args.user, args.password)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(10)
+
+    if args.json:
+        for r in results:
+            print(json.dumps(r))
+        return
+    cols = ["clients", "requests", "rps", "p50_ms", "p90_ms", "p99_ms", "max_ms", "errors", "rejected", "error_pct"]
+    print("  ".join(f"{c:>10}" for c in cols))
+    for r in results:
+        print("  ".join(f"{r[c]:>10.1f}" if isinstance(r[c], float) else f"{r[c]:>10}" for c in cols))
+        if args.routes:
+            for route, s in r['routes'].items():
+                print(f"{'':>10}  {route:<32}{s['requests']:>8} ok  p50 {s['p50_ms']:.1f} ms  p99 {s['p99_ms']:.1f} ms  "
+                      f"{s['errors']} errors  {s['rejected']} rejected")
+    k = knee(results)
+    print(f"knee: throughput stops growing past {k} concurrent clients" if k else "no knee: throughput still growing at the last level")
+
+
+if __name__ == "__main__":
+    main()
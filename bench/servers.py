@@ -0,0 +1,116 @@
+"""Benchmark: the ways of serving the app, under increasing concurrency.
+
+- flask-debug  `python app.py` as the Procfile used to run it (minus the reloader)
+- flask        the same dev server without debug mode
+- gunicorn     `python -m main serve` (wsgi.py: preloaded, autosized gthread workers)
+- asgi         `python asgi.py` under uvicorn
+
+Each server is started as subprocesses on the same seeded database. A
+keep-alive asyncio client logs in once, then `concurrency` connections replay
+a read-heavy dashboard mix for `--duration` seconds at each level. Reported
+per server and level: requests/s, p50/p99 latency, 503s shed by ASGI
+backpressure (`rejected`) and other errors (exceptions, 5xx).
+
+Run from the project root:
+    python -m bench.servers --clients 50 100 250 500 --duration 10
+    python -m bench.servers --servers flask-debug gunicorn
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+import db
+from bench.fixtures import fill_sales
+from bench.load import login, run_level
+
+# (weight, method, path, json body)
+MIX = [
+    (30, 'GET', '/api/products', None),
+    (30, 'GET', '/api/orders?limit=50', None),
+    (15, 'GET', '/api/daily_summary', None),
+    (15, 'GET', '/api/sources', None),
+    (10, 'POST', '/api/orders', {'product_id': 1, 'quantity': 1, 'payment_method': 'Cash'}),
+]
+
+SERVERS = {
+    'flask-debug': [sys.executable, '-c', 'import os, app; app.app.run(host="127.0.0.1", port=int(os.environ["PORT"]), debug=True, use_reloader=False)'],
+    'flask': [sys.executable, '-c', 'import os, app; app.app.run(host="127.0.0.1", port=int(os.environ["PORT"]), threaded=True)'],
+    'gunicorn': [sys.executable, '-m', 'main', 'serve', '--bind', '127.0.0.1:{port}'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', '{port}',
+             '--log-level', 'warning', '--no-access-log', '--backlog', '2048'],
+}
+
+
+def _wait_ready(port: int, proc, timeout: float = 15):
+    import socket
+    end = time.time() + timeout
+    while time.time() < end:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+def seed(path: Path, history: int):
+    db.init_db(path)
+    fill_sales(path, history)
+    # enough water that the order share of the mix never runs out
+    db.update_source(1, quantity=1e12, db_path=path)
+    db.close_pool()
+
+
+def run(servers, levels, duration: float, port: int = 8765, history: int = 20_000):
+    results = []
+    with tempfile.TemporaryDirectory() as d:
+        path = Path(d) / "bench.db"
+        seed(path, history)
+        for name in servers:
+            cmd = [c.format(port=port) for c in SERVERS[name]]
+            env = dict(os.environ, ERP_DB_PATH=str(path), PORT=str(port))
+            proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                _wait_ready(port, proc)
+                cookie = asyncio.run(login('127.0.0.1', port))
+                for clients in levels:
+                    row = asyncio.run(run_level('127.0.0.1', port, cookie, clients, duration, MIX))
+                    row.pop('routes')
+                    results.append(dict(server=name, **row))
+            finally:
+                proc.terminate()
+                proc.wait(10)
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description="serving benchmark")
+    ap.add_argument("--servers", nargs="+", choices=list(SERVERS), default=list(SERVERS))
+    ap.add_argument("--clients", type=int, nargs="+", default=[50, 100, 250, 500])
+    ap.add_argument("--duration", type=float, default=10)
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = ap.parse_args()
+    results = run(args.servers, args.clients, args.duration, args.port)
+    if args.json:
+        for r in results:
+            print(json.dumps(r))
+        return
+    cols = ["server", "clients", "requests", "rps", "p50_ms", "p99_ms", "rejected", "errors"]
+    print("  ".join(f"{c:>10}" for c in cols))
+    for r in results:
+        print("  ".join(f"{r[c]:>10.1f}" if isinstance(r[c], float) else f"{r[c]:>10}" for c in cols))
+
+
+if __name__ == "__main__":
+    main()
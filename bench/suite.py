@@ -0,0 +1,162 @@
+"""Benchmark suite for the db.py hot paths, with a regression check.
+
+Builds (or reuses) a synthetic database from bench/fixtures.py, about a
+million sales and movements over two years by default, then times each case
+`--repeat` times after one warm-up call:
+
+- record_order            one order on the best-selling product
+- list_orders_day         one day of orders, everyone's / one user's
+- list_orders_day_user
+- list_orders_latest      the newest page of 50
+- daily_summary           one day's totals
+- list_movements          newest 100 movements, all / one tank
+- list_movements_source
+- list_inventory          the stock screen
+- stock_as_of             a tank's level on that day
+
+Results (min/median/p95 ms per case, plus the fixture and environment) are
+written as JSON with `--output`. With `--baseline` each case's best run is
+compared to a stored run (the minimum is far steadier than the median on a
+shared machine) and the exit status is 1 when a case is slower than
+baseline x (1 + tolerance) + 0.05 ms; `--save-baseline` stores this run.
+Baselines only compare like with like: record one per machine.
+
+Run from the project root:
+    python -m bench.suite --baseline bench/baseline.json
+    python -m bench.suite --days 30 --output results.json
+    python -m bench.suite --save-baseline bench/baseline.json
+"""
+import argparse
+import json
+import platform
+import sqlite3
+import statistics
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+import db
+from bench import fixtures
+
+DEFAULT_DB = ROOT / "bench" / "data" / "suite.db"
+TOLERANCE = 0.25
+# timings this close are noise whatever the ratio
+FLOOR_MS = 0.05
+
+
+def _cases(path) -> dict:
+    conn = db.connect(path)
+    day = conn.execute("SELECT substr(timestamp, 1, 10) FROM sales ORDER BY id LIMIT 1 OFFSET (SELECT COUNT(*) / 2 FROM sales)").fetchone()[0]
+    top = conn.execute("SELECT product_id, created_by, COUNT(*) FROM sales GROUP BY 1, 2 ORDER BY 3 DESC LIMIT 1").fetchone()
+    source = conn.execute("SELECT source_id FROM product_sources WHERE product_id = ?", (top[0],)).fetchone()[0]
+    conn.close()
+    product, user = top[0], top[1]
+    return {
+        'record_order': lambda: db.record_order(product, 1, created_by=user, db_path=path),
+        'list_orders_day': lambda: db.list_orders(path, date_iso=day),
+        'list_orders_day_user': lambda: db.list_orders(path, date_iso=day, user_id=user),
+        'list_orders_latest': lambda: db.list_orders(path, limit=50),
+        'daily_summary': lambda: db.daily_summary(day, path),
+        'list_movements': lambda: db.list_movements(100, db_path=path),
+        'list_movements_source': lambda: db.list_movements(100, kind='source', ref_id=source, db_path=path),
+        'list_inventory': lambda: db.list_inventory(path),
+        'stock_as_of': lambda: db.stock_as_of('source', source, day, path),
+    }
+
+
+def measure(fn, repeat: int) -> dict:
+    fn()
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t) * 1000)
+    times.sort()
+    return {
+        'min_ms': round(times[0], 4),
+        'median_ms': round(statistics.median(times), 4),
+        'p95_ms': round(times[min(len(times) - 1, int(len(times) * 0.95))], 4),
+        'runs': repeat,
+    }
+
+
+def run(path, repeat: int = 50, only=None) -> dict:
+    """Time every case (or those named in `only`) against the database at `path`."""
+    cases = _cases(path)
+    unknown = set(only or ()) - set(cases)
+    if unknown:
+        raise ValueError(f"unknown cases: {', '.join(sorted(unknown))}")
+    return {name: measure(fn, repeat) for name, fn in cases.items() if not only or name in only}
+
+
+def compare(results: dict, baseline: dict, tolerance: float = TOLERANCE) -> list:
+    """Cases slower than the baseline allows, as (name, baseline best ms, best ms)."""
+    slower = []
+    for name, r in results.items():
+        base = baseline['results'].get(name)
+        if base and r['min_ms'] > base['min_ms'] * (1 + tolerance) + FLOOR_MS:
+            slower.append((name, base['min_ms'], r['min_ms']))
+    return slower
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="db.py benchmark suite")
+    ap.add_argument("--db", default=str(DEFAULT_DB), help="benchmark database, rebuilt when the fixture parameters change")
+    for key, value in fixtures.DEFAULTS.items():
+        ap.add_argument(f"--{key.replace('_', '-')}", type=int, help=f"fixture {key} (default {value})")
+    ap.add_argument("--repeat", type=int, default=50)
+    ap.add_argument("--cases", nargs="+", help="only these cases")
+    ap.add_argument("--output", help="write results as JSON here ('-' for stdout)")
+    ap.add_argument("--baseline", help="fail when slower than this stored run")
+    ap.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed slowdown as a fraction (default 0.25)")
+    ap.add_argument("--save-baseline", help="store this run as a baseline")
+    args = ap.parse_args(argv)
+
+    Path(args.db).parent.mkdir(parents=True, exist_ok=True)
+    t = time.perf_counter()
+    params = fixtures.load_or_build(args.db, **{k: getattr(args, k) for k in fixtures.DEFAULTS})
+    conn = db.connect(args.db)
+    sales, movements = (conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("sales", "movements"))
+    conn.close()
+    print(f"fixture: {sales} sales, {movements} movements ({time.perf_counter() - t:.1f}s)", file=sys.stderr)
+
+    report = {
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'fixture': params,
+        'rows': {'sales': sales, 'movements': movements},
+        'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                        'platform': platform.platform(), 'journal_mode': db.JOURNAL_MODE},
+        'results': run(args.db, args.repeat, args.cases),
+    }
+    db.close_pool()
+
+    print(f"{'case':<24}{'min ms':>10}{'median ms':>12}{'p95 ms':>10}", file=sys.stderr)
+    for name, r in report['results'].items():
+        print(f"{name:<24}{r['min_ms']:>10.3f}{r['median_ms']:>12.3f}{r['p95_ms']:>10.3f}", file=sys.stderr)
+    text = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(text)
+    elif args.output:
+        Path(args.output).write_text(text + "\n")
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(text + "\n")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if baseline['fixture'] != params:
+            print(f"baseline {args.baseline} was recorded on a different fixture; not comparing", file=sys.stderr)
+            return 2
+        slower = compare(report['results'], baseline, args.tolerance)
+        for name, before, now in slower:
+            print(f"REGRESSION {name}: best {now:.3f} ms vs baseline {before:.3f} ms", file=sys.stderr)
+        if slower:
+            return 1
+        print(f"no regressions against {args.baseline} (tolerance {args.tolerance:.0%})", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
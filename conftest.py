@@ -0,0 +1,22 @@
+"""Fixtures shared by the test modules."""
+import pytest
+
+import app as erp_app
+import db
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """A fresh database, made the default for db and the app."""
+    path = tmp_path / "erp.db"
+    monkeypatch.setattr(db, "get_db_path", lambda *a, **k: path)
+    db.init_db(path)
+    return path
+
+
+@pytest.fixture
+def client(db_path):
+    """Test client logged in as admin against db_path."""
+    c = erp_app.app.test_client()
+    c.post("/api/login", json={"username": "admin", "password": "admin"})
+    return c
@@ -5,29 +5,707 @@ Tables:
 - sales(id INTEGER PRIMARY KEY, product_id INTEGER, quantity INTEGER, unit_price REAL, total REAL, timestamp TEXT)
 
 This module uses only Python's stdlib sqlite3.
+
+Connections are pooled: `connect()` hands out an already-open connection when
+one is idle and `close()` on it puts it back, so helpers keep their
+connect/close shape without reopening the file on every call.
+
+The database file is data/erp.db unless ERP_DB_PATH points elsewhere.
+
+Concurrency is tuned through environment variables (read at import):
+- ERP_DB_JOURNAL_MODE  WAL (default) or DELETE/TRUNCATE/PERSIST; set by init_db
+- ERP_DB_SYNCHRONOUS   NORMAL with WAL, FULL otherwise
+- ERP_DB_CACHE_KB, ERP_DB_MMAP_BYTES, ERP_DB_BUSY_TIMEOUT_MS
+- ERP_DB_WRITE_RETRIES bounded retries for BEGIN IMMEDIATE on a locked database
+- ERP_GROUP_COMMIT     1 to record orders through a single writer thread that
+  commits them in batches (ERP_GROUP_COMMIT_MAX_BATCH, default 64, and
+  ERP_GROUP_COMMIT_MAX_WAIT_MS, default 0)
+
+Closed months can be archived into compressed per-month segment files
+(ERP_ARCHIVE_DIR, ERP_ARCHIVE_KEEP_MONTHS, ERP_ARCHIVE_CACHE_SEGMENTS); see
+"Archive segments".
 """
 from pathlib import Path
+import atexit
+from concurrent.futures import Future
+import gzip
+import hashlib
+import heapq
+import json
+import os
+import queue
+import random
+import re
+import shutil
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import events
+import metrics
+
+
+JOURNAL_MODE = os.environ.get("ERP_DB_JOURNAL_MODE", "WAL").upper()
+SYNCHRONOUS = os.environ.get("ERP_DB_SYNCHRONOUS", "NORMAL" if JOURNAL_MODE == "WAL" else "FULL").upper()
+CACHE_SIZE_KB = int(os.environ.get("ERP_DB_CACHE_KB", 16384))
+MMAP_SIZE = int(os.environ.get("ERP_DB_MMAP_BYTES", 64 * 1024 * 1024))
+BUSY_TIMEOUT_MS = int(os.environ.get("ERP_DB_BUSY_TIMEOUT_MS", 5000))
+WRITE_RETRIES = int(os.environ.get("ERP_DB_WRITE_RETRIES", 5))
+WRITE_BACKOFF = 0.01
+WRITE_BACKOFF_MAX = 0.5
+
+if JOURNAL_MODE not in ("WAL", "DELETE", "TRUNCATE", "PERSIST"):
+    raise ValueError(f"unsupported ERP_DB_JOURNAL_MODE: {JOURNAL_MODE}")
+if SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError(f"unsupported ERP_DB_SYNCHRONOUS: {SYNCHRONOUS}")
+
+# pragmas applied once when a pooled connection is opened
+STANDARD_PRAGMAS = (
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA synchronous = {SYNCHRONOUS}",
+    f"PRAGMA cache_size = -{CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size = {MMAP_SIZE}",
+)
+
+# idle connections kept per database file
+POOL_MAX_IDLE = int(os.environ.get("ERP_DB_POOL_SIZE", 8))
 
 
 def get_db_path(base_dir: Path = Path(__file__).parent / "data") -> Path:
+    """The database file: $ERP_DB_PATH when set, else data/erp.db."""
+    if os.environ.get("ERP_DB_PATH"):
+        return Path(os.environ["ERP_DB_PATH"])
     base_dir.mkdir(parents=True, exist_ok=True)
     return base_dir / "erp.db"
 
 
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that reports each statement's execute and fetch time to metrics.py."""
+
+    sql = ''
+
+    def execute(self, sql, parameters=()):
+        self.sql = sql
+        t = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe_sql(sql, time.perf_counter() - t)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.sql = sql
+        t = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.observe_sql(sql, time.perf_counter() - t)
+
+    def executescript(self, sql_script):
+        t = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            metrics.observe_sql(sql_script, time.perf_counter() - t)
+
+    # a SELECT does most of its work while rows are fetched
+    def fetchone(self):
+        t = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            metrics.observe_sql(self.sql, time.perf_counter() - t, statement=False)
+
+    def fetchmany(self, size=None):
+        t = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            metrics.observe_sql(self.sql, time.perf_counter() - t, statement=False)
+
+    def fetchall(self):
+        t = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            metrics.observe_sql(self.sql, time.perf_counter() - t, statement=False)
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection owned by a ConnectionPool.
+
+    `close()` does not close the file: it rolls back anything left uncommitted
+    and hands the connection back to the pool for the next caller.
+
+    Statements go through TimedCursor (unless ERP_METRICS=0), so
+    `conn.execute()` and `conn.cursor().execute()` are both counted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+        self.pool_key = None
+        self.generation = 0
+        self.checked_out = False
+
+    if metrics.ENABLED:
+        def cursor(self, factory=TimedCursor):
+            return super().cursor(factory)
+
+        def execute(self, sql, parameters=()):
+            return self.cursor().execute(sql, parameters)
+
+        def executemany(self, sql, seq_of_parameters):
+            return self.cursor().executemany(sql, seq_of_parameters)
+
+        def executescript(self, sql_script):
+            return self.cursor().executescript(sql_script)
+
+    def close(self):
+        if self.pool is None:
+            return super().close()
+        if not self.checked_out:
+            return
+        self.checked_out = False
+        try:
+            if self.in_transaction:
+                self.rollback()
+        except sqlite3.Error:
+            self.close_for_real()
+            return
+        self.pool.release(self)
+
+    def commit(self):
+        super().commit()
+        if self.pool is not None:
+            _after_commit(self.pool_key)
+
+    def close_for_real(self):
+        self.pool = None
+        sqlite3.Connection.close(self)
+
+
+class ConnectionPool:
+    """Idle connections per database file, shared by every thread in the process.
+
+    A connection is only ever used by one caller at a time, so this works for
+    the Flask dev server (a thread per request), gunicorn sync/threaded workers
+    and the CLI alike. Connections inherited across fork() are never reused.
+    """
+
+    def __init__(self, max_idle: int = POOL_MAX_IDLE):
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.in_use = 0
+
+    def acquire(self, db_path: Path | str) -> PooledConnection:
+        key = str(db_path)
+        conn = None
+        with self._lock:
+            if self._pid != os.getpid():
+                # the parent's connections must not be touched from the child
+                self._idle = {}
+                self._pid = os.getpid()
+                self.in_use = 0
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.in_use += 1
+            generation = self._generation
+        if conn is None:
+            try:
+                conn = self._open(key)
+            except Exception:
+                with self._lock:
+                    self.in_use -= 1
+                raise
+            conn.generation = generation
+        conn.checked_out = True
+        return conn
+
+    def _open(self, key: str) -> PooledConnection:
+        conn = sqlite3.connect(key, factory=PooledConnection, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in STANDARD_PRAGMAS:
+            conn.execute(pragma)
+        conn.pool = self
+        conn.pool_key = key
+        return conn
+
+    def release(self, conn: PooledConnection):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self.in_use = max(0, self.in_use - 1)
+            idle = self._idle.setdefault(conn.pool_key, [])
+            if conn.generation == self._generation and len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close_for_real()
+
+    def stats(self) -> dict:
+        with self._lock:
+            idle = sum(len(v) for v in self._idle.values())
+            return {"hits": self.hits, "misses": self.misses, "idle": idle, "in_use": self.in_use, "pid": self._pid}
+
+    def close_all(self):
+        """Close idle connections now; ones still checked out close when returned."""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._generation += 1
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                try:
+                    conn.close_for_real()
+                except Exception:
+                    pass
+
+
+_pool = ConnectionPool()
+
+
 def connect(db_path: Path | str | None = None):
+    """Return a pooled connection for db_path; call close() to give it back."""
     if db_path is None:
         db_path = get_db_path()
-    conn = sqlite3.connect(str(db_path))
-    conn.row_factory = sqlite3.Row
-    return conn
+    return _pool.acquire(db_path)
+
+
+def pool_stats() -> dict:
+    return _pool.stats()
+
+
+def close_pool():
+    _pool.close_all()
+
+
+atexit.register(close_pool)
+
+
+def _is_locked(e: sqlite3.OperationalError) -> bool:
+    msg = str(e).lower()
+    return "locked" in msg or "busy" in msg
+
+
+def begin_write(conn, retries: int | None = None):
+    """Start a write transaction with BEGIN IMMEDIATE.
+
+    Taking the write lock up front means a writer never has to upgrade a read
+    lock mid-transaction (which fails straight away with "database is locked").
+    If the lock is still held after busy_timeout, retry with jittered
+    exponential backoff a bounded number of times before giving up.
+    """
+    if retries is None:
+        retries = WRITE_RETRIES
+    delay = WRITE_BACKOFF
+    for attempt in range(retries + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as e:
+            if not _is_locked(e) or attempt == retries:
+                raise
+            time.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, WRITE_BACKOFF_MAX)
+
+
+### Schema registry ###
+# Optional sales columns added by later migrations, in the order they are stored.
+SALES_OPTIONAL_COLUMNS = ("created_by", "bottles_used", "bottle_price")
+_SALES_INSERT_BASE = ("product_id", "quantity", "unit_price", "total", "payment_method", "timestamp")
+_SALES_SELECT_FROM = "FROM sales s JOIN products p ON p.id = s.product_id"
+
+_schema_lock = threading.Lock()
+_schema_cache = {}
+
+
+def _build_sales_schema(conn) -> dict:
+    """Introspect `sales` once and precompute the SQL used on the order/listing paths."""
+    cols = tuple(c[1] for c in conn.execute("PRAGMA table_info(sales)").fetchall())
+    optional = tuple(c for c in SALES_OPTIONAL_COLUMNS if c in cols)
+    insert_fields = _SALES_INSERT_BASE + optional
+    # stored on insert but never listed
+    has_key = "idempotency_key" in cols
+    if has_key:
+        insert_fields += ("idempotency_key",)
+    # output field name -> select expression, for listings and `fields=` projection
+    exprs = {
+        "id": "s.id", "product_id": "s.product_id", "product_name": "p.name as product_name",
+        "quantity": "s.quantity", "unit_price": "s.unit_price", "total": "s.total",
+        "payment_method": "s.payment_method", "timestamp": "s.timestamp",
+    }
+    exprs.update({c: f"s.{c}" for c in optional})
+    order_fields = tuple(exprs)
+    sale_fields = tuple(f for f in order_fields if f != "payment_method")
+    return {
+        "key": None,
+        "columns": cols,
+        "optional": optional,
+        "has_idempotency_key": has_key,
+        "exprs": exprs,
+        "order_fields": order_fields,
+        "sale_fields": sale_fields,
+        "insert_sql": f"INSERT INTO sales ({', '.join(insert_fields)}) VALUES ({', '.join(['?'] * len(insert_fields))})",
+        "sale_by_id_sql": f"SELECT {', '.join(exprs[f] for f in order_fields)} {_SALES_SELECT_FROM} WHERE s.id = ?",
+        # listing SQL text, filled in per filter/projection shape on first use
+        "sql": {},
+    }
+
+
+def _project(available, default: tuple, fields) -> tuple:
+    """Validate a `fields=` projection against the available output names."""
+    if not fields:
+        return default
+    out = tuple(dict.fromkeys(f.strip() for f in fields if f and f.strip()))
+    unknown = [f for f in out if f not in available]
+    if unknown:
+        raise ValueError(f"unknown field(s): {', '.join(unknown)}")
+    return out or default
+
+
+def _sales_listing_sql(schema: dict, fields: tuple, by_date: bool, by_user: bool, after: bool, limited: bool) -> str:
+    key = (fields, by_date, by_user, after, limited)
+    sql = schema["sql"].get(key)
+    if sql is None:
+        where = []
+        if by_date:
+            where.append("s.timestamp >= ? AND s.timestamp < ?")
+        if by_user:
+            where.append("s.created_by = ?")
+        if after:
+            where.append("s.id < ?")
+        where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+        sql = f"SELECT {', '.join(schema['exprs'][f] for f in fields)} {_SALES_SELECT_FROM}{where_sql} ORDER BY s.id DESC"
+        if limited:
+            sql += " LIMIT ?"
+        # projections come from request input; keep the memo bounded
+        if len(schema["sql"]) < 256:
+            schema["sql"][key] = sql
+    return sql
+
+
+def sales_schema(db_path: Path | str | None = None) -> dict:
+    """Cached sales schema for db_path; built by init_db or on first use."""
+    key = str(db_path if db_path is not None else get_db_path())
+    schema = _schema_cache.get(key)
+    if schema is None:
+        conn = connect(key)
+        try:
+            schema = _build_sales_schema(conn)
+        finally:
+            conn.close()
+        schema["key"] = key
+        with _schema_lock:
+            _schema_cache[key] = schema
+    return schema
+
+
+def invalidate_schema(db_path: Path | str | None = None):
+    """Forget cached schema after a migration (all databases when db_path is None)."""
+    with _schema_lock:
+        if db_path is None:
+            _schema_cache.clear()
+        else:
+            _schema_cache.pop(str(db_path), None)
+
+
+### Catalog cache ###
+# Tables whose writes bump a counter in table_versions (maintained by triggers).
+VERSIONED_TABLES = ("products", "product_sources", "sources", "inventory")
+_BOTTLE_NAME = re.compile(r"^Empty (\d+)L bottle$")
+
+
+def _create_version_triggers(cur, tables):
+    now = datetime.utcnow().replace(microsecond=0).isoformat() + 'Z'
+    for table in tables:
+        cur.execute("INSERT OR IGNORE INTO table_versions (name, version, updated_at) VALUES (?, 0, ?)", (table, now))
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            # recreated so older trigger bodies pick up new columns
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_{table}_{op.lower()}_version")
+            cur.execute(
+                f"CREATE TRIGGER trg_{table}_{op.lower()}_version AFTER {op} ON {table} "
+                f"BEGIN UPDATE table_versions SET version = version + 1, "
+                f"updated_at = strftime('%Y-%m-%dT%H:%M:%SZ', 'now') WHERE name = '{table}'; END"
+            )
 
 
-def init_db(db_path: Path | str | None = None):
-    """Create tables and add default product (5L water at 40 KSH) if missing."""
+class CatalogCache:
+    """Products, product->source mappings and bottle products per database, kept in memory.
+
+    Every read checks the products/product_sources counters in table_versions,
+    which triggers bump on any write from any process, so gunicorn workers see
+    each other's catalog edits. When called inside a write transaction the
+    check is exact; the order path then runs no catalog queries at all.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.loads = 0
+
+    def get(self, cur, key: str) -> dict:
+        try:
+            version = tuple(r[0] for r in cur.execute("SELECT version FROM table_versions WHERE name IN ('products', 'product_sources') ORDER BY name"))
+        except sqlite3.OperationalError:
+            # database predates table_versions (init_db not run yet): don't cache
+            version = None
+        entry = self._entries.get(key)
+        if version is not None and entry is not None and entry[0] == version:
+            return entry[1]
+        catalog = self._load(cur)
+        if version is not None:
+            with self._lock:
+                self._entries[key] = (version, catalog)
+        return catalog
+
+    def _load(self, cur) -> dict:
+        self.loads += 1
+        products = {}
+        bottles = {}
+        first_empty = None
+        for r in cur.execute("SELECT id, name, unit_price FROM products ORDER BY id"):
+            p = {'id': r[0], 'name': r[1], 'unit_price': r[2]}
+            products[p['id']] = p
+            m = _BOTTLE_NAME.match(p['name'] or '')
+            if m and int(m.group(1)) not in bottles:
+                bottles[int(m.group(1))] = p['id']
+            if first_empty is None and 'empty' in (p['name'] or '').lower():
+                first_empty = p['id']
+        sources = {
+            r[0]: {'source_id': r[1], 'factor': float(r[2])}
+            for r in cur.execute("SELECT product_id, source_id, factor FROM product_sources")
+        }
+        return {'products': products, 'bottle_by_size': bottles, 'first_bottle': first_empty, 'sources': sources}
+
+    def invalidate(self, key: str | None = None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+_catalog = CatalogCache()
+
+
+def _bottle_product(catalog: dict, mapping: dict | None):
+    """Empty bottle product for a mapped size ("Empty 5L bottle"), else the first "Empty" product."""
+    bottle_pid = None
+    if mapping:
+        bottle_pid = catalog['bottle_by_size'].get(int(mapping['factor']))
+    if bottle_pid is None:
+        bottle_pid = catalog['first_bottle']
+    return bottle_pid
+
+
+def get_catalog(db_path: Path | str | None = None) -> dict:
+    key = str(db_path if db_path is not None else get_db_path())
+    conn = connect(key)
+    try:
+        return _catalog.get(conn.cursor(), key)
+    finally:
+        conn.close()
+
+
+def _invalidate_catalog(db_path):
+    _catalog.invalidate(str(db_path if db_path is not None else get_db_path()))
+
+
+# seconds a process may reuse table versions read from the database; commits
+# made by this process drop them at once, so only other workers' writes wait
+VERSION_TTL = float(os.environ.get("ERP_VERSION_TTL", 1.0))
+_versions_lock = threading.Lock()
+_versions_cache = {}
+
+
+def table_versions(db_path: Path | str | None = None) -> dict:
+    """{table: (version, updated_at)} for every table in VERSIONED_TABLES.
+
+    Usually answered from memory (see VERSION_TTL), which is what lets
+    conditional HTTP requests get a 304 without querying SQLite.
+    """
+    key = str(db_path if db_path is not None else get_db_path())
+    now = time.monotonic()
+    entry = _versions_cache.get(key)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    conn = connect(key)
+    try:
+        rows = conn.execute("SELECT name, version, updated_at FROM table_versions").fetchall()
+    finally:
+        conn.close()
+    versions = {r[0]: (r[1], r[2]) for r in rows}
+    with _versions_lock:
+        _versions_cache[key] = (now + VERSION_TTL, versions)
+    return versions
+
+
+def _after_commit(key: str):
+    _versions_cache.pop(key, None)
+
+
+def date_range(date_iso: str) -> tuple[str, str]:
+    """Half-open [start, end) timestamp bounds for a YYYY-MM-DD, YYYY-MM or YYYY prefix.
+
+    Timestamps are stored as ISO text, so `timestamp >= start AND timestamp < end`
+    selects the same rows as `timestamp LIKE 'prefix%'` but can use an index.
+    """
+    try:
+        parts = [int(p) for p in date_iso.split('-')]
+        if len(parts) == 3:
+            start = date(*parts)
+            end = start + timedelta(days=1)
+        elif len(parts) == 2:
+            start = date(parts[0], parts[1], 1)
+            end = date(parts[0] + (parts[1] == 12), parts[1] % 12 + 1, 1)
+        elif len(parts) == 1:
+            start = date(parts[0], 1, 1)
+            end = date(parts[0] + 1, 1, 1)
+        else:
+            raise ValueError(date_iso)
+    except (ValueError, TypeError, OverflowError):
+        raise ValueError("date must be YYYY-MM-DD, YYYY-MM or YYYY")
+    return start.isoformat(), end.isoformat()
+
+
+### Online table rewrites ###
+# Rebuild a table with a new definition without holding the write lock for
+# the whole copy: rows go into a shadow table in short chunks while triggers
+# mirror concurrent inserts/updates/deletes, then the two are swapped in one
+# short transaction. Progress is kept in table_rewrites, so an interrupted
+# rewrite resumes where it stopped.
+
+REWRITE_CHUNK = int(os.environ.get("ERP_REWRITE_CHUNK", 5000))
+# seconds to sleep between chunks so tills get the write lock
+REWRITE_PAUSE = float(os.environ.get("ERP_REWRITE_PAUSE", 0.01))
+
+
+def _rewrite_columns(conn, table: str, shadow: str, exprs: dict | None):
+    old = {c[1] for c in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    exprs = exprs or {}
+    cols = [c[1] for c in conn.execute(f"PRAGMA table_info({shadow})").fetchall() if c[1] in exprs or c[1] in old]
+    return ", ".join(cols), ", ".join(exprs.get(c, c) for c in cols)
+
+
+def rewrite_status(name: str, db_path: Path | str | None = None) -> dict | None:
+    """Progress of the online rewrite `name`, or None if none was started."""
     conn = connect(db_path)
-    cur = conn.cursor()
+    try:
+        row = conn.execute("SELECT * FROM table_rewrites WHERE name = ?", (name,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    conn.close()
+    return dict(row) if row else None
+
+
+def rewrite_table(table: str, create_sql: str, exprs: dict | None = None, key: str = 'id', chunk_size: int | None = None,
+                  pause: float | None = None, progress=None, name: str | None = None, db_path: Path | str | None = None) -> int:
+    """Rebuild `table` online as `create_sql` (a CREATE TABLE with a {name} placeholder).
+
+    `exprs` maps new columns to SQL over the old row (default: copy columns
+    of the same name). Rows are copied `chunk_size` at a time in `key` order,
+    one short write transaction each, sleeping `pause` seconds in between;
+    progress(copied, total) is called after every chunk. The swap checks row
+    counts, replaces the table and recreates its indexes and triggers.
+    `name` identifies the rewrite in table_rewrites (default: the table name).
+    Returns the number of rows in the rewritten table.
+    """
+    name = name or table
+    chunk_size = chunk_size or REWRITE_CHUNK
+    pause = REWRITE_PAUSE if pause is None else pause
+    shadow = f"{table}__rewrite"
+    trg = f"trg_{table}__rewrite"
+    conn = connect(db_path)
+    try:
+        begin_write(conn)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS table_rewrites (name TEXT PRIMARY KEY, shadow TEXT NOT NULL, last_id INTEGER NOT NULL DEFAULT 0, "
+            "max_id INTEGER, copied INTEGER NOT NULL DEFAULT 0, total INTEGER, started_at TEXT NOT NULL, finished_at TEXT)"
+        )
+        state = conn.execute("SELECT last_id, finished_at FROM table_rewrites WHERE name = ?", (name,)).fetchone()
+        if state is not None and state[1]:
+            conn.rollback()
+            return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        if state is None:
+            conn.execute(f"DROP TABLE IF EXISTS {shadow}")
+            conn.execute(create_sql.format(name=shadow))
+            cols, select = _rewrite_columns(conn, table, shadow, exprs)
+            upsert = f"INSERT OR REPLACE INTO {shadow} ({cols}) SELECT {select} FROM {table} WHERE {key} = NEW.{key};"
+            conn.execute(f"CREATE TRIGGER {trg}_ins AFTER INSERT ON {table} BEGIN {upsert} END")
+            conn.execute(f"CREATE TRIGGER {trg}_upd AFTER UPDATE ON {table} BEGIN DELETE FROM {shadow} WHERE {key} = OLD.{key}; {upsert} END")
+            conn.execute(f"CREATE TRIGGER {trg}_del AFTER DELETE ON {table} BEGIN DELETE FROM {shadow} WHERE {key} = OLD.{key}; END")
+            # rows past max_id arrive after the triggers exist, so the triggers copy them
+            total, max_id = conn.execute(f"SELECT COUNT(*), MAX({key}) FROM {table}").fetchone()
+            conn.execute("INSERT INTO table_rewrites (name, shadow, last_id, max_id, total, started_at) VALUES (?, ?, 0, ?, ?, ?)",
+                         (name, shadow, max_id, total, datetime.utcnow().isoformat() + 'Z'))
+            last_id = 0
+        else:
+            last_id = state[0]
+        conn.commit()
+        cols, select = _rewrite_columns(conn, table, shadow, exprs)
+        total, max_id = conn.execute("SELECT total, max_id FROM table_rewrites WHERE name = ?", (name,)).fetchone()
+
+        while max_id is not None and last_id < max_id:
+            begin_write(conn)
+            upto = conn.execute(f"SELECT MAX({key}) FROM (SELECT {key} FROM {table} WHERE {key} > ? AND {key} <= ? ORDER BY {key} LIMIT ?)",
+                                (last_id, max_id, chunk_size)).fetchone()[0]
+            if upto is None:
+                conn.rollback()
+                break
+            n = conn.execute(f"INSERT OR REPLACE INTO {shadow} ({cols}) SELECT {select} FROM {table} WHERE {key} > ? AND {key} <= ?",
+                             (last_id, upto)).rowcount
+            conn.execute("UPDATE table_rewrites SET last_id = ?, copied = copied + ? WHERE name = ?", (upto, n, name))
+            copied = conn.execute("SELECT copied FROM table_rewrites WHERE name = ?", (name,)).fetchone()[0]
+            conn.commit()
+            last_id = upto
+            if progress:
+                progress(copied, total)
+            if pause:
+                time.sleep(pause)
+
+        # swap: everything written meanwhile is already mirrored by the triggers
+        begin_write(conn)
+        try:
+            extras = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL AND name NOT LIKE ?",
+                (table, f"{trg}%"),
+            ).fetchall()
+            old_n = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            new_n = conn.execute(f"SELECT COUNT(*) FROM {shadow}").fetchone()[0]
+            if old_n != new_n:
+                raise RuntimeError(f"rewrite of {table} is out of step: {old_n} rows vs {new_n} copied")
+            conn.execute(f"DROP TABLE {table}")
+            conn.execute(f"ALTER TABLE {shadow} RENAME TO {table}")
+            for (sql,) in extras:
+                conn.execute(sql)
+            conn.execute("UPDATE table_rewrites SET finished_at = ? WHERE name = ?", (datetime.utcnow().isoformat() + 'Z', name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return new_n
+    finally:
+        conn.close()
+        invalidate_schema(db_path)
+
+
+### Schema migrations ###
+# Each migration runs once, in its own write transaction, and is recorded in
+# schema_version. The early ones are written to be safe on databases created
+# before versioning existed (IF NOT EXISTS, column checks).
+
+def _m001_base_tables(cur):
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS products (
@@ -37,23 +715,8 @@ def init_db(db_path: Path | str | None = None):
         )
         """
     )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS sales (
-            id INTEGER PRIMARY KEY,
-            product_id INTEGER NOT NULL,
-            quantity REAL NOT NULL,
-            unit_price REAL NOT NULL,
-            total REAL NOT NULL,
-            payment_method TEXT DEFAULT 'Cash',
-            timestamp TEXT NOT NULL,
-            created_by INTEGER,
-            FOREIGN KEY(product_id) REFERENCES products(id),
-            FOREIGN KEY(created_by) REFERENCES users(id)
-        )
-        """
-    )
-    # create users table for simple auth
+    cur.execute(_SALES_TABLE_SQL.format(name="IF NOT EXISTS sales"))
+    # users table for simple auth
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS users (
@@ -64,20 +727,7 @@ def init_db(db_path: Path | str | None = None):
         )
         """
     )
-    # ensure default product exists
-    cur.execute("SELECT id FROM products WHERE name = ?", ("5L water",))
-    if cur.fetchone() is None:
-        cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", ("5L water", 40.0))
-    # ensure default users
-    cur.execute("SELECT id FROM users WHERE username = ?", ("admin",))
-    if cur.fetchone() is None:
-        # NOTE: passwords stored in plain text for prototype only
-        cur.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", ("admin", "admin", "admin"))
-    cur.execute("SELECT id FROM users WHERE username = ?", ("user",))
-    if cur.fetchone() is None:
-        cur.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)", ("user", "user", "user"))
-    conn.commit()
-    # ensure inventory table exists (tracks product stock levels)
+    # product stock levels
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS inventory (
@@ -89,7 +739,7 @@ def init_db(db_path: Path | str | None = None):
         )
         """
     )
-    # ensure sources table exists (central tanks / gallons where water comes from)
+    # central tanks / gallons where water comes from
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS sources (
@@ -141,132 +791,636 @@ def init_db(db_path: Path | str | None = None):
         )
         """
     )
-    # Ensure sales.quantity is REAL (migrate if older INTEGER existed)
-    try:
-        cur.execute("PRAGMA table_info(sales)")
-        cols = cur.fetchall()
-        qty_col = None
-        for c in cols:
-            # c is sqlite3.Row with name and type
-            if c[1] == 'quantity':
-                qty_col = c
-                break
-        if qty_col is not None:
-            col_type = qty_col[2].upper() if qty_col[2] else ''
-            if col_type != 'REAL':
-                # migrate table: create new table with quantity REAL, copy data
-                cur.execute('ALTER TABLE sales RENAME TO sales_old')
-                cur.execute(
-                    """
-                    CREATE TABLE sales (
-                        id INTEGER PRIMARY KEY,
-                        product_id INTEGER NOT NULL,
-                        quantity REAL NOT NULL,
-                        unit_price REAL NOT NULL,
-                        total REAL NOT NULL,
-                        payment_method TEXT DEFAULT 'Cash',
-                        timestamp TEXT NOT NULL,
-                        FOREIGN KEY(product_id) REFERENCES products(id)
-                    )
-                    """
-                )
-                # copy rows, casting quantity to REAL
-                cur.execute("INSERT INTO sales (id, product_id, quantity, unit_price, total, payment_method, timestamp) SELECT id, product_id, CAST(quantity AS REAL), unit_price, total, payment_method, timestamp FROM sales_old")
-                cur.execute("DROP TABLE sales_old")
+
+
+_SALES_TABLE_SQL = """
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY,
+            product_id INTEGER NOT NULL,
+            quantity REAL NOT NULL,
+            unit_price REAL NOT NULL,
+            total REAL NOT NULL,
+            payment_method TEXT DEFAULT 'Cash',
+            timestamp TEXT NOT NULL,
+            created_by INTEGER,
+            FOREIGN KEY(product_id) REFERENCES products(id),
+            FOREIGN KEY(created_by) REFERENCES users(id)
+        )
+        """
+
+
+def _m002_sales_quantity_real(db_path, progress=None):
+    """Very old databases stored sales.quantity as INTEGER; rebuild the table with REAL, online."""
+    conn = connect(db_path)
+    cols = conn.execute("PRAGMA table_info(sales)").fetchall()
+    conn.close()
+    qty = next((c for c in cols if c[1] == 'quantity'), None)
+    if qty is None or (qty[2] or '').upper() == 'REAL':
+        return
+    base = ('id', 'product_id', 'quantity', 'unit_price', 'total', 'payment_method', 'timestamp', 'created_by')
+    # keep any columns added to the old table since
+    extra = "".join(
+        f"{c[1]} {c[2]}{f' DEFAULT {c[4]}' if c[4] is not None else ''},\n            "
+        for c in cols if c[1] not in base
+    )
+    create_sql = _SALES_TABLE_SQL.replace("FOREIGN KEY(product_id)", extra + "FOREIGN KEY(product_id)", 1)
+    rewrite_table("sales", create_sql, exprs={'quantity': 'CAST(quantity AS REAL)'}, progress=progress,
+                  name="sales.quantity_real", db_path=db_path)
+
+
+# runs outside the runner's transaction; the rewrite commits chunk by chunk
+_m002_sales_quantity_real.online = True
+
+
+def _m003_sales_columns(cur):
+    cols = {c[1] for c in cur.execute("PRAGMA table_info(sales)").fetchall()}
+    for name, decl in (
+        ("created_by", "INTEGER"),
+        # number of bottles consumed by a sale and the price charged per bottle
+        ("bottles_used", "INTEGER DEFAULT 0"),
+        ("bottle_price", "REAL DEFAULT 0"),
+        # client-supplied key that makes order replays safe
+        ("idempotency_key", "TEXT"),
+    ):
+        if name not in cols:
+            cur.execute(f"ALTER TABLE sales ADD COLUMN {name} {decl}")
+
+
+def _m004_indexes(cur):
+    # partial index: keys cleared by purge_idempotency_keys drop out of it
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sales_idempotency_key ON sales(idempotency_key) WHERE idempotency_key IS NOT NULL")
+    # date/user filtering of sales and per-ref movement lookups
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sales_timestamp ON sales(timestamp)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sales_created_by_timestamp ON sales(created_by, timestamp)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sales_product_id ON sales(product_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movements_kind_ref_id ON movements(kind, ref_id, id)")
+
+
+def _m005_table_versions(cur):
+    # per-table change counters bumped by triggers (catalog cache, HTTP validators)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        )
+        """
+    )
+    if 'updated_at' not in [c[1] for c in cur.execute("PRAGMA table_info(table_versions)").fetchall()]:
+        cur.execute("ALTER TABLE table_versions ADD COLUMN updated_at TEXT")
+    _create_version_triggers(cur, VERSIONED_TABLES)
+
+
+def _m006_sales_rollup(cur):
+    # per-day sales rollup maintained by record_order; created_by 0 = unknown user
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sales_daily_rollup (
+            day TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            created_by INTEGER NOT NULL DEFAULT 0,
+            payment_method TEXT NOT NULL DEFAULT '',
+            orders INTEGER NOT NULL DEFAULT 0,
+            quantity REAL NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0,
+            bottles_used INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_id, created_by, payment_method)
+        ) WITHOUT ROWID
+        """
+    )
+    # backfill for databases that already had sales before the rollup existed
+    if cur.execute("SELECT 1 FROM sales_daily_rollup LIMIT 1").fetchone() is None:
+        _rebuild_rollup(cur.connection)
+
+
+def _m007_seed_defaults(cur):
+    """Default users, water products, main tank, bottle stock and product->tank mappings.
+
+    Only adds what is missing: live stock levels and mappings an admin has
+    changed are left alone.
+    """
+    now = datetime.utcnow().isoformat() + 'Z'
+    # NOTE: passwords stored in plain text for prototype only
+    for username, password, role in (("admin", "admin", "admin"), ("user", "user", "user")):
+        cur.execute("INSERT OR IGNORE INTO users (username, password, role) VALUES (?, ?, ?)", (username, password, role))
+
+    r = cur.execute("SELECT id FROM sources WHERE name = ?", ("Main Tank",)).fetchone()
+    if r is None:
+        cur.execute("INSERT INTO sources (name, unit, quantity, last_updated) VALUES (?, ?, ?, ?)", ("Main Tank", 'L', 10000.0, now))
+        main_tank_id = cur.lastrowid
+    else:
+        main_tank_id = r[0]
+
+    def product_id(name, price):
+        r = cur.execute("SELECT id FROM products WHERE name = ?", (name,)).fetchone()
+        if r is not None:
+            return r[0]
+        cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", (name, float(price)))
+        return cur.lastrowid
+
+    # water products and litres drawn from the main tank per unit
+    for name, price, factor in (("5L water", 40.0, 5.0), ("10L water", 70.0, 10.0), ("20L water", 120.0, 20.0)):
+        pid = product_id(name, price)
+        cur.execute("INSERT OR IGNORE INTO product_sources (product_id, source_id, factor) VALUES (?, ?, ?)", (pid, main_tank_id, factor))
+
+    # empty bottle product types with their starting counts
+    for name, initial_count in (("Empty 5L bottle", 120.0), ("Empty 10L bottle", 80.0), ("Empty 20L bottle", 40.0)):
+        pid = product_id(name, 0.0)
+        cur.execute("INSERT OR IGNORE INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, ?)", (pid, initial_count, now))
+
+
+def _m008_stock_checkpoints(cur):
+    # point-in-time stock levels (see "Stock checkpoints"), anchored at the current counters
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stock_checkpoints (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL, -- 'source' or 'inventory'
+            ref_id INTEGER NOT NULL, -- source_id or product_id
+            timestamp TEXT NOT NULL,
+            movement_id INTEGER NOT NULL, -- last movement reflected in quantity
+            quantity REAL NOT NULL
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_stock_checkpoints_ref ON stock_checkpoints(kind, ref_id, timestamp)")
+    _checkpoint_changed(cur, datetime.utcnow().isoformat() + 'Z')
+
+
+def _m009_checkpoint_reason(cur):
+    # 'set' marks checkpoints of deliberate writes, which reconciliation
+    # starts from; the first checkpoint of each row is its opening level
+    if 'reason' not in [c[1] for c in cur.execute("PRAGMA table_info(stock_checkpoints)").fetchall()]:
+        cur.execute("ALTER TABLE stock_checkpoints ADD COLUMN reason TEXT NOT NULL DEFAULT 'snapshot'")
+    cur.execute("UPDATE stock_checkpoints SET reason = 'set' WHERE id IN (SELECT MIN(id) FROM stock_checkpoints GROUP BY kind, ref_id)")
+
+
+def _m010_archive_manifest(cur):
+    # closed months moved out to segment files (see "Archive segments")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS archive_segments (
+            month TEXT PRIMARY KEY, -- YYYY-MM
+            file TEXT NOT NULL, -- gzip-compressed SQLite file in the archive directory
+            sales INTEGER NOT NULL,
+            movements INTEGER NOT NULL,
+            min_sale_id INTEGER,
+            max_sale_id INTEGER,
+            min_movement_id INTEGER,
+            max_movement_id INTEGER,
+            bytes INTEGER NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            archived_at TEXT NOT NULL
+        )
+        """
+    )
+    # per month and stock row, so ledger sums rarely need to open a segment
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS archive_totals (
+            kind TEXT NOT NULL,
+            ref_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            movements INTEGER NOT NULL,
+            delta REAL NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            PRIMARY KEY (kind, ref_id, month)
+        )
+        """
+    )
+
+
+MIGRATIONS = (
+    (1, "base tables", _m001_base_tables),
+    (2, "sales.quantity as REAL", _m002_sales_quantity_real),
+    (3, "sales created_by/bottles/idempotency columns", _m003_sales_columns),
+    (4, "sales and movements indexes", _m004_indexes),
+    (5, "table_versions change counters", _m005_table_versions),
+    (6, "sales_daily_rollup", _m006_sales_rollup),
+    (7, "default users, products, tank and bottle stock", _m007_seed_defaults),
+    (8, "stock_checkpoints", _m008_stock_checkpoints),
+    (9, "stock_checkpoints.reason", _m009_checkpoint_reason),
+    (10, "archive_segments and archive_totals", _m010_archive_manifest),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _schema_version(conn) -> int:
+    try:
+        return conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        # no schema_version table yet
+        return 0
+
+
+def schema_version(db_path: Path | str | None = None) -> int:
+    """Highest migration applied to the database (0 for a new or pre-versioning file)."""
+    conn = connect(db_path)
+    try:
+        return _schema_version(conn)
+    finally:
+        conn.close()
+
+
+def migrate(db_path: Path | str | None = None, progress=None) -> list:
+    """Apply pending MIGRATIONS, each in its own write transaction. Returns the versions applied.
+
+    Safe to run from several processes at once: each migration re-checks the
+    version after taking the write lock. Migrations marked `online` (table
+    rewrites) manage their own short transactions and get
+    progress(name, copied, total) callbacks.
+    """
+    conn = connect(db_path)
+    applied = []
+    try:
+        current = _schema_version(conn)
+        if current > SCHEMA_VERSION:
+            raise RuntimeError(f"database schema version {current} is newer than this code ({SCHEMA_VERSION})")
+        if current == SCHEMA_VERSION:
+            return applied
+        conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TEXT NOT NULL)")
+        conn.commit()
+        for version, name, apply in MIGRATIONS:
+            if getattr(apply, 'online', False) and _schema_version(conn) < version:
+                apply(db_path, progress and (lambda copied, total, name=name: progress(name, copied, total)))
+                apply = None
+            begin_write(conn)
+            try:
+                if _schema_version(conn) >= version:
+                    conn.rollback()
+                    continue
+                if apply is not None:
+                    apply(conn.cursor())
+                conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                             (version, name, datetime.utcnow().isoformat() + 'Z'))
                 conn.commit()
-    except Exception:
-        # if anything goes wrong, ignore migration (keep running)
-        pass
-    # ensure created_by column exists (add if missing)
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(version)
+    finally:
+        conn.close()
+    if applied:
+        invalidate_schema(db_path)
+        _invalidate_catalog(db_path)
+    return applied
+
+
+def init_db(db_path: Path | str | None = None, journal_mode: str | None = None):
+    """Bring the database up to SCHEMA_VERSION and prime the in-process caches.
+
+    On an up-to-date database this is one version query. Also switches the
+    database to `journal_mode` (default JOURNAL_MODE); WAL lets readers of
+    /api/orders run alongside a writer.
+    """
+    journal_mode = (journal_mode or JOURNAL_MODE).upper()
+    if journal_mode not in ("WAL", "DELETE", "TRUNCATE", "PERSIST"):
+        raise ValueError(f"unsupported journal_mode: {journal_mode}")
+    conn = connect(db_path)
+    conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+    conn.close()
+    applied = migrate(db_path)
+    sales_schema(db_path)
+    return applied
+
+
+### Stock adjustments ###
+# Every stock change is a single guarded UPDATE: the check and the write are
+# one statement, so no other writer can slip in between a read and a write
+# (even in a deferred transaction), and the write lock is held for one
+# statement per stock row rather than a read plus a write.
+
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+_STOCK_ROWS = {'source': ('sources', 'id'), 'inventory': ('inventory', 'product_id')}
+
+
+def _change_stock(cur, kind: str, ref_id: int, delta: float, now: str, error: str = 'insufficient stock') -> float | None:
+    """Add `delta` to a source or inventory row inside the caller's transaction. Returns the new quantity.
+
+    A decrement only applies while the row holds at least that much;
+    otherwise (or when there is no row to take from) ValueError(`error`)
+    is raised and nothing changes. An increment of a missing row returns
+    None so the caller can create it.
+    """
+    table, key = _STOCK_ROWS[kind]
+    delta = float(delta)
+    sql = f"UPDATE {table} SET quantity = quantity + ?, last_updated = ? WHERE {key} = ?"
+    params = [delta, now, ref_id]
+    if delta < 0:
+        sql += " AND quantity >= ?"
+        params.append(-delta)
+    if HAS_RETURNING:
+        row = cur.execute(sql + " RETURNING quantity", params).fetchone()
+        new_q = None if row is None else float(row[0])
+    elif cur.execute(sql, params).rowcount:
+        new_q = float(cur.execute(f"SELECT quantity FROM {table} WHERE {key} = ?", (ref_id,)).fetchone()[0])
+    else:
+        new_q = None
+    if new_q is None and delta < 0:
+        raise ValueError(error)
+    return new_q
+
+
+### Stock checkpoints ###
+# A checkpoint (timestamp, movement_id, quantity) says a source or inventory
+# row held `quantity` after every movement up to `movement_id`, at
+# `timestamp`. The level at any moment is then the nearest checkpoint plus or
+# minus the few movements between the two, never the whole ledger.
+# checkpoint_stock() snapshots rows that moved since their last checkpoint
+# (run it from cron: `python -m main checkpoint`), and every path that changes
+# a counter without writing a movement (add_source, update_source,
+# set_inventory, adjust_*) records a 'set' one in its own transaction. Movements are
+# stamped when they are written, so ids and timestamps grow together; the
+# lookups bound their scans by id on that basis.
+
+# days between the historical checkpoints backfill_checkpoints() derives
+CHECKPOINT_BACKFILL_DAYS = int(os.environ.get("ERP_CHECKPOINT_BACKFILL_DAYS", 7))
+
+_LATEST_CHECKPOINT_SQL = "SELECT movement_id FROM stock_checkpoints c WHERE c.kind = ? AND c.ref_id = {ref} ORDER BY c.timestamp DESC, c.id DESC LIMIT 1"
+
+
+def _checkpoint(cur, kind: str, ref_id: int, now: str):
+    """Record the level a deliberate write left on one row, inside the caller's transaction."""
+    table, key = _STOCK_ROWS[kind]
+    cur.execute(f"INSERT INTO stock_checkpoints (kind, ref_id, timestamp, movement_id, quantity, reason) "
+                f"SELECT ?, {key}, ?, (SELECT COALESCE(MAX(id), 0) FROM movements), quantity, 'set' FROM {table} WHERE {key} = ?",
+                (kind, now, ref_id))
+
+
+def _checkpoint_changed(cur, now: str) -> int:
+    """Checkpoint every row with movements after its last checkpoint (or with none yet)."""
+    created = 0
+    for kind, (table, key) in _STOCK_ROWS.items():
+        latest = _LATEST_CHECKPOINT_SQL.format(ref=f"t.{key}")
+        cur.execute(
+            f"""
+            INSERT INTO stock_checkpoints (kind, ref_id, timestamp, movement_id, quantity)
+            SELECT ?, t.{key}, ?, (SELECT COALESCE(MAX(id), 0) FROM movements), t.quantity FROM {table} t
+            WHERE COALESCE((SELECT MAX(m.id) FROM movements m WHERE m.kind = ? AND m.ref_id = t.{key}), 0)
+                > COALESCE(({latest}), -1)
+            """,
+            (kind, now, kind, kind),
+        )
+        created += cur.rowcount
+    return created
+
+
+def checkpoint_stock(db_path: Path | str | None = None) -> int:
+    """Snapshot every source and inventory row that moved since its last checkpoint. Returns rows written."""
+    conn = connect(db_path)
     try:
-        cur.execute("PRAGMA table_info(sales)")
-        cols = [c[1] for c in cur.fetchall()]
-        if 'created_by' not in cols:
-            cur.execute("ALTER TABLE sales ADD COLUMN created_by INTEGER")
-            conn.commit()
+        begin_write(conn)
+        created = _checkpoint_changed(conn.cursor(), datetime.utcnow().isoformat() + 'Z')
+        conn.commit()
     except Exception:
-        pass
-    # ensure bottles_used column exists (track number of bottles consumed by a sale)
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return created
+
+
+def backfill_checkpoints(every_days: int | None = None, db_path: Path | str | None = None) -> int:
+    """Derive checkpoints for the history before each row's earliest one. Returns rows written.
+
+    One grouped pass per row sums its movements per day; walking back from
+    the earliest checkpoint gives the level at the end of every
+    `every_days`-th day (counted from 1970-01-01, so reruns land on the same
+    days and add nothing new). Levels before a counter was set outright
+    cannot be known from movements; these assume there was no such set.
+    """
+    every_days = every_days or CHECKPOINT_BACKFILL_DAYS
+    epoch = date(1970, 1, 1)
+    per_day_sql = ("SELECT substr(timestamp, 1, 10) AS day, TOTAL(delta), MAX(id) FROM movements "
+                   "WHERE kind = ? AND ref_id = ? AND id <= ? GROUP BY day ORDER BY day")
+    conn = connect(db_path)
     try:
-        cur.execute("PRAGMA table_info(sales)")
-        cols = [c[1] for c in cur.fetchall()]
-        if 'bottles_used' not in cols:
-            cur.execute("ALTER TABLE sales ADD COLUMN bottles_used INTEGER DEFAULT 0")
-            conn.commit()
+        begin_write(conn)
+        anchors = {(r['kind'], r['ref_id']): (r['timestamp'], r['movement_id'], r['quantity']) for r in conn.execute(
+            "SELECT kind, ref_id, timestamp, movement_id, quantity FROM stock_checkpoints c "
+            "WHERE id = (SELECT id FROM stock_checkpoints e WHERE e.kind = c.kind AND e.ref_id = c.ref_id ORDER BY e.timestamp, e.id LIMIT 1)")}
+        rows = []
+        for (kind, ref_id), (anchor_ts, anchor_id, level) in anchors.items():
+            per_day = conn.execute(per_day_sql, (kind, ref_id, anchor_id)).fetchall()
+            archived = _archived_ledger(conn, kind, ref_id, upto_id=anchor_id)
+            if archived:
+                days = {day: [moved, last] for day, moved, last in per_day}
+                for seg in archived:
+                    for day, moved, last in _segment_rows(db_path, seg, per_day_sql, (kind, ref_id, anchor_id)):
+                        total = days.setdefault(day, [0.0, last])
+                        total[0] += moved
+                        total[1] = max(total[1], last)
+                per_day = sorted((day, moved, last) for day, (moved, last) in days.items())
+            if not per_day:
+                continue
+            # the end of a day is only a checkpoint if it comes before the anchor
+            day = date.fromisoformat(anchor_ts[:10]) - timedelta(days=1)
+            first = date.fromisoformat(per_day[0][0])
+            # the level at the end of a day is the anchor minus everything after it
+            later = 0.0
+            i = len(per_day) - 1
+            while i >= 0 and per_day[i][0] > day.isoformat():
+                later += per_day[i][1]
+                i -= 1
+            while day >= first:
+                iso = day.isoformat()
+                if (day - epoch).days % every_days == 0:
+                    rows.append((kind, ref_id, iso + 'T23:59:59.999999Z', per_day[i][2], level - later))
+                if per_day[i][0] == iso:
+                    later += per_day[i][1]
+                    i -= 1
+                day -= timedelta(days=1)
+        existing = {(r[0], r[1], r[2]) for r in conn.execute("SELECT kind, ref_id, timestamp FROM stock_checkpoints")}
+        rows = [r for r in rows if r[:3] not in existing]
+        conn.executemany("INSERT INTO stock_checkpoints (kind, ref_id, timestamp, movement_id, quantity) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
     except Exception:
-        pass
-    # ensure bottle_price column exists (track price of bottles when used)
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return len(rows)
+
+
+def _as_of_timestamp(ts) -> str:
+    """A datetime, date or ISO string in the stored UTC timestamp format. A bare date means its first moment."""
+    if isinstance(ts, str):
+        try:
+            ts = datetime.fromisoformat(ts[:-1] if ts.endswith('Z') else ts)
+        except ValueError:
+            raise ValueError("timestamp must be YYYY-MM-DD or an ISO datetime")
+    elif not isinstance(ts, datetime) and isinstance(ts, date):
+        ts = datetime(ts.year, ts.month, ts.day)
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _level_as_of(cur, kind: str, ref_id: int, ts: str, db_path=None) -> float | None:
+    before = cur.execute("SELECT quantity, movement_id FROM stock_checkpoints WHERE kind = ? AND ref_id = ? AND timestamp <= ? "
+                         "ORDER BY timestamp DESC, id DESC LIMIT 1", (kind, ref_id, ts)).fetchone()
+    after = cur.execute("SELECT quantity, movement_id FROM stock_checkpoints WHERE kind = ? AND ref_id = ? AND timestamp > ? "
+                        "ORDER BY timestamp, id LIMIT 1", (kind, ref_id, ts)).fetchone()
+    if before is not None:
+        # forward from the checkpoint; the next one bounds the id range scanned
+        sql = "SELECT TOTAL(delta) FROM movements WHERE kind = ? AND ref_id = ? AND id > ? AND timestamp <= ?"
+        params = [kind, ref_id, before[1], ts]
+        if after is not None:
+            sql += " AND id <= ?"
+            params.append(after[1])
+        moved = cur.execute(sql, params).fetchone()[0]
+        moved += _archived_delta(cur, db_path, kind, ref_id, before[1], after and after[1], ts_upto=ts)[0]
+        return before[0] + moved
+    if after is None:
+        # never checkpointed: back from the live counter
+        table, key = _STOCK_ROWS[kind]
+        live = cur.execute(f"SELECT quantity FROM {table} WHERE {key} = ?", (ref_id,)).fetchone()
+        if live is None:
+            return None
+        after = (live[0], cur.execute("SELECT COALESCE(MAX(id), 0) FROM movements").fetchone()[0])
+    # back from the earliest checkpoint
+    moved = cur.execute("SELECT TOTAL(delta) FROM movements WHERE kind = ? AND ref_id = ? AND id <= ? AND timestamp > ?",
+                        (kind, ref_id, after[1], ts)).fetchone()[0]
+    moved += _archived_delta(cur, db_path, kind, ref_id, upto_id=after[1], ts_after=ts)[0]
+    return after[0] - moved
+
+
+def stock_levels(kind: str, ref_id: int, timestamps, db_path: Path | str | None = None) -> list:
+    """Levels of a source ('source', id) or bottle stock ('inventory', product id) at each timestamp.
+
+    Each level starts from the nearest checkpoint and applies only the
+    movements in between. None where the row is unknown.
+    """
+    if kind not in _STOCK_ROWS:
+        raise ValueError("kind must be 'source' or 'inventory'")
+    stamps = [_as_of_timestamp(ts) for ts in timestamps]
+    conn = connect(db_path)
     try:
-        cur.execute("PRAGMA table_info(sales)")
-        cols = [c[1] for c in cur.fetchall()]
-        if 'bottle_price' not in cols:
-            cur.execute("ALTER TABLE sales ADD COLUMN bottle_price REAL DEFAULT 0")
-            conn.commit()
-    except Exception:
-        pass
-    # --- Seed default sources and bottle stock ---
-    try:
-        now = datetime.utcnow().isoformat() + 'Z'
-        # ensure main tank (10000 L)
-        cur.execute("SELECT id FROM sources WHERE name = ?", ("Main Tank",))
-        r = cur.fetchone()
-        if r is None:
-            cur.execute("INSERT INTO sources (name, unit, quantity, last_updated) VALUES (?, ?, ?, ?)", ("Main Tank", 'L', 10000.0, now))
-            main_tank_id = cur.lastrowid
-        else:
-            main_tank_id = r[0]
-
-        # ensure water products exist (5L, 10L, 20L)
-        cur.execute("SELECT id FROM products WHERE name = ?", ("5L water",))
-        if cur.fetchone() is None:
-            cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", ("5L water", 40.0))
-        cur.execute("SELECT id FROM products WHERE name = ?", ("10L water",))
-        if cur.fetchone() is None:
-            cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", ("10L water", 70.0))
-        cur.execute("SELECT id FROM products WHERE name = ?", ("20L water",))
-        if cur.fetchone() is None:
-            cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", ("20L water", 120.0))
-
-        # ensure empty bottle product types and inventory counts
-        bottle_templates = [
-            ("Empty 5L bottle", 0.0, 120.0),
-            ("Empty 10L bottle", 0.0, 80.0),
-            ("Empty 20L bottle", 0.0, 40.0),
-        ]
-        for name, price, initial_count in bottle_templates:
-            cur.execute("SELECT id FROM products WHERE name = ?", (name,))
-            r = cur.fetchone()
-            if r is None:
-                cur.execute("INSERT INTO products (name, unit_price) VALUES (?, ?)", (name, float(price)))
-                pid = cur.lastrowid
-            else:
-                pid = r[0]
-            # upsert inventory row for bottle counts
-            cur.execute("SELECT id FROM inventory WHERE product_id = ?", (pid,))
-            inv = cur.fetchone()
-            if inv is None:
-                cur.execute("INSERT INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, ?)", (pid, float(initial_count), now))
-            else:
-                cur.execute("UPDATE inventory SET quantity = ?, last_updated = ? WHERE product_id = ?", (float(initial_count), now, pid))
-
-        # map water products to main tank with factors (litres per unit)
-        mappings = [("5L water", 5.0), ("10L water", 10.0), ("20L water", 20.0)]
-        for pname, factor in mappings:
-            cur.execute("SELECT id FROM products WHERE name = ?", (pname,))
-            r = cur.fetchone()
-            if r:
-                pid = r[0]
-                cur.execute("SELECT product_id FROM product_sources WHERE product_id = ?", (pid,))
-                if cur.fetchone() is None:
-                    cur.execute("INSERT INTO product_sources (product_id, source_id, factor) VALUES (?, ?, ?)", (pid, main_tank_id, float(factor)))
-                else:
-                    cur.execute("UPDATE product_sources SET source_id = ?, factor = ? WHERE product_id = ?", (main_tank_id, float(factor), pid))
+        cur = conn.cursor()
+        return [_level_as_of(cur, kind, int(ref_id), ts, db_path) for ts in stamps]
+    finally:
+        conn.close()
 
-        conn.commit()
+
+def stock_as_of(kind: str, ref_id: int, ts, db_path: Path | str | None = None) -> float | None:
+    """The level of a source or inventory row at `ts` (datetime, date or ISO string, UTC)."""
+    return stock_levels(kind, ref_id, [ts], db_path)[0]
+
+
+### Ledger reconciliation ###
+# sources.quantity and inventory.quantity are counters; the ledger is the
+# movements plus the checkpoints of deliberate writes (reason 'set': opening
+# levels, update_source, set_inventory, adjust_*). A counter should equal its
+# latest 'set' checkpoint plus the movements after it. Scheduled snapshots
+# copy the counter, drift included, so they are never a starting point.
+
+# differences smaller than this are float noise, not drift
+RECONCILE_TOLERANCE = 1e-6
+RECONCILE_REPAIRS = ('ledger', 'counters')
+
+_RECONCILE_SQL = """
+WITH base AS (
+    SELECT c.kind, c.ref_id, c.quantity, c.movement_id FROM stock_checkpoints c
+    WHERE c.id = (SELECT e.id FROM stock_checkpoints e WHERE e.kind = c.kind AND e.ref_id = c.ref_id AND e.reason = 'set'
+                  ORDER BY e.timestamp DESC, e.id DESC LIMIT 1)
+),
+moved AS (
+    SELECT m.kind, m.ref_id, TOTAL(m.delta) AS delta, COUNT(*) AS movements FROM movements m
+    LEFT JOIN base b ON b.kind = m.kind AND b.ref_id = m.ref_id
+    WHERE m.id > COALESCE(b.movement_id, 0)
+    GROUP BY m.kind, m.ref_id
+),
+counters AS (
+    SELECT 'source' AS kind, id AS ref_id, quantity FROM sources
+    UNION ALL
+    SELECT 'inventory', product_id, quantity FROM inventory
+),
+refs AS (
+    SELECT kind, ref_id FROM counters UNION SELECT kind, ref_id FROM moved UNION SELECT kind, ref_id FROM archive_totals
+)
+SELECT r.kind, r.ref_id, k.quantity AS actual,
+       COALESCE(b.quantity, 0) + COALESCE(mv.delta, 0) AS expected, COALESCE(mv.movements, 0) AS movements,
+       COALESCE(b.movement_id, 0) AS base_id
+FROM refs r
+LEFT JOIN counters k ON k.kind = r.kind AND k.ref_id = r.ref_id
+LEFT JOIN base b ON b.kind = r.kind AND b.ref_id = r.ref_id
+LEFT JOIN moved mv ON mv.kind = r.kind AND mv.ref_id = r.ref_id
+ORDER BY r.kind, r.ref_id
+"""
+
+
+def _reconcile(cur, db_path=None) -> tuple:
+    """(rows checked, movements applied, discrepancies) for every counter and every ref with movements."""
+    checked = applied = 0
+    found = []
+    archived = {(r[0], r[1]) for r in cur.execute("SELECT DISTINCT kind, ref_id FROM archive_totals").fetchall()}
+    for kind, ref_id, actual, expected, movements, base_id in cur.execute(_RECONCILE_SQL).fetchall():
+        if (kind, ref_id) in archived:
+            moved, n = _archived_delta(cur, db_path, kind, ref_id, after_id=base_id)
+            expected += moved
+            movements += n
+        checked += 1
+        applied += movements
+        if actual is None or abs(actual - expected) > RECONCILE_TOLERANCE:
+            found.append({'kind': kind, 'ref_id': ref_id, 'actual': actual, 'expected': round(expected, 6),
+                          'difference': None if actual is None else round(actual - expected, 6)})
+    return checked, applied, found
+
+
+def reconcile_stock(repair: str | None = None, user_id: int | None = None, db_path: Path | str | None = None) -> dict:
+    """Recompute every stock counter from the ledger and report (or repair) the ones that differ.
+
+    The expected levels come from one grouped pass over movements in SQL.
+    A discrepancy with `actual` None is a ref with movements but no counter
+    row (a deleted tank, say); it is reported but never repaired.
+
+    repair='ledger' keeps the counters (the physical count) and books a
+    'reconcile' movement for each difference; repair='counters' resets the
+    counters to the ledger. Either way a 'set' checkpoint records the result,
+    so the next run and stock_as_of start from there.
+    """
+    if repair is not None and repair not in RECONCILE_REPAIRS:
+        raise ValueError(f"repair must be one of {', '.join(RECONCILE_REPAIRS)}")
+    started = time.perf_counter()
+    conn = connect(db_path)
+    cur = conn.cursor()
+    try:
+        if repair:
+            begin_write(conn)
+        checked, applied, found = _reconcile(cur, db_path)
+        fixable = [d for d in found if d['actual'] is not None]
+        if repair and fixable:
+            now = datetime.utcnow().isoformat() + 'Z'
+            if repair == 'ledger':
+                cur.executemany("INSERT INTO movements (kind, ref_id, delta, reason, timestamp, user_id) VALUES (?, ?, ?, 'reconcile', ?, ?)",
+                                [(d['kind'], d['ref_id'], d['actual'] - d['expected'], now, user_id) for d in fixable])
+            else:
+                for kind, (table, key) in _STOCK_ROWS.items():
+                    cur.executemany(f"UPDATE {table} SET quantity = ?, last_updated = ? WHERE {key} = ?",
+                                    [(d['expected'], now, d['ref_id']) for d in fixable if d['kind'] == kind])
+            for d in fixable:
+                _checkpoint(cur, d['kind'], d['ref_id'], now)
+        if repair:
+            conn.commit()
     except Exception:
-        # non-fatal; continue
-        pass
-    conn.close()
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if repair == 'counters':
+        for d in fixable:
+            _publish_stock(d['kind'], d['ref_id'], d['expected'], None)
+    return {
+        'checked': checked,
+        'movements': applied,
+        'discrepancies': found,
+        'repaired': len(fixable) if repair else 0,
+        'repair': repair,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
 
 
 ### Sources (central tanks) helpers ###
@@ -294,6 +1448,7 @@ def add_source(name: str, unit: str = 'L', quantity: float = 0, db_path: Path |
     cur = conn.cursor()
     cur.execute("INSERT INTO sources (name, unit, quantity, last_updated) VALUES (?, ?, ?, ?)", (name, unit, float(quantity), now))
     sid = cur.lastrowid
+    _checkpoint(cur, 'source', sid, now)
     conn.commit()
     cur.execute("SELECT id, name, unit, quantity, last_updated FROM sources WHERE id = ?", (sid,))
     row = cur.fetchone()
@@ -315,15 +1470,21 @@ def update_source(source_id: int, name: str | None = None, unit: str | None = No
         parts.append('quantity = ?'); params.append(float(quantity))
     if not parts:
         conn.close(); return get_source(source_id, db_path)
-    parts.append('last_updated = ?'); params.append(datetime.utcnow().isoformat() + 'Z')
+    now = datetime.utcnow().isoformat() + 'Z'
+    parts.append('last_updated = ?'); params.append(now)
     params.append(source_id)
     sql = f"UPDATE sources SET {', '.join(parts)} WHERE id = ?"
     cur.execute(sql, tuple(params))
+    if quantity is not None:
+        _checkpoint(cur, 'source', source_id, now)
     conn.commit()
     cur.execute("SELECT id, name, unit, quantity, last_updated FROM sources WHERE id = ?", (source_id,))
     row = cur.fetchone()
     conn.close()
-    return dict(row) if row else None
+    if row is None:
+        return None
+    _publish_stock('source', source_id, row['quantity'], None, name=row['name'], unit=row['unit'])
+    return dict(row)
 
 
 def delete_source(source_id: int, db_path: Path | str | None = None) -> bool:
@@ -339,28 +1500,27 @@ def delete_source(source_id: int, db_path: Path | str | None = None) -> bool:
 def adjust_source_quantity(source_id: int, delta: float, db_path: Path | str | None = None) -> float:
     """Adjust source quantity by delta (can be negative). Returns new quantity. Raises ValueError on insufficient."""
     conn = connect(db_path)
+    begin_write(conn)
     cur = conn.cursor()
-    cur.execute("SELECT quantity FROM sources WHERE id = ?", (source_id,))
-    r = cur.fetchone()
-    if r is None:
-        if delta < 0:
-            conn.close(); raise ValueError('insufficient stock')
+    now = datetime.utcnow().isoformat() + 'Z'
+    try:
+        new_q = _change_stock(cur, 'source', source_id, delta, now)
+    except ValueError:
+        conn.close()
+        raise
+    if new_q is None:
         new_q = float(delta)
-        now = datetime.utcnow().isoformat() + 'Z'
         cur.execute("INSERT INTO sources (id, name, unit, quantity, last_updated) VALUES (?, ?, ?, ?, ?)", (source_id, 'source', 'L', new_q, now))
-        conn.commit(); conn.close(); return new_q
-    cur_q = float(r[0])
-    new_q = cur_q + float(delta)
-    if new_q < 0:
-        conn.close(); raise ValueError('insufficient stock')
-    now = datetime.utcnow().isoformat() + 'Z'
-    cur.execute("UPDATE sources SET quantity = ?, last_updated = ? WHERE id = ?", (new_q, now, source_id))
-    conn.commit(); conn.close(); return new_q
+    _checkpoint(cur, 'source', source_id, now)
+    conn.commit(); conn.close()
+    _publish_stock('source', source_id, new_q, float(delta))
+    return new_q
 
 
 ### Product -> Source mapping helpers ###
 def set_product_source(product_id: int, source_id: int, factor: float = 1.0, db_path: Path | str | None = None):
     conn = connect(db_path)
+    begin_write(conn)
     cur = conn.cursor()
     cur.execute("SELECT product_id FROM product_sources WHERE product_id = ?", (product_id,))
     if cur.fetchone() is None:
@@ -368,12 +1528,24 @@ def set_product_source(product_id: int, source_id: int, factor: float = 1.0, db_
     else:
         cur.execute("UPDATE product_sources SET source_id = ?, factor = ? WHERE product_id = ?", (source_id, float(factor), product_id))
     conn.commit()
+    _invalidate_catalog(db_path)
     cur.execute("SELECT product_id, source_id, factor FROM product_sources WHERE product_id = ?", (product_id,))
     row = cur.fetchone()
     conn.close()
     return dict(row) if row else None
 
 
+def delete_product_source(product_id: int, db_path: Path | str | None = None) -> bool:
+    conn = connect(db_path)
+    cur = conn.cursor()
+    cur.execute("DELETE FROM product_sources WHERE product_id = ?", (product_id,))
+    changed = cur.rowcount
+    conn.commit()
+    _invalidate_catalog(db_path)
+    conn.close()
+    return bool(changed)
+
+
 def get_product_source(product_id: int, db_path: Path | str | None = None):
     conn = connect(db_path)
     cur = conn.cursor()
@@ -417,6 +1589,7 @@ def set_inventory(product_id: int, quantity: float, db_path: Path | str | None =
     """Create or update inventory record for a product. Returns the inventory row."""
     now = datetime.utcnow().isoformat() + 'Z'
     conn = connect(db_path)
+    begin_write(conn)
     cur = conn.cursor()
     cur.execute("SELECT id FROM inventory WHERE product_id = ?", (product_id,))
     if cur.fetchone() is None:
@@ -427,10 +1600,12 @@ def set_inventory(product_id: int, quantity: float, db_path: Path | str | None =
         # fetch id
         cur.execute("SELECT id FROM inventory WHERE product_id = ?", (product_id,))
         iid = cur.fetchone()[0]
+    _checkpoint(cur, 'inventory', product_id, now)
     conn.commit()
     cur.execute("SELECT id, product_id, quantity, last_updated FROM inventory WHERE id = ?", (iid,))
     row = cur.fetchone()
     conn.close()
+    _publish_stock('inventory', product_id, row['quantity'], None)
     return dict(row)
 
 
@@ -449,305 +1624,544 @@ def adjust_inventory(product_id: int, delta: float, db_path: Path | str | None =
     Raises ValueError if resulting quantity would be negative.
     """
     conn = connect(db_path)
+    begin_write(conn)
     cur = conn.cursor()
-    cur.execute("SELECT quantity FROM inventory WHERE product_id = ?", (product_id,))
-    r = cur.fetchone()
-    if r is None:
-        # no inventory row; treat as zero and create if delta positive
-        if delta < 0:
-            conn.close()
-            raise ValueError("insufficient stock")
+    now = datetime.utcnow().isoformat() + 'Z'
+    try:
+        new_q = _change_stock(cur, 'inventory', product_id, delta, now)
+    except ValueError:
+        conn.close()
+        raise
+    if new_q is None:
+        # no inventory row yet: an increase creates it
         new_q = float(delta)
-        now = datetime.utcnow().isoformat() + 'Z'
         cur.execute("INSERT INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, ?)", (product_id, new_q, now))
+    _checkpoint(cur, 'inventory', product_id, now)
+    conn.commit()
+    conn.close()
+    _publish_stock('inventory', product_id, new_q, float(delta))
+    return new_q
+
+
+def authenticate_user(username: str, password: str, db_path: Path | str | None = None) -> dict | None:
+    conn = connect(db_path)
+    cur = conn.cursor()
+    cur.execute("SELECT id, username, role FROM users WHERE username = ? AND password = ?", (username, password))
+    r = cur.fetchone()
+    conn.close()
+    return dict(r) if r else None
+
+
+def list_products(db_path: Path | str | None = None):
+    # served from the catalog cache; copies so callers can't alter cached rows
+    return [dict(p) for p in get_catalog(db_path)['products'].values()]
+
+
+def record_sale(product_id: int, quantity: int = 1, db_path: Path | str | None = None) -> dict:
+    # legacy function kept: no payment method
+    return record_order(product_id=product_id, quantity=quantity, payment_method='Cash', db_path=db_path)
+
+
+def _apply_order(cur, schema: dict, product_id: int, quantity: float = 1, payment_method: str = 'Cash', order_date: str | None = None, created_by: int | None = None, use_bottle: bool = False, bottles_used: int | None = None, bottle_price: float = 0, idempotency_key: str | None = None, touched: list | None = None) -> tuple[int, bool]:
+    """Adjust stock, write movements, the sale row and its rollup inside the caller's transaction.
+
+    Returns (sale id, created). Raises ValueError for invalid orders; the caller
+    decides whether that rolls back the whole transaction or one savepoint.
+    If a sale with the same idempotency_key exists, (its id, False) is returned
+    and nothing is applied, so the caller publishes nothing for it. Stock rows changed are appended to `touched` as
+    (kind, ref_id, new_quantity, delta) for publishing after commit.
+    """
+    if touched is None:
+        touched = []
+    if idempotency_key and schema['has_idempotency_key']:
+        row = cur.execute("SELECT id FROM sales WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+        if row is not None:
+            return row[0], False
+    if quantity <= 0:
+        raise ValueError("quantity must be > 0")
+    catalog = _catalog.get(cur, schema['key'])
+    r = catalog['products'].get(product_id)
+    if r is None:
+        raise ValueError(f"product id {product_id} not found")
+    unit_price = float(r["unit_price"])
+    product_name = r["name"]
+    total = unit_price * quantity
+    
+    # Add bottle price to total if using bottle
+    if use_bottle and bottle_price > 0:
+        # Calculate number of bottles
+        bottles_count = 1
+        if bottles_used is not None:
+            bottles_count = int(bottles_used)
+        else:
+            import math
+            bottles_count = int(quantity) if float(quantity).is_integer() else math.ceil(quantity)
+        total += bottle_price * bottles_count
+
+    # determine timestamp (use provided order_date or now)
+    if order_date:
+        # Accept either a date (YYYY-MM-DD) or a full ISO datetime (YYYY-MM-DDTHH:MM[:SS])
+        try:
+            od_dt = datetime.fromisoformat(order_date)
+        except Exception:
+            try:
+                # fallback: treat as plain date and attach the current UTC time
+                d = datetime.strptime(order_date, "%Y-%m-%d").date()
+                now_utc = datetime.utcnow()
+                od_dt = datetime.combine(d, now_utc.time())
+            except Exception:
+                raise ValueError("order_date must be YYYY-MM-DD or an ISO datetime (YYYY-MM-DDTHH:MM)")
+        # ensure not in the future
+        if od_dt > datetime.utcnow():
+            raise ValueError("order_date cannot be in the future")
+        # create Z-terminated ISO timestamp for storage
+        ts = od_dt.replace(microsecond=0).isoformat() + 'Z'
+    else:
+        ts = datetime.utcnow().isoformat() + "Z"
+
+    # perform stock adjustments (source-based preferred)
+    mapping = catalog['sources'].get(product_id)
+    now_ts = datetime.utcnow().isoformat() + 'Z'
+
+    if mapping:
+        required = float(quantity) * float(mapping['factor'])
+        new_q = _change_stock(cur, 'source', mapping['source_id'], -required, now_ts, 'insufficient stock for this order')
+        touched.append(('source', mapping['source_id'], new_q, -required))
+        cur.execute("INSERT INTO movements (kind, ref_id, delta, reason, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?)", ('source', mapping['source_id'], -required, f'order:{product_id}', now_ts, created_by))
+    else:
+        # fallback to product inventory
+        new_q = _change_stock(cur, 'inventory', product_id, -float(quantity), now_ts, 'insufficient stock for this order')
+        touched.append(('inventory', product_id, new_q, -float(quantity)))
+        cur.execute("INSERT INTO movements (kind, ref_id, delta, reason, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?)", ('inventory', product_id, -float(quantity), f'order:{product_id}', now_ts, created_by))
+
+    # optional: decrement bottle inventory when requested or when `bottles_used` provided
+    bottles_to_consume = None
+    if bottles_used is not None:
+        try:
+            bottles_to_consume = int(bottles_used)
+        except Exception:
+            raise ValueError('bottles_used must be an integer')
+        if bottles_to_consume < 0:
+            raise ValueError('bottles_used cannot be negative')
+    elif use_bottle:
+        # compute bottles based on product size (existing behavior)
+        bottle_pid = _bottle_product(catalog, mapping)
+
+        if bottle_pid is not None:
+            import math
+            bottles_to_consume = int(quantity) if float(quantity).is_integer() else math.ceil(quantity)
+
+    # if we have a bottle count to consume, perform inventory decrement
+    if bottles_to_consume is not None and bottles_to_consume > 0:
+        # find bottle product id if not already determined
+        if 'bottle_pid' not in locals() or bottle_pid is None:
+            bottle_pid = _bottle_product(catalog, mapping)
+
+        if bottle_pid is not None:
+            new_bq = _change_stock(cur, 'inventory', bottle_pid, -bottles_to_consume, now_ts, 'insufficient bottle stock for this order')
+            touched.append(('inventory', bottle_pid, new_bq, -bottles_to_consume))
+            cur.execute("INSERT INTO movements (kind, ref_id, delta, reason, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?)", ('inventory', bottle_pid, -bottles_to_consume, f'order_bottle:{product_id}', now_ts, created_by))
+
+    # insert sale row (include bottles_used and bottle_price when columns exist)
+    optional_values = {
+        'created_by': created_by,
+        # persist bottles_used (0 if none)
+        'bottles_used': int(bottles_to_consume) if bottles_to_consume is not None else 0,
+        'bottle_price': bottle_price if use_bottle else 0,
+    }
+    params = [product_id, quantity, unit_price, total, payment_method, ts]
+    params.extend(optional_values[c] for c in schema['optional'])
+    if schema['has_idempotency_key']:
+        params.append(idempotency_key)
+    cur.execute(schema['insert_sql'], params)
+    sale_id = cur.lastrowid
+    cur.execute(
+        _ROLLUP_UPSERT_SQL,
+        (ts[:10], product_id, created_by or 0, payment_method or '', quantity, total, optional_values['bottles_used']),
+    )
+    return sale_id, True
+
+
+def _publish_stock(kind: str, ref_id: int, quantity: float, delta: float | None, **extra):
+    if kind == 'source':
+        events.publish('source-adjusted', dict(id=ref_id, quantity=quantity, delta=delta, **extra))
+    else:
+        events.publish('inventory-changed', dict(product_id=ref_id, quantity=quantity, delta=delta, **extra))
+
+
+def _publish_order(sale: dict, touched: list):
+    """Publish order-created and the stock changes it made; call only after commit."""
+    events.publish('order-created', {'order': sale}, owner=sale.get('created_by'))
+    for kind, ref_id, quantity, delta in touched:
+        _publish_stock(kind, ref_id, quantity, delta)
+
+
+def record_order(product_id: int, quantity: float = 1, payment_method: str = 'Cash', order_date: str | None = None, created_by: int | None = None, use_bottle: bool = False, bottles_used: int | None = None, bottle_price: float = 0, db_path: Path | str | None = None, idempotency_key: str | None = None) -> dict:
+    """Record one order atomically. With an idempotency_key, a repeat returns the stored sale untouched."""
+    if idempotency_key:
+        # fast path for replays: no write lock, no stock adjustments
+        existing = get_order_by_idempotency_key(idempotency_key, db_path)
+        if existing is not None:
+            return existing
+    if quantity <= 0:
+        raise ValueError("quantity must be > 0")
+    if GROUP_COMMIT:
+        order = dict(product_id=product_id, quantity=quantity, payment_method=payment_method, order_date=order_date, created_by=created_by,
+                     use_bottle=use_bottle, bottles_used=bottles_used, bottle_price=bottle_price, idempotency_key=idempotency_key)
+        return group_writer(db_path).submit(order).result()
+    schema = sales_schema(db_path)
+    conn = connect(db_path)
+    cur = conn.cursor()
+    # perform everything inside a transaction so adjustments + sale are atomic
+    touched = []
+    try:
+        begin_write(conn)
+        sale_id, created = _apply_order(cur, schema, product_id, quantity, payment_method, order_date, created_by, use_bottle, bottles_used, bottle_price, idempotency_key, touched)
         conn.commit()
+        # return sale including bottles_used/bottle_price/created_by when available
+        cur.execute(schema['sale_by_id_sql'], (sale_id,))
+        sale = dict(cur.fetchone())
         conn.close()
-        return new_q
-    else:
-        cur_q = float(r[0])
-        new_q = cur_q + float(delta)
-        if new_q < 0:
-            conn.close()
-            raise ValueError("insufficient stock")
-        now = datetime.utcnow().isoformat() + 'Z'
-        cur.execute("UPDATE inventory SET quantity = ?, last_updated = ? WHERE product_id = ?", (new_q, now, product_id))
-        conn.commit()
+        # a key that raced in since the fast path: the sale was announced when it was made
+        if created:
+            _publish_order(sale, touched)
+        return sale
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
         conn.close()
-        return new_q
+        raise
 
 
-def authenticate_user(username: str, password: str, db_path: Path | str | None = None) -> dict | None:
+# days an idempotency key is kept before purge_idempotency_keys clears it
+IDEMPOTENCY_RETENTION_DAYS = int(os.environ.get("ERP_IDEMPOTENCY_RETENTION_DAYS", 30))
+
+
+def get_order_by_idempotency_key(key: str, db_path: Path | str | None = None) -> dict | None:
+    """The sale stored under an idempotency key, or None."""
+    schema = sales_schema(db_path)
+    if not key or not schema['has_idempotency_key']:
+        return None
     conn = connect(db_path)
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, role FROM users WHERE username = ? AND password = ?", (username, password))
-    r = cur.fetchone()
+    row = conn.execute("SELECT id FROM sales WHERE idempotency_key = ?", (key,)).fetchone()
+    sale = None
+    if row is not None:
+        r = conn.execute(schema['sale_by_id_sql'], (row[0],)).fetchone()
+        sale = dict(r) if r else None
     conn.close()
-    return dict(r) if r else None
+    return sale
 
 
-def list_products(db_path: Path | str | None = None):
+def purge_idempotency_keys(older_than_days: int | None = None, db_path: Path | str | None = None) -> int:
+    """Clear idempotency keys on sales older than the retention window. Returns rows cleared.
+
+    The sale rows stay; only the key is dropped, which removes it from the
+    partial unique index so lookups stay cheap.
+    """
+    if older_than_days is None:
+        older_than_days = IDEMPOTENCY_RETENTION_DAYS
+    cutoff = (datetime.utcnow() - timedelta(days=older_than_days)).isoformat() + 'Z'
     conn = connect(db_path)
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, unit_price FROM products ORDER BY id")
-    rows = cur.fetchall()
+    begin_write(conn)
+    cur = conn.execute("UPDATE sales SET idempotency_key = NULL WHERE idempotency_key IS NOT NULL AND timestamp < ?", (cutoff,))
+    n = cur.rowcount
+    conn.commit()
     conn.close()
-    return [dict(r) for r in rows]
+    return n
 
 
-def record_sale(product_id: int, quantity: int = 1, db_path: Path | str | None = None) -> dict:
-    # legacy function kept: no payment method
-    return record_order(product_id=product_id, quantity=quantity, payment_method='Cash', db_path=db_path)
+# fields accepted per order by record_orders (same names as record_order's arguments)
+ORDER_FIELDS = ('product_id', 'quantity', 'payment_method', 'order_date', 'created_by', 'use_bottle', 'bottles_used', 'bottle_price', 'idempotency_key')
 
 
-def record_order(product_id: int, quantity: float = 1, payment_method: str = 'Cash', order_date: str | None = None, created_by: int | None = None, use_bottle: bool = False, bottles_used: int | None = None, bottle_price: float = 0, db_path: Path | str | None = None) -> dict:
-    if quantity <= 0:
-        raise ValueError("quantity must be > 0")
+def record_orders(orders: list, created_by: int | None = None, db_path: Path | str | None = None) -> list:
+    """Record many orders in one write transaction with a savepoint per order.
+
+    Each item is a dict of record_order arguments. A failing order (bad input,
+    insufficient stock) is rolled back on its own and the rest still commit.
+    Returns one result per input, in order: {'ok': True, 'order': {...}} or
+    {'ok': False, 'error': '...'}. `created_by` fills in items that lack one.
+    """
+    schema = sales_schema(db_path)
     conn = connect(db_path)
     cur = conn.cursor()
-    # perform everything inside a transaction so adjustments + sale are atomic
+    results = []
+    sale_ids = {}
+    created = set()
+    touched = {}
     try:
-        cur.execute("BEGIN")
-        cur.execute("SELECT unit_price, name FROM products WHERE id = ?", (product_id,))
-        r = cur.fetchone()
-        if r is None:
-            raise ValueError(f"product id {product_id} not found")
-        unit_price = float(r["unit_price"])
-        product_name = r["name"]
-        total = unit_price * quantity
-        
-        # Add bottle price to total if using bottle
-        if use_bottle and bottle_price > 0:
-            # Calculate number of bottles
-            bottles_count = 1
-            if bottles_used is not None:
-                bottles_count = int(bottles_used)
-            else:
-                import math
-                bottles_count = int(quantity) if float(quantity).is_integer() else math.ceil(quantity)
-            total += bottle_price * bottles_count
-
-        # determine timestamp (use provided order_date or now)
-        if order_date:
-            # Accept either a date (YYYY-MM-DD) or a full ISO datetime (YYYY-MM-DDTHH:MM[:SS])
-            try:
-                od_dt = datetime.fromisoformat(order_date)
-            except Exception:
-                try:
-                    # fallback: treat as plain date and attach the current UTC time
-                    d = datetime.strptime(order_date, "%Y-%m-%d").date()
-                    now_utc = datetime.utcnow()
-                    od_dt = datetime.combine(d, now_utc.time())
-                except Exception:
-                    raise ValueError("order_date must be YYYY-MM-DD or an ISO datetime (YYYY-MM-DDTHH:MM)")
-            # ensure not in the future
-            if od_dt > datetime.utcnow():
-                raise ValueError("order_date cannot be in the future")
-            # create Z-terminated ISO timestamp for storage
-            ts = od_dt.replace(microsecond=0).isoformat() + 'Z'
-        else:
-            ts = datetime.utcnow().isoformat() + "Z"
-
-        # perform stock adjustments (source-based preferred)
-        cur.execute("SELECT source_id, factor FROM product_sources WHERE product_id = ?", (product_id,))
-        m = cur.fetchone()
-        mapping = {'source_id': m[0], 'factor': float(m[1])} if m else None
-        now_ts = datetime.utcnow().isoformat() + 'Z'
-
-        if mapping:
-            required = float(quantity) * float(mapping['factor'])
-            cur.execute("SELECT quantity FROM sources WHERE id = ?", (mapping['source_id'],))
-            srow = cur.fetchone()
-            cur_q = float(srow[0]) if srow is not None else 0.0
-            new_q = cur_q - required
-            if new_q < 0:
-                raise ValueError('insufficient stock for this order')
-            cur.execute("UPDATE sources SET quantity = ?, last_updated = ? WHERE id = ?", (new_q, now_ts, mapping['source_id']))
-            cur.execute("INSERT INTO movements (kind, ref_id, delta, reason, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?)", ('source', mapping['source_id'], -required, f'order:{product_id}', now_ts, created_by))
-        else:
-            # fallback to product inventory
-            cur.execute("SELECT quantity FROM inventory WHERE product_id = ?", (product_id,))
-            irow = cur.fetchone()
-            cur_q = float(irow[0]) if irow is not None else 0.0
-            new_q = cur_q - float(quantity)
-            if new_q < 0:
-                raise ValueError('insufficient stock for this order')
-            if irow is None:
-                cur.execute("INSERT INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, ?)", (product_id, new_q, now_ts))
-            else:
-                cur.execute("UPDATE inventory SET quantity = ?, last_updated = ? WHERE product_id = ?", (new_q, now_ts, product_id))
-            cur.execute("INSERT INTO movements (kind, ref_id, delta, reason, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?)", ('inventory', product_id, -float(quantity), f'order:{product_id}', now_ts, created_by))
-
-        # optional: decrement bottle inventory when requested or when `bottles_used` provided
-        bottles_to_consume = None
-        if bottles_used is not None:
+        begin_write(conn)
+        for i, item in enumerate(orders):
             try:
-                bottles_to_consume = int(bottles_used)
-            except Exception:
-                raise ValueError('bottles_used must be an integer')
-            if bottles_to_consume < 0:
-                raise ValueError('bottles_used cannot be negative')
-        elif use_bottle:
-            # compute bottles based on product size (existing behavior)
-            bottle_pid = None
+                if not isinstance(item, dict):
+                    raise ValueError('order must be an object')
+                kwargs = {k: item[k] for k in ORDER_FIELDS if k in item}
+                if 'product_id' not in kwargs:
+                    raise ValueError('product_id required')
+                kwargs.setdefault('created_by', created_by)
+            except ValueError as ve:
+                results.append({'ok': False, 'error': str(ve)})
+                continue
+            cur.execute("SAVEPOINT batch_order")
             try:
-                if mapping:
-                    bottle_name = f"Empty {int(mapping['factor'])}L bottle"
-                    cur.execute("SELECT id FROM products WHERE name = ?", (bottle_name,))
-                    prow = cur.fetchone()
-                    if prow:
-                        bottle_pid = prow[0]
-                if bottle_pid is None:
-                    cur.execute("SELECT id FROM products WHERE name LIKE ?", ("%Empty%",))
-                    prow = cur.fetchone()
-                    if prow:
-                        bottle_pid = prow[0]
-            except Exception:
-                bottle_pid = None
-
-            if bottle_pid is not None:
-                import math
-                bottles_to_consume = int(quantity) if float(quantity).is_integer() else math.ceil(quantity)
-
-        # if we have a bottle count to consume, perform inventory decrement
-        if bottles_to_consume is not None and bottles_to_consume > 0:
-            # find bottle product id if not already determined
-            if 'bottle_pid' not in locals() or bottle_pid is None:
-                bottle_pid = None
-                try:
-                    if mapping:
-                        bottle_name = f"Empty {int(mapping['factor'])}L bottle"
-                        cur.execute("SELECT id FROM products WHERE name = ?", (bottle_name,))
-                        prow = cur.fetchone()
-                        if prow:
-                            bottle_pid = prow[0]
-                    if bottle_pid is None:
-                        cur.execute("SELECT id FROM products WHERE name LIKE ?", ("%Empty%",))
-                        prow = cur.fetchone()
-                        if prow:
-                            bottle_pid = prow[0]
-                except Exception:
-                    bottle_pid = None
-
-            if bottle_pid is not None:
-                cur.execute("SELECT quantity FROM inventory WHERE product_id = ?", (bottle_pid,))
-                brow = cur.fetchone()
-                cur_q = float(brow[0]) if brow else 0.0
-                new_bq = cur_q - bottles_to_consume
-                if new_bq < 0:
-                    raise ValueError('insufficient bottle stock for this order')
-                if brow is None:
-                    cur.execute("INSERT INTO inventory (product_id, quantity, last_updated) VALUES (?, ?, ?)", (bottle_pid, new_bq, now_ts))
-                else:
-                    cur.execute("UPDATE inventory SET quantity = ?, last_updated = ? WHERE product_id = ?", (new_bq, now_ts, bottle_pid))
-                cur.execute("INSERT INTO movements (kind, ref_id, delta, reason, timestamp, user_id) VALUES (?, ?, ?, ?, ?, ?)", ('inventory', bottle_pid, -bottles_to_consume, f'order_bottle:{product_id}', now_ts, created_by))
-
-        # insert sale row (include bottles_used and bottle_price when columns exist)
-        cols = [c[1] for c in cur.execute("PRAGMA table_info(sales)").fetchall()]
-        fields = ["product_id", "quantity", "unit_price", "total", "payment_method", "timestamp"]
-        params = [product_id, quantity, unit_price, total, payment_method, ts]
-        if 'created_by' in cols:
-            fields.append('created_by')
-            params.append(created_by)
-        # persist bottles_used (0 if none)
-        if 'bottles_used' in cols:
-            fields.append('bottles_used')
-            params.append(int(bottles_to_consume) if bottles_to_consume is not None else 0)
-        # persist bottle_price
-        if 'bottle_price' in cols:
-            fields.append('bottle_price')
-            params.append(bottle_price if use_bottle else 0)
-        placeholders = ', '.join(['?'] * len(fields))
-        sql = f"INSERT INTO sales ({', '.join(fields)}) VALUES ({placeholders})"
-        cur.execute(sql, tuple(params))
-        sale_id = cur.lastrowid
+                touched[i] = []
+                sale_ids[i], new = _apply_order(cur, schema, touched=touched[i], **kwargs)
+                if new:
+                    created.add(i)
+                cur.execute("RELEASE SAVEPOINT batch_order")
+                results.append(None)
+            except (ValueError, TypeError) as e:
+                cur.execute("ROLLBACK TO SAVEPOINT batch_order")
+                cur.execute("RELEASE SAVEPOINT batch_order")
+                results.append({'ok': False, 'error': str(e)})
         conn.commit()
-        # return sale including bottles_used/bottle_price/created_by when available
-        select_cols = ["s.id", "s.product_id", "p.name as product_name", "s.quantity", "s.unit_price", "s.total", "s.payment_method", "s.timestamp"]
-        if 'created_by' in cols:
-            select_cols.append('s.created_by')
-        if 'bottles_used' in cols:
-            select_cols.append('s.bottles_used')
-        if 'bottle_price' in cols:
-            select_cols.append('s.bottle_price')
-        sql = f"SELECT {', '.join(select_cols)} FROM sales s JOIN products p ON p.id = s.product_id WHERE s.id = ?"
-        cur.execute(sql, (sale_id,))
-        sale = dict(cur.fetchone())
+        for i, sale_id in sale_ids.items():
+            cur.execute(schema['sale_by_id_sql'], (sale_id,))
+            results[i] = {'ok': True, 'order': dict(cur.fetchone())}
         conn.close()
-        return sale
-    except Exception as e:
+        # replayed idempotency keys were announced when their sale was made
+        for i in sorted(created):
+            _publish_order(results[i]['order'], touched[i])
+        return results
+    except Exception:
         try:
             conn.rollback()
         except Exception:
             pass
         conn.close()
-
-    # --- Price history helpers ---
-    def get_price_history(product_id: int, db_path: Path | str | None = None):
-        conn = connect(db_path)
-        cur = conn.cursor()
-        cur.execute("SELECT id, product_id, old_price, new_price, changed_by, timestamp, reason FROM price_history WHERE product_id = ? ORDER BY id DESC", (product_id,))
-        rows = cur.fetchall()
-        conn.close()
-        return [dict(r) for r in rows]
-        if isinstance(e, ValueError) and 'insufficient' in str(e).lower():
-            raise
         raise
-    
 
 
-def list_sales(db_path: Path | str | None = None):
+### Group commit ###
+# ERP_GROUP_COMMIT=1 sends record_order through one writer thread per database
+GROUP_COMMIT = os.environ.get("ERP_GROUP_COMMIT", "0").lower() in ("1", "on", "true", "yes")
+# most orders committed by one transaction
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get("ERP_GROUP_COMMIT_MAX_BATCH", 64))
+# how long the first order of a batch waits for company; 0 batches only the
+# orders that queued up while the previous batch was committing
+GROUP_COMMIT_MAX_WAIT_MS = float(os.environ.get("ERP_GROUP_COMMIT_MAX_WAIT_MS", 0))
+
+
+class GroupCommitWriter:
+    """Single-writer lane: queued orders are recorded a batch per transaction.
+
+    The thread takes the first waiting order, collects whatever else arrives
+    within `max_wait` seconds (at most `max_batch` orders), and records them
+    with record_orders, so every order gets its own savepoint and one bad
+    order does not sink the others. Each caller's future gets its sale, or
+    the ValueError its order failed with; an error that aborts the whole
+    transaction is set on every future of the batch. A forked child does not
+    inherit the thread, so the first submit there starts a fresh lane.
+    """
+
+    def __init__(self, db_path: Path | str, max_batch: int = GROUP_COMMIT_MAX_BATCH, max_wait: float = GROUP_COMMIT_MAX_WAIT_MS / 1000):
+        self.db_path = db_path
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait)
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = os.getpid()
+        self.batches = 0
+        self.orders = 0
+        self.largest = 0
+
+    def submit(self, order: dict) -> Future:
+        """Queue one order (record_order keyword arguments) and return its future."""
+        future = Future()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._forked()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="erp-group-commit", daemon=True)
+                self._thread.start()
+            self._queue.put((future, order))
+        return future
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch: list):
+        batch = [(f, order) for f, order in batch if f.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            results = record_orders([order for _, order in batch], db_path=self.db_path)
+        except Exception as e:
+            for f, _ in batch:
+                f.set_exception(e)
+            return
+        self.batches += 1
+        self.orders += len(batch)
+        self.largest = max(self.largest, len(batch))
+        for (f, _), r in zip(batch, results):
+            if r['ok']:
+                f.set_result(r['order'])
+            else:
+                f.set_exception(ValueError(r['error']))
+
+    def _forked(self):
+        # the parent's thread and queued orders stayed behind in the parent
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._pid = os.getpid()
+        self.batches = self.orders = self.largest = 0
+
+    def stats(self) -> dict:
+        return {'batches': self.batches, 'orders': self.orders, 'largest': self.largest,
+                'max_batch': self.max_batch, 'max_wait_ms': self.max_wait * 1000}
+
+    def close(self):
+        """Record what is queued, then stop the thread."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._forked()
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+
+
+_writers_lock = threading.Lock()
+_writers = {}
+
+
+def group_writer(db_path: Path | str | None = None) -> GroupCommitWriter:
+    """The shared writer lane for db_path."""
+    if db_path is None:
+        db_path = get_db_path()
+    key = str(db_path)
+    with _writers_lock:
+        writer = _writers.get(key)
+        if writer is None:
+            writer = _writers[key] = GroupCommitWriter(db_path)
+        return writer
+
+
+def group_commit_stats() -> dict:
+    """Batches and orders committed by the writer lanes of this process."""
+    with _writers_lock:
+        writers = list(_writers.values())
+    return {'batches': sum(w.batches for w in writers), 'orders': sum(w.orders for w in writers)}
+
+
+def close_writers():
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+atexit.register(close_writers)
+
+
+# --- Price history helpers ---
+def get_price_history(product_id: int, db_path: Path | str | None = None):
     conn = connect(db_path)
     cur = conn.cursor()
-    # Include optional columns (bottles_used, bottle_price, created_by) if they exist in the sales table
-    cols = [c[1] for c in cur.execute("PRAGMA table_info(sales)").fetchall()]
-    select_cols = ["s.id", "s.product_id", "p.name as product_name", "s.quantity", "s.unit_price", "s.total", "s.timestamp"]
-    if 'created_by' in cols:
-        select_cols.append('s.created_by')
-    if 'bottles_used' in cols:
-        select_cols.append('s.bottles_used')
-    if 'bottle_price' in cols:
-        select_cols.append('s.bottle_price')
-    sql = f"SELECT {', '.join(select_cols)} FROM sales s JOIN products p ON p.id = s.product_id ORDER BY s.id DESC"
-    cur.execute(sql)
+    cur.execute("SELECT id, product_id, old_price, new_price, changed_by, timestamp, reason FROM price_history WHERE product_id = ? ORDER BY id DESC", (product_id,))
     rows = cur.fetchall()
     conn.close()
     return [dict(r) for r in rows]
 
 
-def list_orders(db_path: Path | str | None = None, date_iso: str | None = None, user_id: int | None = None):
+def _sales_page(db_path, schema: dict, out: tuple, date_iso: str | None, user_id: int | None, after_id: int | None, limit: int | None) -> list:
+    bounds = date_range(date_iso) if date_iso else ()
+    params = list(bounds)
+    if user_id is not None:
+        params.append(user_id)
+    if after_id is not None:
+        params.append(int(after_id))
+    if limit is not None:
+        params.append(int(limit))
     conn = connect(db_path)
-    cur = conn.cursor()
-    params = []
-    where_clauses = []
+    try:
+        segments = _archived(conn, *bounds)
+        # merging with archived rows goes by id
+        fields = out if not segments or 'id' in out else ('id',) + out
+        sql = _sales_listing_sql(schema, fields, bool(bounds), user_id is not None, after_id is not None, limit is not None)
+        rows = [dict(r) for r in conn.execute(sql, tuple(params)).fetchall()]
+    finally:
+        conn.close()
+    if segments:
+        rows = _page_archived(db_path, rows, segments, 'sale', sql, tuple(params), limit, after_id)
+        if fields is not out:
+            rows = [{f: r[f] for f in out} for r in rows]
+    return rows
+
+
+def list_sales(db_path: Path | str | None = None, after_id: int | None = None, limit: int | None = None, fields=None):
+    """Sales newest first. `after_id`/`limit` page by id (rows with id < after_id); `fields` projects columns."""
+    # Include optional columns (bottles_used, bottle_price, created_by) if they exist in the sales table
+    schema = sales_schema(db_path)
+    out = _project(schema['exprs'], schema['sale_fields'], fields)
+    return _sales_page(db_path, schema, out, None, None, after_id, limit)
+
+
+def list_orders(db_path: Path | str | None = None, date_iso: str | None = None, user_id: int | None = None, after_id: int | None = None, limit: int | None = None, fields=None):
+    """Orders newest first, optionally for one day/month and one user.
+
+    Keyset pagination: pass the last id of the previous page as `after_id`.
+    Archived months are included when the date range reaches them.
+    """
+    schema = sales_schema(db_path)
+    out = _project(schema['exprs'], schema['order_fields'], fields)
+    return _sales_page(db_path, schema, out, date_iso, user_id, after_id, limit)
+
+
+def count_orders(db_path: Path | str | None = None, date_iso: str | None = None, user_id: int | None = None) -> int:
+    """Number of orders matching the list_orders filters (ignores pagination)."""
+    bounds = date_range(date_iso) if date_iso else ()
+    where = []
+    params = list(bounds)
     if date_iso:
-        where_clauses.append("s.timestamp LIKE ?")
-        params.append(f"{date_iso}%")
+        where.append("timestamp >= ? AND timestamp < ?")
     if user_id is not None:
-        where_clauses.append("s.created_by = ?")
+        where.append("created_by = ?")
         params.append(user_id)
+    where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+    sql = f"SELECT COUNT(*) FROM sales{where_sql}"
+    conn = connect(db_path)
+    try:
+        n = conn.execute(sql, params).fetchone()[0]
+        segments = _archived(conn, *bounds)
+    finally:
+        conn.close()
+    for seg in segments:
+        # the manifest already counts a month the filters take whole
+        if user_id is None and (not bounds or (bounds[0] <= seg['month'] + '-01' and date_range(seg['month'])[1] <= bounds[1])):
+            n += seg['sales']
+        else:
+            n += _segment_rows(db_path, seg, sql, params)[0][0]
+    return n
 
-    where_sql = ("WHERE " + " AND ".join(where_clauses)) if where_clauses else ""
-    # Dynamically include optional columns when present in the sales table
-    cols = [c[1] for c in cur.execute("PRAGMA table_info(sales)").fetchall()]
-    select_cols = ["s.id", "s.product_id", "p.name as product_name", "s.quantity", "s.unit_price", "s.total", "s.payment_method", "s.timestamp"]
-    if 'created_by' in cols:
-        select_cols.append('s.created_by')
-    if 'bottles_used' in cols:
-        select_cols.append('s.bottles_used')
-    if 'bottle_price' in cols:
-        select_cols.append('s.bottle_price')
-
-    sql = f"SELECT {', '.join(select_cols)} FROM sales s JOIN products p ON p.id = s.product_id {where_sql} ORDER BY s.id DESC"
-    cur.execute(sql, tuple(params))
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
 
+MOVEMENT_FIELDS = ("id", "kind", "ref_id", "delta", "reason", "timestamp", "user_id")
 
-def list_movements(limit: int = 100, kind: str | None = None, ref_id: int | None = None, db_path: Path | str | None = None):
-    """Return recent movements (audit) optionally filtered by kind ('source'|'inventory') or ref_id."""
-    conn = connect(db_path)
-    cur = conn.cursor()
+
+def _movements_where(kind: str | None, ref_id: int | None, after_id: int | None = None):
     params = []
     where = []
     if kind:
@@ -756,13 +2170,137 @@ def list_movements(limit: int = 100, kind: str | None = None, ref_id: int | None
     if ref_id is not None:
         where.append('ref_id = ?')
         params.append(int(ref_id))
+    if after_id is not None:
+        where.append('id < ?')
+        params.append(int(after_id))
     where_sql = ('WHERE ' + ' AND '.join(where)) if where else ''
-    sql = f"SELECT id, kind, ref_id, delta, reason, timestamp, user_id FROM movements {where_sql} ORDER BY id DESC LIMIT ?"
+    return where_sql, params
+
+
+def list_movements(limit: int = 100, kind: str | None = None, ref_id: int | None = None, db_path: Path | str | None = None, after_id: int | None = None, fields=None):
+    """Return recent movements (audit) optionally filtered by kind ('source'|'inventory') or ref_id.
+
+    Pages newest first; pass the last id seen as `after_id` for the next page.
+    """
+    out = _project(MOVEMENT_FIELDS, MOVEMENT_FIELDS, fields)
+    where_sql, params = _movements_where(kind, ref_id, after_id)
     params.append(int(limit or 100))
-    cur.execute(sql, tuple(params))
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    conn = connect(db_path)
+    try:
+        segments = _archived(conn)
+        if segments and (kind or ref_id is not None):
+            # only the months the filtered rows have movements in
+            totals_where, totals_params = _movements_where(kind, ref_id)
+            months = {r[0] for r in conn.execute(f"SELECT DISTINCT month FROM archive_totals {totals_where}", totals_params)}
+            segments = [seg for seg in segments if seg['month'] in months]
+        fields = out if not segments or 'id' in out else ('id',) + out
+        sql = f"SELECT {', '.join(fields)} FROM movements {where_sql} ORDER BY id DESC LIMIT ?"
+        rows = [dict(r) for r in conn.execute(sql, tuple(params)).fetchall()]
+    finally:
+        conn.close()
+    if segments:
+        rows = _page_archived(db_path, rows, segments, 'movement', sql, tuple(params), int(limit or 100), after_id)
+        if fields is not out:
+            rows = [{f: r[f] for f in out} for r in rows]
+    return rows
+
+
+def count_movements(kind: str | None = None, ref_id: int | None = None, db_path: Path | str | None = None) -> int:
+    where_sql, params = _movements_where(kind, ref_id)
+    conn = connect(db_path)
+    try:
+        n = conn.execute(f"SELECT COUNT(*) FROM movements {where_sql}", params).fetchone()[0]
+        if _archived(conn):
+            n += conn.execute(f"SELECT COALESCE(SUM(movements), 0) FROM archive_totals {where_sql}", params).fetchone()[0]
+    finally:
+        conn.close()
+    return n
+
+
+def _export_bounds(column: str, date_from: str | None, date_to: str | None):
+    where = []
+    params = []
+    if date_from:
+        where.append(f"{column} >= ?"); params.append(date_range(date_from)[0])
+    if date_to:
+        where.append(f"{column} < ?"); params.append(date_range(date_to)[1])
+    return where, params
+
+
+def _iter_rows(sql: str, params, db_path, batch: int):
+    conn = connect(db_path)
+    try:
+        cur = conn.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            for r in rows:
+                yield dict(r)
+    finally:
+        conn.close()
+
+
+def _iter_merged(sql: str, params, db_path, batch: int, segments: list, out: tuple, fields: tuple):
+    """Rows of `sql` from the live database and from `segments`, merged by id."""
+    rows = _iter_rows(sql, params, db_path, batch)
+    if segments:
+        parts = [_iter_segment(db_path, seg, sql, params, batch) for seg in reversed(segments)]
+        rows = heapq.merge(rows, *parts, key=lambda r: r['id'])
+    if fields is not out:
+        rows = ({f: r[f] for f in out} for r in rows)
+    return rows
+
+
+def _export_segments(date_from: str | None, date_to: str | None, db_path) -> list:
+    conn = connect(db_path)
+    try:
+        return _archived(conn, date_from and date_range(date_from)[0], date_to and date_range(date_to)[1])
+    finally:
+        conn.close()
+
+
+def iter_sales(date_from: str | None = None, date_to: str | None = None, user_id: int | None = None, fields=None, db_path: Path | str | None = None, batch: int = 1000):
+    """Yield sales oldest first for inclusive days [date_from, date_to], `batch` rows at a time.
+
+    Memory use does not depend on how many rows match. Archived months in
+    the range are read from their segments.
+    """
+    schema = sales_schema(db_path)
+    out = _project(schema['exprs'], schema['order_fields'], fields)
+    where, params = _export_bounds("s.timestamp", date_from, date_to)
+    if user_id is not None:
+        where.append("s.created_by = ?"); params.append(int(user_id))
+    where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+    segments = _export_segments(date_from, date_to, db_path)
+    fields = out if not segments or 'id' in out else ('id',) + out
+    sql = f"SELECT {', '.join(schema['exprs'][f] for f in fields)} {_SALES_SELECT_FROM}{where_sql} ORDER BY s.id"
+    return _iter_merged(sql, params, db_path, batch, segments, out, fields)
+
+
+def iter_movements(date_from: str | None = None, date_to: str | None = None, kind: str | None = None, ref_id: int | None = None, fields=None, db_path: Path | str | None = None, batch: int = 1000):
+    """Yield movements oldest first for inclusive days [date_from, date_to], `batch` rows at a time."""
+    out = _project(MOVEMENT_FIELDS, MOVEMENT_FIELDS, fields)
+    where, params = _export_bounds("timestamp", date_from, date_to)
+    if kind:
+        where.append("kind = ?"); params.append(kind)
+    if ref_id is not None:
+        where.append("ref_id = ?"); params.append(int(ref_id))
+    where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+    segments = _export_segments(date_from, date_to, db_path)
+    fields = out if not segments or 'id' in out else ('id',) + out
+    sql = f"SELECT {', '.join(fields)} FROM movements{where_sql} ORDER BY id"
+    return _iter_merged(sql, params, db_path, batch, segments, out, fields)
+
+
+def export_fields(kind: str, fields=None, db_path: Path | str | None = None) -> tuple:
+    """Column order an export of 'sales' or 'movements' will produce (CSV header)."""
+    if kind == 'sales':
+        schema = sales_schema(db_path)
+        return _project(schema['exprs'], schema['order_fields'], fields)
+    if kind == 'movements':
+        return _project(MOVEMENT_FIELDS, MOVEMENT_FIELDS, fields)
+    raise ValueError("export kind must be 'sales' or 'movements'")
 
 
 def add_product(name: str, unit_price: float, db_path: Path | str | None = None) -> dict:
@@ -778,6 +2316,7 @@ def add_product(name: str, unit_price: float, db_path: Path | str | None = None)
         # ignore if price_history doesn't exist
         pass
     conn.commit()
+    _invalidate_catalog(db_path)
     cur.execute("SELECT id, name, unit_price FROM products WHERE id = ?", (pid,))
     row = cur.fetchone()
     conn.close()
@@ -786,6 +2325,7 @@ def add_product(name: str, unit_price: float, db_path: Path | str | None = None)
 
 def update_product(product_id: int, name: str, unit_price: float, db_path: Path | str | None = None) -> dict:
     conn = connect(db_path)
+    begin_write(conn)
     cur = conn.cursor()
     # record previous price for history (best-effort)
     try:
@@ -801,6 +2341,7 @@ def update_product(product_id: int, name: str, unit_price: float, db_path: Path
     except Exception:
         pass
     conn.commit()
+    _invalidate_catalog(db_path)
     cur.execute("SELECT id, name, unit_price FROM products WHERE id = ?", (product_id,))
     row = cur.fetchone()
     conn.close()
@@ -813,19 +2354,503 @@ def delete_product(product_id: int, db_path: Path | str | None = None) -> bool:
     cur.execute("DELETE FROM products WHERE id = ?", (product_id,))
     changed = cur.rowcount
     conn.commit()
+    _invalidate_catalog(db_path)
     conn.close()
     return bool(changed)
 
 
 def daily_summary(date_iso: str | None = None, db_path: Path | str | None = None) -> dict:
     """Return totals (quantity and money) for a specific UTC date (YYYY-MM-DD). If date_iso is None use today's UTC date."""
-    from datetime import datetime, timezone
-    if date_iso is None:
+    if not date_iso:
         date_iso = datetime.utcnow().date().isoformat()
+    start, end = date_range(date_iso)
     conn = connect(db_path)
     cur = conn.cursor()
-    # sum quantity and total for rows whose timestamp starts with date_iso
-    cur.execute("SELECT SUM(quantity) as qty, SUM(total) as money FROM sales WHERE timestamp LIKE ?", (f"{date_iso}%",))
+    # sum the pre-aggregated rollup rows for the day(s) covered by date_iso
+    cur.execute("SELECT SUM(quantity) as qty, SUM(total) as money FROM sales_daily_rollup WHERE day >= ? AND day < ?", (start, end))
     r = cur.fetchone()
     conn.close()
     return {"date": date_iso, "total_quantity": int(r[0] or 0), "total_money": float(r[1] or 0.0)}
+
+
+### Sales rollup ###
+_ROLLUP_UPSERT_SQL = (
+    "INSERT INTO sales_daily_rollup (day, product_id, created_by, payment_method, orders, quantity, total, bottles_used) "
+    "VALUES (?, ?, ?, ?, 1, ?, ?, ?) "
+    "ON CONFLICT(day, product_id, created_by, payment_method) DO UPDATE SET "
+    "orders = orders + 1, quantity = quantity + excluded.quantity, "
+    "total = total + excluded.total, bottles_used = bottles_used + excluded.bottles_used"
+)
+# adds a whole aggregated row (from an archive segment) to the rollup
+_ROLLUP_MERGE_SQL = (
+    "INSERT INTO sales_daily_rollup (day, product_id, created_by, payment_method, orders, quantity, total, bottles_used) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(day, product_id, created_by, payment_method) DO UPDATE SET "
+    "orders = orders + excluded.orders, quantity = quantity + excluded.quantity, "
+    "total = total + excluded.total, bottles_used = bottles_used + excluded.bottles_used"
+)
+
+# report name -> (rollup column, extra select, join)
+_REPORT_GROUPS = {
+    'day': ("r.day", "", ""),
+    'product': ("r.product_id", ", p.name as product_name", " LEFT JOIN products p ON p.id = r.product_id"),
+    'payment_method': ("r.payment_method", "", ""),
+    'user': ("r.created_by", ", u.username", " LEFT JOIN users u ON u.id = r.created_by"),
+}
+
+
+def _rebuild_rollup(conn, date_from: str | None = None, date_to: str | None = None):
+    where = []
+    params = []
+    if date_from:
+        where.append("day >= ?"); params.append(date_from)
+    if date_to:
+        where.append("day <= ?"); params.append(date_to)
+    where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+    conn.execute(f"DELETE FROM sales_daily_rollup{where_sql}", params)
+    sql, sales_params = _rollup_source(conn, date_from, date_to)
+    conn.execute("INSERT INTO sales_daily_rollup (day, product_id, created_by, payment_method, orders, quantity, total, bottles_used) " + sql, sales_params)
+
+
+def _rollup_source(conn, date_from: str | None, date_to: str | None) -> tuple:
+    """The SELECT aggregating raw sales into rollup rows for [date_from, date_to], and its params."""
+    # same bounds expressed against raw sales timestamps
+    sales_where = []
+    sales_params = []
+    if date_from:
+        sales_where.append("timestamp >= ?"); sales_params.append(date_from)
+    if date_to:
+        sales_where.append("timestamp < ?"); sales_params.append(date_range(date_to)[1])
+    sales_where_sql = (" WHERE " + " AND ".join(sales_where)) if sales_where else ""
+    bottles = "COALESCE(bottles_used, 0)" if 'bottles_used' in _sales_columns(conn) else "0"
+    sql = (f"SELECT substr(timestamp, 1, 10), product_id, COALESCE(created_by, 0), COALESCE(payment_method, ''), COUNT(*), SUM(quantity), SUM(total), SUM({bottles}) "
+           f"FROM sales{sales_where_sql} GROUP BY 1, 2, 3, 4")
+    return sql, sales_params
+
+
+def _sales_columns(conn) -> tuple:
+    return tuple(c[1] for c in conn.execute("PRAGMA table_info(sales)").fetchall())
+
+
+def rebuild_rollup(date_from: str | None = None, date_to: str | None = None, db_path: Path | str | None = None) -> int:
+    """Recompute sales_daily_rollup from raw sales for [date_from, date_to] (inclusive days; all when None).
+
+    Archived months in the range are aggregated from their segments.
+    Returns the number of rollup rows now covering that range.
+    """
+    conn = connect(db_path)
+    try:
+        begin_write(conn)
+        _rebuild_rollup(conn, date_from, date_to)
+        sql, params = _rollup_source(conn, date_from, date_to)
+        for seg in _archived(conn, date_from, date_to and date_range(date_to)[1]):
+            conn.executemany(_ROLLUP_MERGE_SQL, [tuple(r) for r in _segment_rows(db_path, seg, sql, params)])
+        conn.commit()
+        where = []
+        params = []
+        if date_from:
+            where.append("day >= ?"); params.append(date_from)
+        if date_to:
+            where.append("day <= ?"); params.append(date_to)
+        where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+        return conn.execute(f"SELECT COUNT(*) FROM sales_daily_rollup{where_sql}", params).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def sales_report(group_by: str = 'day', date_from: str | None = None, date_to: str | None = None, user_id: int | None = None, split: str | None = None, db_path: Path | str | None = None) -> list:
+    """Totals from sales_daily_rollup grouped by 'day', 'product', 'payment_method' or 'user'.
+
+    Dates are inclusive YYYY-MM-DD days; user_id restricts to one user's sales.
+    split names a second grouping, e.g. ('day', split='payment_method') gives
+    one row per day and payment method.
+    """
+    if group_by not in _REPORT_GROUPS:
+        raise ValueError(f"group_by must be one of {', '.join(_REPORT_GROUPS)}")
+    if split is not None and (split not in _REPORT_GROUPS or split == group_by):
+        raise ValueError(f"split must be one of {', '.join(g for g in _REPORT_GROUPS if g != group_by)}")
+    col, extra, join = _REPORT_GROUPS[group_by]
+    group_cols = col
+    if split is not None:
+        split_col, split_extra, split_join = _REPORT_GROUPS[split]
+        extra += f", {split_col} as {split}{split_extra}"
+        join += split_join
+        group_cols += f", {split_col}"
+    where = []
+    params = []
+    if date_from:
+        where.append("r.day >= ?"); params.append(date_range(date_from)[0])
+    if date_to:
+        where.append("r.day <= ?"); params.append(date_range(date_to)[0])
+    if user_id is not None:
+        where.append("r.created_by = ?"); params.append(int(user_id))
+    where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+    sql = (
+        f"SELECT {col} as {group_by}{extra}, SUM(r.orders) as orders, SUM(r.quantity) as quantity, "
+        f"SUM(r.total) as total, SUM(r.bottles_used) as bottles_used "
+        f"FROM sales_daily_rollup r{join}{where_sql} GROUP BY {group_cols} ORDER BY {group_cols}"
+    )
+    conn = connect(db_path)
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+### Archive segments ###
+# Closed months of sales and movements move out of the live database into one
+# read-only SQLite file per month, gzip-compressed in archive_dir(), together
+# with the products they reference (named as they were when archived). The
+# manifest stays live: archive_segments (one row per month, mirrored to
+# manifest.json next to the files) and archive_totals (per month and stock row:
+# movement count, delta sum and id range). Listings, counts, exports, rollup
+# rebuilds, stock history and reconciliation add the segments their date range
+# reaches; a segment is unpacked into cache/ on first use and opened
+# read-only from there. Rows written into an archived month afterwards
+# (backdated orders) stay live until the month is archived again, which writes
+# a new segment holding old and new rows. The newest row of each table is never
+# archived, so SQLite never hands out an archived id again.
+
+# months before the current one kept in the live database by archive_months()
+ARCHIVE_KEEP_MONTHS = int(os.environ.get("ERP_ARCHIVE_KEEP_MONTHS", 3))
+# unpacked segments kept in the cache, least recently used dropped first
+ARCHIVE_CACHE_SEGMENTS = int(os.environ.get("ERP_ARCHIVE_CACHE_SEGMENTS", 12))
+
+_MONTH_RE = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+_SEGMENT_INDEXES = (
+    "CREATE INDEX idx_sales_timestamp ON sales(timestamp)",
+    "CREATE INDEX idx_sales_created_by_timestamp ON sales(created_by, timestamp)",
+    "CREATE INDEX idx_movements_kind_ref_id ON movements(kind, ref_id, id)",
+)
+_archive_lock = threading.Lock()
+
+
+def archive_dir(db_path: Path | str | None = None) -> Path:
+    """$ERP_ARCHIVE_DIR when set, else `<name>.archive` next to the database file."""
+    if os.environ.get("ERP_ARCHIVE_DIR"):
+        return Path(os.environ["ERP_ARCHIVE_DIR"])
+    path = Path(db_path if db_path is not None else get_db_path())
+    return path.with_name(path.stem + ".archive")
+
+
+def _archived(conn, start: str | None = None, end: str | None = None) -> list:
+    """Manifest rows of the segments whose month overlaps [start, end), newest first."""
+    where = []
+    params = []
+    if start:
+        where.append("month >= ?"); params.append(start[:7])
+    if end:
+        where.append("month || '-01' < ?"); params.append(end)
+    where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+    try:
+        rows = conn.execute(f"SELECT * FROM archive_segments{where_sql} ORDER BY month DESC", params).fetchall()
+    except sqlite3.OperationalError as e:
+        # a database from before migration 10
+        if "no such table" not in str(e):
+            raise
+        return []
+    return [dict(r) for r in rows]
+
+
+def _segment_file(db_path, seg) -> Path:
+    """The unpacked copy of a segment in the cache, unpacking it if needed."""
+    directory = archive_dir(db_path)
+    cached = directory / "cache" / seg['file'][:-len(".gz")]
+    try:
+        if cached.stat().st_size == seg['raw_bytes']:
+            os.utime(cached)
+            return cached
+    except FileNotFoundError:
+        pass
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cached.with_name(f"{cached.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    with gzip.open(directory / seg['file'], 'rb') as src, open(tmp, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(tmp, cached)
+    _prune_segment_cache(cached.parent)
+    return cached
+
+
+def _prune_segment_cache(cache: Path):
+    def used(p):
+        try:
+            return p.stat().st_mtime
+        except OSError:
+            return 0.0
+    for p in sorted(cache.glob("*.sqlite"), key=used, reverse=True)[ARCHIVE_CACHE_SEGMENTS:]:
+        try:
+            p.unlink()
+        except OSError:
+            # still open (Windows) or pruned meanwhile; the next prune gets it
+            pass
+
+
+def _open_segment(db_path, seg):
+    # immutable: the file never changes, so no locks and no -wal/-shm files
+    uri = _segment_file(db_path, seg).resolve().as_uri() + "?mode=ro&immutable=1"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _segment_rows(db_path, seg, sql: str, params) -> list:
+    conn = _open_segment(db_path, seg)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def _iter_segment(db_path, seg, sql: str, params, batch: int):
+    conn = _open_segment(db_path, seg)
+    try:
+        cur = conn.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            for r in rows:
+                yield dict(r)
+    finally:
+        conn.close()
+
+
+def _page_archived(db_path, rows: list, segments: list, span: str, sql: str, params, limit: int | None, after_id: int | None) -> list:
+    """Merge the rows `sql` finds in `segments` into a newest-first page of live rows.
+
+    Segments are visited by their highest id; once the page is full of rows
+    newer than everything in the next segment, the rest are never opened.
+    """
+    lo, hi = f"min_{span}_id", f"max_{span}_id"
+    for seg in sorted((s for s in segments if s[hi] is not None), key=lambda s: s[hi], reverse=True):
+        if after_id is not None and seg[lo] >= after_id:
+            continue
+        if limit is not None and len(rows) >= limit and rows[limit - 1]['id'] > seg[hi]:
+            break
+        found = _segment_rows(db_path, seg, sql, params)
+        if found:
+            rows = sorted(rows + [dict(r) for r in found], key=lambda r: r['id'], reverse=True)[:limit]
+    return rows
+
+
+def _archived_ledger(cur, kind: str, ref_id: int, after_id: int | None = None, upto_id: int | None = None) -> list:
+    """archive_totals rows of one stock row with movements in after_id < id <= upto_id, with their segment file."""
+    try:
+        return cur.execute(
+            "SELECT t.month, t.movements, t.delta, t.min_id, t.max_id, s.file, s.raw_bytes FROM archive_totals t "
+            "JOIN archive_segments s ON s.month = t.month WHERE t.kind = ? AND t.ref_id = ? AND t.max_id > ? AND t.min_id <= ?",
+            (kind, ref_id, -1 if after_id is None else after_id, 2 ** 63 - 1 if upto_id is None else upto_id)).fetchall()
+    except sqlite3.OperationalError as e:
+        if "no such table" not in str(e):
+            raise
+        return []
+
+
+def _archived_delta(cur, db_path, kind: str, ref_id: int, after_id: int | None = None, upto_id: int | None = None,
+                    ts_after: str | None = None, ts_upto: str | None = None) -> tuple:
+    """(delta sum, count) of archived movements of one stock row with after_id < id <= upto_id
+    and ts_after < timestamp <= ts_upto; a bound of None is open.
+
+    A month wholly inside the bounds comes from archive_totals; only a month
+    the bounds cut through is opened.
+    """
+    delta, count = 0.0, 0
+    for r in _archived_ledger(cur, kind, ref_id, after_id, upto_id):
+        start, end = date_range(r['month'])
+        if (ts_upto is not None and ts_upto < start) or (ts_after is not None and ts_after >= end):
+            continue
+        if ((after_id is None or r['min_id'] > after_id) and (upto_id is None or r['max_id'] <= upto_id)
+                and (ts_after is None or ts_after < start) and (ts_upto is None or end <= ts_upto)):
+            delta += r['delta']
+            count += r['movements']
+            continue
+        where = ["kind = ?", "ref_id = ?"]
+        params = [kind, ref_id]
+        for cond, value in (("id > ?", after_id), ("id <= ?", upto_id), ("timestamp > ?", ts_after), ("timestamp <= ?", ts_upto)):
+            if value is not None:
+                where.append(cond); params.append(value)
+        moved, n = _segment_rows(db_path, r, f"SELECT TOTAL(delta), COUNT(*) FROM movements WHERE {' AND '.join(where)}", params)[0]
+        delta += moved
+        count += n
+    return delta, count
+
+
+def _build_segment(seg, db_path: str, previous: Path | None, start: str, end: str, ceilings: dict) -> dict:
+    """Fill the empty segment database `seg` with the month's live rows (and the previous segment's). Returns rows copied from live."""
+    seg.execute("ATTACH DATABASE ? AS live", (db_path,))
+    if previous is not None:
+        seg.execute("ATTACH DATABASE ? AS old", (str(previous),))
+    try:
+        for table in ('sales', 'movements'):
+            # same columns and types as the live table
+            seg.execute(seg.execute("SELECT sql FROM live.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0])
+        seg.execute("CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT, unit_price REAL)")
+        seg.execute("BEGIN")
+        if previous is not None:
+            for table in ('sales', 'movements', 'products'):
+                cols = ', '.join(c[1] for c in seg.execute(f"PRAGMA old.table_info({table})"))
+                seg.execute(f"INSERT INTO {table} ({cols}) SELECT {cols} FROM old.{table}")
+        copied = {}
+        for table in ('sales', 'movements'):
+            copied[table] = seg.execute(f"INSERT INTO {table} SELECT * FROM live.{table} WHERE timestamp >= ? AND timestamp < ? AND id < ? ORDER BY id",
+                                        (start, end, ceilings[table])).rowcount
+        seg.execute("INSERT OR REPLACE INTO products (id, name, unit_price) SELECT id, name, unit_price FROM live.products")
+        for sql in _SEGMENT_INDEXES:
+            seg.execute(sql)
+        seg.execute("COMMIT")
+    finally:
+        if seg.in_transaction:
+            seg.execute("ROLLBACK")
+        seg.execute("DETACH DATABASE live")
+        if previous is not None:
+            seg.execute("DETACH DATABASE old")
+    return copied
+
+
+def _write_manifest(db_path, directory: Path):
+    conn = connect(db_path)
+    try:
+        segments = _archived(conn)
+    finally:
+        conn.close()
+    tmp = directory / f"manifest.json.{os.getpid()}.tmp"
+    tmp.write_text(json.dumps({'database': Path(db_path).name, 'segments': segments[::-1]}, indent=2), encoding='utf-8')
+    os.replace(tmp, directory / "manifest.json")
+
+
+def archive_month(month: str, db_path: Path | str | None = None) -> dict | None:
+    """Move the live sales and movements of one closed month (YYYY-MM) into its segment.
+
+    Returns the month's manifest row, or None when no live row was left to
+    move. The rows are copied out first and deleted in one short write
+    transaction that also records the segment, so every row is always found
+    in exactly one place. Raises RuntimeError, changing nothing, if rows of
+    the month were deleted meanwhile.
+    """
+    if not isinstance(month, str) or not _MONTH_RE.match(month):
+        raise ValueError("month must be YYYY-MM")
+    start, end = date_range(month)
+    if end > datetime.utcnow().date().replace(day=1).isoformat():
+        raise ValueError("only months before the current one can be archived")
+    db_path = str(db_path if db_path is not None else get_db_path())
+    directory = archive_dir(db_path)
+    cache = directory / "cache"
+    with _archive_lock:
+        conn = connect(db_path)
+        try:
+            previous = next(iter(_archived(conn, start, end)), None)
+            ceilings = {}
+            live = 0
+            for table in ('sales', 'movements'):
+                ceilings[table] = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+                live += conn.execute(f"SELECT COUNT(*) FROM {table} WHERE timestamp >= ? AND timestamp < ? AND id < ?",
+                                     (start, end, ceilings[table])).fetchone()[0]
+        finally:
+            conn.close()
+        if not live:
+            return None
+        cache.mkdir(parents=True, exist_ok=True)
+        raw = cache / f"{month}.{os.getpid()}.building"
+        raw.unlink(missing_ok=True)
+        seg = sqlite3.connect(str(raw), isolation_level=None)
+        try:
+            copied = _build_segment(seg, db_path, previous and _segment_file(db_path, previous), start, end, ceilings)
+            stats = seg.execute("SELECT (SELECT COUNT(*) FROM sales), (SELECT MIN(id) FROM sales), (SELECT MAX(id) FROM sales), "
+                                "(SELECT COUNT(*) FROM movements), (SELECT MIN(id) FROM movements), (SELECT MAX(id) FROM movements)").fetchone()
+            totals = seg.execute("SELECT kind, ref_id, ?, COUNT(*), TOTAL(delta), MIN(id), MAX(id) FROM movements GROUP BY kind, ref_id", (month,)).fetchall()
+            seg.execute("VACUUM")
+        finally:
+            seg.close()
+
+        tmp = directory / f"{month}.{os.getpid()}.gz.tmp"
+        with open(raw, 'rb') as src, gzip.GzipFile(tmp, 'wb', compresslevel=6, mtime=0) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        digest = hashlib.sha256()
+        with open(tmp, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        name = f"{month}-{digest[:12]}.sqlite.gz"
+        os.replace(tmp, directory / name)
+        os.replace(raw, cache / name[:-len(".gz")])
+        row = {
+            'month': month, 'file': name, 'sales': stats[0], 'movements': stats[3],
+            'min_sale_id': stats[1], 'max_sale_id': stats[2], 'min_movement_id': stats[4], 'max_movement_id': stats[5],
+            'bytes': (directory / name).stat().st_size, 'raw_bytes': (cache / name[:-len(".gz")]).stat().st_size,
+            'sha256': digest, 'archived_at': datetime.utcnow().isoformat() + 'Z',
+        }
+
+        conn = connect(db_path)
+        try:
+            begin_write(conn)
+            cur = conn.cursor()
+            for table, lo, hi in (('sales', stats[1], stats[2]), ('movements', stats[4], stats[5])):
+                if not copied[table]:
+                    continue
+                # the segment's id range turns a table scan into a rowid range under the write lock
+                cur.execute(f"DELETE FROM {table} WHERE id >= ? AND id <= ? AND timestamp >= ? AND timestamp < ? AND id < ?",
+                            (lo, hi, start, end, ceilings[table]))
+                if cur.rowcount != copied[table]:
+                    raise RuntimeError(f"{table} of {month} changed while archiving; run it again")
+            cur.execute(f"INSERT OR REPLACE INTO archive_segments ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})", tuple(row.values()))
+            cur.execute("DELETE FROM archive_totals WHERE month = ?", (month,))
+            cur.executemany("INSERT INTO archive_totals (kind, ref_id, month, movements, delta, min_id, max_id) VALUES (?, ?, ?, ?, ?, ?, ?)", totals)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            if previous is None or previous['file'] != name:
+                (directory / name).unlink(missing_ok=True)
+            raise
+        finally:
+            conn.close()
+    if previous is not None and previous['file'] != name:
+        for stale in (directory / previous['file'], cache / previous['file'][:-len(".gz")]):
+            try:
+                stale.unlink(missing_ok=True)
+            except OSError:
+                pass
+    _write_manifest(db_path, directory)
+    return row
+
+
+def archive_months(keep_months: int | None = None, vacuum: bool = False, db_path: Path | str | None = None) -> list:
+    """Archive every month older than the current one and the `keep_months` before it
+    (default ARCHIVE_KEEP_MONTHS). Returns the manifest rows written.
+
+    Space freed in the live file is reused by new rows; vacuum=True also
+    shrinks the file, holding the write lock while it rewrites the database.
+    """
+    keep = ARCHIVE_KEEP_MONTHS if keep_months is None else int(keep_months)
+    if keep < 0:
+        raise ValueError("keep_months must be 0 or more")
+    today = datetime.utcnow().date()
+    year, month0 = divmod(today.year * 12 + today.month - 1 - keep, 12)
+    cutoff = date(year, month0 + 1, 1).isoformat()
+    conn = connect(db_path)
+    try:
+        firsts = [conn.execute(f"SELECT MIN(timestamp) FROM {table}").fetchone()[0] for table in ('sales', 'movements')]
+    finally:
+        conn.close()
+    firsts = [t for t in firsts if t]
+    written = []
+    month = min(firsts)[:7] if firsts else None
+    while month is not None and month + "-01" < cutoff:
+        row = archive_month(month, db_path)
+        if row is not None:
+            written.append(row)
+        month = date_range(month)[1][:7]
+    if vacuum and written:
+        conn = connect(db_path)
+        try:
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+    return written
+
+
+def list_archive(db_path: Path | str | None = None) -> list:
+    """The manifest: one row per archived month, oldest first."""
+    conn = connect(db_path)
+    try:
+        return _archived(conn)[::-1]
+    finally:
+        conn.close()
@@ -0,0 +1,266 @@
+"""In-process fan-out of change events for the `/api/events` SSE stream.
+
+db.py publishes an event after each committing write that moves stock or
+records a sale:
+
+- order-created      {'order': <sale row>}, followed by the stock events below
+- source-adjusted    {'id', 'quantity', 'delta'} (+ name/unit from update_source)
+- inventory-changed  {'product_id', 'quantity', 'delta'}
+
+`delta` is null when a quantity was set outright rather than adjusted.
+
+An event may name an owner (the user who created an order); streams opened
+for a non-admin skip events owned by someone else.
+
+Events go into one shared ring buffer with increasing ids. Subscribers do not
+get a queue each: they remember the last id they sent and wait on a single
+condition, so publishing costs the same with one idle dashboard or hundreds,
+and a reconnecting EventSource resumes from `Last-Event-ID`. A client that
+falls further behind than the buffer gets a `resync` event telling it to
+reload instead of a silent gap.
+
+The hub lives in one process. With several server workers, share() attaches
+an EventBridge: every publish is also appended to a small SQLite file next to
+the database, and a thread in each worker polls it and replays the events the
+other workers published into its own hub. Dashboards connected to any worker
+see every order and stock change, a poll interval later at most. wsgi.py
+shares the hub in each worker when there is more than one.
+
+Tuning (environment, read at import):
+- ERP_EVENTS_BUFFER     events kept for catch-up (default 1000)
+- ERP_EVENTS_HEARTBEAT  seconds between keep-alive comments (default 15)
+- ERP_EVENTS_POLL       seconds between polls of the shared file (default 0.25)
+- ERP_EVENTS_MAX_STREAMS  open /api/events streams the Flask route allows per
+  process (default 0, no limit); wsgi.py sets it below the thread count
+"""
+from collections import deque
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+BUFFER_SIZE = int(os.environ.get("ERP_EVENTS_BUFFER", 1000))
+HEARTBEAT = float(os.environ.get("ERP_EVENTS_HEARTBEAT", 15))
+POLL = float(os.environ.get("ERP_EVENTS_POLL", 0.25))
+MAX_STREAMS = int(os.environ.get("ERP_EVENTS_MAX_STREAMS", 0))
+
+log = logging.getLogger("erp.events")
+
+
+# tells EventSource how long to back off before reconnecting
+RETRY = 'retry: 3000\n\n'
+PING = ': ping\n\n'
+
+
+def resync(last_id: int) -> str:
+    return f'id: {last_id}\nevent: resync\ndata: {{}}\n\n'
+
+
+class EventHub:
+    """Ring buffer of (id, event, json data, owner) plus a condition subscribers wait on."""
+
+    def __init__(self, size: int = BUFFER_SIZE):
+        self._events = deque(maxlen=size)
+        self._cond = threading.Condition()
+        self._last_id = 0
+        self._listeners = []
+        self.subscribers = 0
+        self.bridge = None
+
+    @property
+    def last_id(self) -> int:
+        return self._last_id
+
+    def publish(self, event: str, data: dict, owner: int | None = None) -> int:
+        """Append an event, wake every waiting subscriber and pass it to the bridge. Returns its id."""
+        payload = json.dumps(data, separators=(',', ':'))
+        event_id = self._append(event, payload, owner)
+        bridge = self.bridge
+        if bridge is not None:
+            bridge.write(event, payload, owner)
+        return event_id
+
+    def _append(self, event: str, payload: str, owner: int | None) -> int:
+        with self._cond:
+            self._last_id += 1
+            self._events.append((self._last_id, event, payload, owner))
+            self._cond.notify_all()
+            event_id = self._last_id
+            listeners = tuple(self._listeners)
+        for callback in listeners:
+            callback()
+        return event_id
+
+    def add_listener(self, callback):
+        """Call `callback()` after every publish, e.g. to wake an event loop (asgi.py)."""
+        with self._cond:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._cond:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def since(self, last_id: int):
+        """Events after `last_id`, or None when some of them have already been dropped."""
+        with self._cond:
+            return self._since(last_id)
+
+    def _since(self, last_id: int):
+        if last_id >= self._last_id:
+            return []
+        if not self._events or self._events[0][0] > last_id + 1:
+            return None
+        # ids are contiguous, so the offset into the buffer is known
+        start = last_id + 1 - self._events[0][0]
+        return [self._events[i] for i in range(start, len(self._events))]
+
+    def wait(self, last_id: int, timeout: float | None = None):
+        """Block until there are events after `last_id` or `timeout` passes; same result as since()."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._last_id > last_id, timeout)
+            return self._since(last_id)
+
+    def render(self, batch, last_id: int, user_id: int | None = None):
+        """Turn a since()/wait() result into (new last_id, text/event-stream chunk)."""
+        if batch is None:
+            last_id = self._last_id
+            return last_id, resync(last_id)
+        if not batch:
+            return last_id, PING
+        chunk = ''.join(f'id: {i}\nevent: {e}\ndata: {d}\n\n' for i, e, d, owner in batch
+                        if user_id is None or owner is None or owner == user_id)
+        return batch[-1][0], chunk or PING
+
+    def start(self, last_id: int | None):
+        """Where a new stream begins: (last_id, whether the client must resync)."""
+        # an id from before a server restart cannot be resumed
+        stale = last_id is not None and last_id > self._last_id
+        if last_id is None or stale:
+            last_id = self._last_id
+        return last_id, stale
+
+    def stream(self, last_id: int | None = None, user_id: int | None = None, heartbeat: float | None = None):
+        """Yield text/event-stream chunks forever, starting after `last_id` (default: now).
+
+        With `user_id`, events owned by other users are left out.
+        """
+        heartbeat = HEARTBEAT if heartbeat is None else heartbeat
+        last_id, stale = self.start(last_id)
+        self.count_subscriber(1)
+        try:
+            yield RETRY
+            if stale:
+                yield resync(last_id)
+            while True:
+                last_id, chunk = self.render(self.wait(last_id, heartbeat), last_id, user_id)
+                yield chunk
+        finally:
+            self.count_subscriber(-1)
+
+    def count_subscriber(self, n: int):
+        with self._cond:
+            self.subscribers += n
+
+
+class EventBridge:
+    """Fans a hub's events out to the hubs of other processes through a shared SQLite file.
+
+    write() appends what this process published; a daemon thread polls for
+    rows written by other processes and appends them to the local hub, where
+    asgi listeners and SSE streams pick them up like local events. Rows are
+    transient: only the newest BUFFER_SIZE are kept, and a poller that falls
+    further behind gets a `resync` event.
+    """
+
+    def __init__(self, hub: EventHub, path, poll: float | None = None, pid: int | None = None):
+        self.hub = hub
+        self.path = str(path)
+        self.poll = POLL if poll is None else poll
+        self.pid = pid or os.getpid()
+        self._lock = threading.Lock()
+        self._conn = self._open()
+        self._conn.execute("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, pid INTEGER NOT NULL, "
+                           "event TEXT NOT NULL, data TEXT NOT NULL, owner INTEGER)")
+        self._seen = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="erp-events-bridge", daemon=True)
+        self._thread.start()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
+        # nothing here outlives a restart, so no fsync either
+        conn.execute("PRAGMA synchronous = OFF")
+        return conn
+
+    def write(self, event: str, payload: str, owner: int | None):
+        try:
+            with self._lock:
+                row_id = self._conn.execute("INSERT INTO events (pid, event, data, owner) VALUES (?, ?, ?, ?)",
+                                            (self.pid, event, payload, owner)).lastrowid
+                if row_id % 100 == 0:
+                    self._conn.execute("DELETE FROM events WHERE id <= ?", (row_id - BUFFER_SIZE,))
+        except sqlite3.Error:
+            # the write it reports on has committed; local streams still got the event
+            log.warning("event bridge write failed", exc_info=True)
+
+    def poll_once(self, conn=None) -> int:
+        """Replay rows other processes wrote since the last poll. Returns how many."""
+        rows = (conn or self._conn).execute("SELECT id, pid, event, data, owner FROM events WHERE id > ? ORDER BY id",
+                                            (self._seen,)).fetchall()
+        if rows and rows[0][0] > self._seen + 1 and self._seen:
+            # pruned before this process read them
+            self.hub._append('resync', '{}', None)
+        replayed = 0
+        for row_id, pid, event, payload, owner in rows:
+            self._seen = row_id
+            if pid != self.pid:
+                self.hub._append(event, payload, owner)
+                replayed += 1
+        return replayed
+
+    def _run(self):
+        # its own connection, so polls never wait behind write()
+        conn = self._open()
+        try:
+            while not self._stop.wait(self.poll):
+                try:
+                    self.poll_once(conn)
+                except sqlite3.Error:
+                    log.warning("event bridge poll failed", exc_info=True)
+        finally:
+            conn.close()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        with self._lock:
+            self._conn.close()
+
+
+hub = EventHub()
+
+
+def share(path, poll: float | None = None) -> EventBridge:
+    """Attach (or replace) the bridge sharing `hub` with other processes through `path`."""
+    unshare()
+    hub.bridge = EventBridge(hub, path, poll)
+    return hub.bridge
+
+
+def unshare():
+    bridge, hub.bridge = hub.bridge, None
+    # a bridge inherited across fork() has no thread here; just drop it
+    if bridge is not None and bridge.pid == os.getpid():
+        bridge.close()
+
+
+def publish(event: str, data: dict, owner: int | None = None) -> int:
+    return hub.publish(event, data, owner)
+
+
+def stats() -> dict:
+    return {'last_id': hub.last_id, 'subscribers': hub.subscribers, 'buffered': len(hub._events),
+            'shared': hub.bridge.path if hub.bridge else None}
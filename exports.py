@@ -0,0 +1,57 @@
+"""Streaming export of sales and movements as NDJSON or CSV.
+
+Both the Flask endpoints (`/api/export/<kind>`) and `python -m main export`
+use `stream_export`, which yields encoded text chunks straight from a
+`db.iter_sales`/`db.iter_movements` cursor, so memory stays flat however many
+rows are exported.
+"""
+import csv
+import io
+import json
+
+import db
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def _ndjson(rows):
+    for r in rows:
+        yield json.dumps(r, separators=(',', ':')) + '\n'
+
+
+def _csv(rows, fields):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fields)
+    for i, r in enumerate(rows, 1):
+        writer.writerow([r.get(f) for f in fields])
+        # flush in chunks rather than one write per row
+        if i % 500 == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def stream_export(kind: str, fmt: str = 'ndjson', date_from: str | None = None, date_to: str | None = None,
+                  fields=None, user_id: int | None = None, db_path=None):
+    """Return an iterator of text chunks for exporting `kind` ('sales' or 'movements').
+
+    Arguments are validated before the first chunk is produced, so a ValueError
+    surfaces to the caller instead of in the middle of a streamed response.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    cols = db.export_fields(kind, fields, db_path=db_path)
+    if date_from:
+        db.date_range(date_from)
+    if date_to:
+        db.date_range(date_to)
+    if kind == 'sales':
+        rows = db.iter_sales(date_from, date_to, user_id=user_id, fields=cols, db_path=db_path)
+    else:
+        rows = db.iter_movements(date_from, date_to, fields=cols, db_path=db_path)
+    return _ndjson(rows) if fmt == 'ndjson' else _csv(rows, cols)
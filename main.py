@@ -2,23 +2,52 @@
 
 Usage (PowerShell):
     python -m main init
+    python -m main migrate --chunk-size 5000 --pause 0.01
     python -m main sell --product-id 1 --quantity 2
     python -m main list
+    python -m main rollup --from 2024-01-01 --to 2024-12-31
+    python -m main export sales --format csv --from 2024-01-01 --output sales.csv
+    python -m main purge-keys --days 30
+    python -m main checkpoint --backfill --every 7
+    python -m main reconcile --repair ledger
+    python -m main archive --keep-months 3
+    python -m main serve --workers 4 --threads 8
+    python -m main reload
 """
 import argparse
 from pathlib import Path
 import json
-from db import init_db, list_products, record_sale, list_sales, get_db_path
+import sys
+import db
+import exports
+from db import init_db, list_products, record_sale, list_sales, get_db_path, close_pool, rebuild_rollup, purge_idempotency_keys
 
 
 def cmd_init(args):
-    init_db()
+    applied = init_db()
     print(f"Initialized database at {get_db_path()}")
+    if applied:
+        print(f"Applied migrations: {', '.join(map(str, applied))}")
+    else:
+        print("Schema already up to date")
     print("Default products:")
     for p in list_products():
         print(f"  {p['id']}: {p['name']} — {p['unit_price']} KSH")
 
 
+def cmd_migrate(args):
+    if args.chunk_size:
+        db.REWRITE_CHUNK = args.chunk_size
+    if args.pause is not None:
+        db.REWRITE_PAUSE = args.pause
+
+    def progress(name, copied, total):
+        print(f"  {name}: {copied}/{total} rows copied", flush=True)
+
+    applied = db.migrate(progress=progress)
+    print(f"Applied migrations: {', '.join(map(str, applied))}" if applied else "Schema already up to date")
+
+
 def cmd_sell(args):
     sale = record_sale(args.product_id, args.quantity)
     print("Recorded sale:")
@@ -34,6 +63,83 @@ def cmd_list(args):
         print(f"[{s['id']}] {s['timestamp']} — {s['product_name']} x{s['quantity']} @ {s['unit_price']} => {s['total']} KSH")
 
 
+def cmd_rollup(args):
+    rows = rebuild_rollup(date_from=args.date_from, date_to=args.date_to)
+    span = f"{args.date_from or 'start'} .. {args.date_to or 'today'}"
+    print(f"Rebuilt sales rollup for {span}: {rows} rows")
+
+
+def cmd_export(args):
+    chunks = exports.stream_export(args.kind, args.format, date_from=args.date_from, date_to=args.date_to)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8", newline="") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        print(f"Exported {args.kind} to {args.output}")
+    else:
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+
+
+def cmd_purge_keys(args):
+    n = purge_idempotency_keys(older_than_days=args.days)
+    print(f"Cleared {n} idempotency keys")
+
+
+def cmd_checkpoint(args):
+    n = db.checkpoint_stock()
+    print(f"Wrote {n} stock checkpoints")
+    if args.backfill:
+        n = db.backfill_checkpoints(every_days=args.every)
+        print(f"Backfilled {n} historical checkpoints")
+
+
+def cmd_reconcile(args):
+    report = db.reconcile_stock(repair=args.repair)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"Checked {report['checked']} stock rows against {report['movements']} movements in {report['seconds']}s")
+    for d in report['discrepancies']:
+        actual = 'no row' if d['actual'] is None else f"{d['actual']:g}"
+        print(f"  {d['kind']} {d['ref_id']}: counter {actual}, ledger {d['expected']:g}")
+    if args.repair:
+        print(f"Repaired {report['repaired']} ({args.repair})")
+    elif report['discrepancies']:
+        print("Run with --repair ledger (keep the counters) or --repair counters (trust the ledger) to fix")
+
+
+def cmd_archive(args):
+    if args.list:
+        segments = db.list_archive()
+    elif args.month:
+        segments = [r for r in [db.archive_month(args.month)] if r]
+    else:
+        segments = db.archive_months(keep_months=args.keep_months, vacuum=args.vacuum)
+    if args.json:
+        print(json.dumps(segments, indent=2))
+        return
+    if not args.list:
+        print(f"Archived {len(segments)} month(s) to {db.archive_dir()}")
+    for r in segments:
+        print(f"  {r['month']}: {r['sales']} sales, {r['movements']} movements, {r['bytes'] / 1024:.0f} KiB ({r['file']})")
+
+
+def cmd_serve(args):
+    try:
+        import wsgi
+        import gunicorn  # noqa: F401
+    except ImportError:
+        sys.exit("serve needs gunicorn (Linux/macOS); on Windows run: python asgi.py")
+    wsgi.serve(bind=args.bind, workers=args.workers, threads=args.threads, max_requests=args.max_requests)
+
+
+def cmd_reload(args):
+    import wsgi
+    pid = wsgi.reload()
+    print(f"Sent graceful reload to server {pid}")
+
+
 def main():
     parser = argparse.ArgumentParser(prog="erp", description="Minimal ERP CLI (sales recording)")
     sub = parser.add_subparsers(dest="cmd")
@@ -41,6 +147,11 @@ def main():
     p_init = sub.add_parser("init", help="Initialize database and default products")
     p_init.set_defaults(func=cmd_init)
 
+    p_migrate = sub.add_parser("migrate", help="Apply pending schema migrations, showing table rewrite progress")
+    p_migrate.add_argument("--chunk-size", type=int, help="Rows per rewrite transaction (default ERP_REWRITE_CHUNK or 5000)")
+    p_migrate.add_argument("--pause", type=float, help="Seconds between rewrite chunks (default ERP_REWRITE_PAUSE or 0.01)")
+    p_migrate.set_defaults(func=cmd_migrate)
+
     p_sell = sub.add_parser("sell", help="Record a sale")
     p_sell.add_argument("--product-id", type=int, required=True, help="Product ID to sell")
     p_sell.add_argument("--quantity", type=int, default=1, help="Quantity (integer)")
@@ -49,6 +160,51 @@ def main():
     p_list = sub.add_parser("list", help="List sales")
     p_list.set_defaults(func=cmd_list)
 
+    p_rollup = sub.add_parser("rollup", help="Rebuild/backfill the daily sales rollup from raw sales")
+    p_rollup.add_argument("--from", dest="date_from", help="First day to rebuild (YYYY-MM-DD)")
+    p_rollup.add_argument("--to", dest="date_to", help="Last day to rebuild (YYYY-MM-DD)")
+    p_rollup.set_defaults(func=cmd_rollup)
+
+    p_export = sub.add_parser("export", help="Stream sales or movements as NDJSON/CSV")
+    p_export.add_argument("kind", choices=["sales", "movements"])
+    p_export.add_argument("--format", choices=sorted(exports.FORMATS), default="ndjson")
+    p_export.add_argument("--from", dest="date_from", help="First day (YYYY-MM-DD, inclusive)")
+    p_export.add_argument("--to", dest="date_to", help="Last day (YYYY-MM-DD, inclusive)")
+    p_export.add_argument("--output", help="Write to this file instead of stdout")
+    p_export.set_defaults(func=cmd_export)
+
+    p_purge = sub.add_parser("purge-keys", help="Clear order idempotency keys past their retention window")
+    p_purge.add_argument("--days", type=int, default=None, help="Keep keys this many days (default ERP_IDEMPOTENCY_RETENTION_DAYS or 30)")
+    p_purge.set_defaults(func=cmd_purge_keys)
+
+    p_checkpoint = sub.add_parser("checkpoint", help="Snapshot stock levels that moved since their last checkpoint (run periodically)")
+    p_checkpoint.add_argument("--backfill", action="store_true", help="Also derive checkpoints for the history before the first one")
+    p_checkpoint.add_argument("--every", type=int, default=None, help="Days between backfilled checkpoints (default ERP_CHECKPOINT_BACKFILL_DAYS or 7)")
+    p_checkpoint.set_defaults(func=cmd_checkpoint)
+
+    p_reconcile = sub.add_parser("reconcile", help="Recompute stock counters from the movement ledger and report differences")
+    p_reconcile.add_argument("--repair", choices=db.RECONCILE_REPAIRS, help="ledger: book the differences as movements; counters: reset counters to the ledger")
+    p_reconcile.add_argument("--json", action="store_true", help="Print the report as JSON")
+    p_reconcile.set_defaults(func=cmd_reconcile)
+
+    p_archive = sub.add_parser("archive", help="Move closed months of sales and movements into compressed segment files")
+    p_archive.add_argument("--keep-months", type=int, default=None, help="Months before the current one to keep live (default ERP_ARCHIVE_KEEP_MONTHS or 3)")
+    p_archive.add_argument("--month", help="Archive this one closed month (YYYY-MM) instead")
+    p_archive.add_argument("--vacuum", action="store_true", help="Shrink the database file afterwards (blocks writers while it runs)")
+    p_archive.add_argument("--list", action="store_true", help="Only show the archived months")
+    p_archive.add_argument("--json", action="store_true", help="Print the manifest rows as JSON")
+    p_archive.set_defaults(func=cmd_archive)
+
+    p_serve = sub.add_parser("serve", help="Run the production server (gunicorn, app preloaded)")
+    p_serve.add_argument("--bind", help="host:port (default 0.0.0.0:$PORT)")
+    p_serve.add_argument("--workers", type=int, help="Worker processes (default from CPU count)")
+    p_serve.add_argument("--threads", type=int, help="Threads per worker (default 4)")
+    p_serve.add_argument("--max-requests", type=int, help="Requests before a worker is recycled (default 2000)")
+    p_serve.set_defaults(func=cmd_serve)
+
+    p_reload = sub.add_parser("reload", help="Gracefully restart the workers of a running `serve`")
+    p_reload.set_defaults(func=cmd_reload)
+
     args = parser.parse_args()
     if not hasattr(args, "func"):
         parser.print_help()
@@ -57,6 +213,8 @@ def main():
         args.func(args)
     except Exception as e:
         print(f"Error: {e}")
+    finally:
+        close_pool()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,182 @@
+"""In-process request and SQL metrics, exposed in Prometheus text format at `/api/metrics`.
+
+What is measured:
+- every Flask request: latency histogram and count per (method, route
+  rule, status), where the route is the URL rule (`/api/products/<int:product_id>`)
+  so ids do not explode the label set
+- per request, how many SQL statements ran and how long they took, as
+  histograms per route (statements run by db.py's timed cursor)
+- all SQL statements, inside requests or not, and the slow ones
+- connections opened by the db.py pool, and its idle/in-use counts
+
+Statements slower than ERP_SLOW_QUERY_MS (default 100) are logged as
+warnings on the `erp.sql` logger. The cost per statement is two clock reads
+and a few additions; per request, a context variable and one locked update.
+ERP_METRICS=0 turns the timed cursor and the request hooks off.
+
+The numbers are per process: with several gunicorn workers each scrape sees
+the worker that answered it.
+"""
+from bisect import bisect_left
+import contextvars
+import logging
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("ERP_METRICS", "1").lower() not in ("0", "off", "false", "no")
+SLOW_QUERY_MS = float(os.environ.get("ERP_SLOW_QUERY_MS", 100))
+# optional bearer token that lets a scraper read /api/metrics without a session
+TOKEN = os.environ.get("ERP_METRICS_TOKEN") or None
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+log = logging.getLogger("erp.sql")
+
+
+class Histogram:
+    """Bucket counts plus sum and count for one label set. Callers hold the registry lock."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestStats:
+    """SQL work done while serving one request."""
+
+    __slots__ = ('started', 'statements', 'sql_seconds')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+
+_current = contextvars.ContextVar("erp_request_stats", default=None)
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latency = {}
+            self.requests = {}
+            self.request_statements = {}
+            self.request_sql = {}
+            self.statements = 0
+            self.sql_seconds = 0.0
+            self.slow = 0
+
+    def observe_sql(self, sql: str, seconds: float, statement: bool = True):
+        """Record one execute (or the fetch that finished it) taking `seconds`."""
+        stats = _current.get()
+        if stats is not None:
+            stats.statements += statement
+            stats.sql_seconds += seconds
+        with self._lock:
+            self.statements += statement
+            self.sql_seconds += seconds
+            if seconds * 1000 >= SLOW_QUERY_MS:
+                self.slow += 1
+        if seconds * 1000 >= SLOW_QUERY_MS:
+            log.warning("slow query (%.1f ms): %s", seconds * 1000, " ".join(sql.split()))
+
+    def observe_request(self, method: str, route: str, status: int, stats: RequestStats):
+        elapsed = time.perf_counter() - stats.started
+        with self._lock:
+            key = (method, route)
+            if key not in self.latency:
+                self.latency[key] = Histogram(LATENCY_BUCKETS)
+                self.request_statements[key] = Histogram(STATEMENT_BUCKETS)
+                self.request_sql[key] = Histogram(LATENCY_BUCKETS)
+            self.latency[key].observe(elapsed)
+            self.request_statements[key].observe(stats.statements)
+            self.request_sql[key].observe(stats.sql_seconds)
+            counted = key + (str(status),)
+            self.requests[counted] = self.requests.get(counted, 0) + 1
+        return elapsed
+
+    def render(self, pool: dict | None = None, extra: dict | None = None) -> str:
+        """The Prometheus text exposition of everything recorded so far."""
+        out = []
+        with self._lock:
+            _histograms(out, "erp_http_request_duration_seconds", "Request latency by route.", self.latency)
+            out.append("# HELP erp_http_requests_total Requests by route and status.")
+            out.append("# TYPE erp_http_requests_total counter")
+            for (method, route, status), n in sorted(self.requests.items()):
+                out.append(f'erp_http_requests_total{{method="{method}",route="{_escape(route)}",status="{status}"}} {n}')
+            _histograms(out, "erp_request_sql_statements", "SQL statements run per request.", self.request_statements)
+            _histograms(out, "erp_request_sql_seconds", "Time spent in SQL per request.", self.request_sql)
+            _scalar(out, "erp_sql_statements_total", "counter", "SQL statements executed.", self.statements)
+            _scalar(out, "erp_sql_seconds_total", "counter", "Time spent executing and fetching SQL.", round(self.sql_seconds, 6))
+            _scalar(out, "erp_sql_slow_total", "counter", f"SQL calls slower than {SLOW_QUERY_MS:g} ms.", self.slow)
+        if pool is not None:
+            _scalar(out, "erp_db_connections_opened_total", "counter", "SQLite connections opened by the pool.", pool['misses'])
+            _scalar(out, "erp_db_connections_reused_total", "counter", "Pooled connections handed out again.", pool['hits'])
+            _scalar(out, "erp_db_connections_in_use", "gauge", "Pooled connections checked out.", pool['in_use'])
+            _scalar(out, "erp_db_connections_idle", "gauge", "Pooled connections waiting for reuse.", pool['idle'])
+        for name, (kind, help_text, value) in (extra or {}).items():
+            _scalar(out, name, kind, help_text, value)
+        return "\n".join(out) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _scalar(out, name, kind, help_text, value):
+    out.append(f"# HELP {name} {help_text}")
+    out.append(f"# TYPE {name} {kind}")
+    out.append(f"{name} {value}")
+
+
+def _histograms(out, name, help_text, series):
+    out.append(f"# HELP {name} {help_text}")
+    out.append(f"# TYPE {name} histogram")
+    for (method, route), h in sorted(series.items()):
+        labels = f'method="{method}",route="{_escape(route)}"'
+        running = 0
+        for bound, n in zip(h.buckets, h.counts):
+            running += n
+            out.append(f'{name}_bucket{{{labels},le="{bound:g}"}} {running}')
+        out.append(f'{name}_bucket{{{labels},le="+Inf"}} {h.count}')
+        out.append(f"{name}_sum{{{labels}}} {round(h.sum, 6)}")
+        out.append(f"{name}_count{{{labels}}} {h.count}")
+
+
+registry = Registry()
+
+
+def start_request() -> RequestStats:
+    """Begin collecting SQL work for the request running in this context."""
+    stats = RequestStats()
+    _current.set(stats)
+    return stats
+
+
+def finish_request(method: str, route: str, status: int) -> RequestStats | None:
+    """Record the request started in this context; returns its stats (None if none was started)."""
+    stats = _current.get()
+    if stats is None:
+        return None
+    _current.set(None)
+    registry.observe_request(method, route, status, stats)
+    return stats
+
+
+def observe_sql(sql: str, seconds: float, statement: bool = True):
+    registry.observe_sql(sql, seconds, statement)
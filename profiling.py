@@ -0,0 +1,171 @@
+"""On-demand request profiling into collapsed stacks (flamegraph input).
+
+A request is profiled when
+- an admin sends it with `X-Profile: 1` (or `true`, `yes`, `on`), or
+- it is picked by sampling: an admin sets a rate (0..1), optionally for one
+  route rule, with `PUT /api/profiles/sampling`; ERP_PROFILE_SAMPLE sets the
+  rate at startup (default 0)
+
+The profiler is a sys.setprofile hook on the request's thread that records
+time per call stack (cProfile keeps callers but not whole stacks). Each
+profile is written as `<id>.collapsed`, one `frame;frame;frame microseconds`
+line per stack, ready for flamegraph.pl or speedscope, next to `<id>.json`
+with the route, status and timing. Only the newest ERP_PROFILE_KEEP
+profiles (default 50) are kept in ERP_PROFILE_DIR (default data/profiles).
+
+When nothing asks for a profile, each request costs a header lookup and
+a comparison; the hook is installed only for the profiled request. The
+profiler itself slows a request several times over, so the recorded
+durations are only comparable with each other.
+"""
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+import random
+import re
+import sys
+import threading
+import time
+
+PROFILE_DIR = Path(os.environ.get("ERP_PROFILE_DIR", Path(__file__).parent / "data" / "profiles"))
+KEEP = int(os.environ.get("ERP_PROFILE_KEEP", 50))
+HEADER = 'X-Profile'
+# header values that ask for a profile; anything else, `0` included, does not
+HEADER_ON = ('1', 'true', 'yes', 'on')
+
+_ID_RE = re.compile(r'^[0-9TZ]+-\d+$')
+_ROOT = str(Path(__file__).resolve().parent)
+
+
+class Sampling:
+    """The runtime sampling switch: a rate and an optional route rule."""
+
+    def __init__(self, rate: float = 0.0, route: str | None = None):
+        self.set(rate, route)
+
+    def set(self, rate: float, route: str | None = None):
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError('rate must be between 0 and 1')
+        self.rate, self.route = rate, route or None
+
+    def pick(self, route: str | None) -> bool:
+        return self.rate > 0 and (self.route is None or self.route == route) and random.random() < self.rate
+
+    def as_dict(self) -> dict:
+        return {'rate': self.rate, 'route': self.route}
+
+
+def _label(code) -> str:
+    filename = code.co_filename
+    if filename.startswith(_ROOT):
+        filename = filename[len(_ROOT) + 1:]
+    else:
+        filename = '/'.join(Path(filename).parts[-2:])
+    return f"{code.co_qualname if hasattr(code, 'co_qualname') else code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def _c_label(fn) -> str:
+    module = getattr(fn, '__module__', None) or 'builtins'
+    return f"{module}.{getattr(fn, '__qualname__', repr(fn))}"
+
+
+class StackProfiler:
+    """Self time per call stack for the calling thread, between start() and stop()."""
+
+    def __init__(self):
+        # [path, started, time spent in children]
+        self._stack = []
+        self.totals = {}
+        self.started = None
+        self.elapsed = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        sys.setprofile(self._hook)
+
+    def stop(self):
+        sys.setprofile(None)
+        now = time.perf_counter()
+        while self._stack:
+            self._pop(now)
+        self.elapsed = now - self.started
+
+    def _hook(self, frame, event, arg):
+        now = time.perf_counter()
+        if event == 'call' or event == 'c_call':
+            label = _label(frame.f_code) if event == 'call' else _c_label(arg)
+            parent = self._stack[-1][0] + ';' if self._stack else ''
+            self._stack.append([parent + label.replace(';', ','), now, 0.0])
+        elif self._stack:
+            # return, c_return, c_exception
+            self._pop(now)
+
+    def _pop(self, now: float):
+        path, started, children = self._stack.pop()
+        spent = now - started
+        self.totals[path] = self.totals.get(path, 0.0) + spent - children
+        if self._stack:
+            self._stack[-1][2] += spent
+
+    def collapsed(self) -> str:
+        lines = (f"{path} {round(seconds * 1_000_000)}" for path, seconds in sorted(self.totals.items()))
+        return "\n".join(line for line in lines if not line.endswith(' 0')) + "\n"
+
+
+class ProfileStore:
+    """Newest `keep` profiles as files in `directory`."""
+
+    def __init__(self, directory: Path = PROFILE_DIR, keep: int = KEEP):
+        self.directory = Path(directory)
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    def save(self, profiler: StackProfiler, meta: dict) -> str:
+        with self._lock:
+            self._seq += 1
+            profile_id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')}-{self._seq}"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        meta = dict(meta, id=profile_id, captured_at=datetime.utcnow().isoformat() + 'Z',
+                    duration_ms=round(profiler.elapsed * 1000, 3), stacks=len(profiler.totals))
+        (self.directory / f"{profile_id}.collapsed").write_text(profiler.collapsed(), encoding='utf-8')
+        (self.directory / f"{profile_id}.json").write_text(json.dumps(meta), encoding='utf-8')
+        self._prune()
+        return profile_id
+
+    def _ids(self) -> list:
+        if not self.directory.exists():
+            return []
+        # ids sort by capture time
+        return sorted((p.stem for p in self.directory.glob("*.json") if _ID_RE.match(p.stem)), reverse=True)
+
+    def _prune(self):
+        with self._lock:
+            for profile_id in self._ids()[self.keep:]:
+                for suffix in ('.json', '.collapsed'):
+                    (self.directory / f"{profile_id}{suffix}").unlink(missing_ok=True)
+
+    def list(self) -> list:
+        """Metadata of the stored profiles, newest first."""
+        out = []
+        for profile_id in self._ids():
+            try:
+                out.append(json.loads((self.directory / f"{profile_id}.json").read_text(encoding='utf-8')))
+            except (OSError, ValueError):
+                # pruned by another worker meanwhile
+                continue
+        return out
+
+    def collapsed(self, profile_id: str) -> str | None:
+        if not _ID_RE.match(profile_id):
+            return None
+        try:
+            return (self.directory / f"{profile_id}.collapsed").read_text(encoding='utf-8')
+        except OSError:
+            return None
+
+
+sampling = Sampling(float(os.environ.get("ERP_PROFILE_SAMPLE", 0)))
+store = ProfileStore()
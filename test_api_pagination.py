@@ -0,0 +1,42 @@
+"""Keyset pagination and projection on /api/orders and /api/movements — run with pytest."""
+import pytest
+
+import db
+
+
+@pytest.fixture(autouse=True)
+def _orders(db_path):
+    pid = next(p["id"] for p in db.list_products(db_path) if p["name"] == "5L water")
+    for _ in range(7):
+        db.record_order(product_id=pid, quantity=1, created_by=1, db_path=db_path)
+
+
+def test_orders_pages_with_total_and_cursor(client):
+    seen = []
+    url = "/api/orders?limit=3&fields=id,total"
+    while True:
+        r = client.get(url)
+        assert r.status_code == 200
+        assert r.headers["X-Total-Count"] == "7"
+        page = r.get_json()
+        assert all(set(o) == {"id", "total"} for o in page)
+        seen.extend(o["id"] for o in page)
+        nxt = r.headers.get("X-Next-After-Id")
+        if not nxt:
+            break
+        url = f"/api/orders?limit=3&fields=id,total&after_id={nxt}"
+    assert seen == sorted(seen, reverse=True) and len(set(seen)) == 7
+
+
+def test_bad_projection_is_rejected(client):
+    assert client.get("/api/orders?fields=id,password").status_code == 400
+    assert client.get("/api/movements?fields=nope").status_code == 400
+
+
+def test_movements_pagination(client):
+    r = client.get("/api/movements?limit=4&kind=source")
+    assert r.headers["X-Total-Count"] == "7"
+    first = r.get_json()
+    r2 = client.get(f"/api/movements?limit=4&kind=source&after_id={r.headers['X-Next-After-Id']}")
+    assert len(first) == 4 and len(r2.get_json()) == 3
+    assert "X-Next-After-Id" not in r2.headers
@@ -0,0 +1,102 @@
+"""Archiving closed months into compressed segments — run with pytest."""
+import json
+import shutil
+
+import pytest
+
+import db
+from bench import fixtures
+
+
+def _build(path):
+    # about four months of history, so the older closed months get archived
+    fixtures.build(path, days=120, sales_per_day=30, products=4, sources=2, users=3)
+
+
+def _views(path) -> dict:
+    newest = db.list_orders(path, limit=1)[0]["id"]
+    old_month = db.list_orders(path, after_id=newest - 2500, limit=1)[0]["timestamp"][:7]
+    return {
+        "page": db.list_orders(path, limit=25),
+        "deep_page": db.list_orders(path, after_id=newest - 3000, limit=25, fields=["total", "product_name"]),
+        "month": db.list_orders(path, date_iso=old_month, user_id=2),
+        "counts": (db.count_orders(path), db.count_orders(path, date_iso=old_month), db.count_orders(path, user_id=1)),
+        "sales": db.list_sales(path, after_id=100, limit=10),
+        "movements": db.list_movements(50, db_path=path, after_id=200),
+        "tank_movements": db.list_movements(50, kind="source", ref_id=1, db_path=path, after_id=300),
+        "movement_counts": (db.count_movements(db_path=path), db.count_movements("source", 1, db_path=path)),
+        "export_sales": list(db.iter_sales(db_path=path, fields=["quantity", "timestamp"], batch=100)),
+        "export_movements": list(db.iter_movements(db_path=path, kind="source")),
+        "report": db.sales_report("product", db_path=path),
+    }
+
+
+def test_archived_months_read_like_live_ones(tmp_path):
+    path = tmp_path / "erp.db"
+    _build(path)
+    before = _views(path)
+    live_sales = db.count_orders(path)
+
+    archived = db.archive_months(keep_months=1, db_path=path)
+    assert archived and [r["month"] for r in archived] == sorted(r["month"] for r in archived)
+    directory = db.archive_dir(path)
+    manifest = json.loads((directory / "manifest.json").read_text(encoding="utf-8"))
+    assert [s["file"] for s in manifest["segments"]] == [r["file"] for r in db.list_archive(path)]
+    assert all((directory / r["file"]).stat().st_size < r["raw_bytes"] for r in archived)
+    conn = db.connect(path)
+    assert conn.execute("SELECT COUNT(*) FROM sales").fetchone()[0] == live_sales - sum(r["sales"] for r in archived)
+    conn.close()
+
+    assert _views(path) == before
+    # nothing left to move; a cold cache is unpacked again
+    assert db.archive_months(keep_months=1, db_path=path) == []
+    shutil.rmtree(directory / "cache")
+    assert _views(path) == before
+    # reports rebuilt from raw sales still include the archived months
+    db.rebuild_rollup(db_path=path)
+    assert db.sales_report("product", db_path=path) == before["report"]
+
+
+def test_stock_history_and_ledger_span_segments(tmp_path):
+    path = tmp_path / "erp.db"
+    _build(path)
+    tank = db.list_sources(path)[0]["id"]
+    stamps = [db.list_movements(1, db_path=path, after_id=n)[0]["timestamp"] for n in (150, 900, 2000)]
+    levels = db.stock_levels("source", tank, stamps, db_path=path)
+    report = db.reconcile_stock(db_path=path)
+
+    db.archive_months(keep_months=1, db_path=path)
+    assert db.stock_levels("source", tank, stamps, db_path=path) == pytest.approx(levels)
+    after = db.reconcile_stock(db_path=path)
+    assert (after["checked"], after["movements"], after["discrepancies"]) == (report["checked"], report["movements"], [])
+
+    # history derived after archiving walks the archived movements too
+    conn = db.connect(path)
+    conn.execute("DELETE FROM stock_checkpoints WHERE reason != 'set'")
+    conn.commit()
+    conn.close()
+    assert db.backfill_checkpoints(db_path=path) > 0
+    assert db.stock_levels("source", tank, stamps, db_path=path) == pytest.approx(levels)
+
+
+def test_backdated_orders_are_merged_on_the_next_run(tmp_path):
+    path = tmp_path / "erp.db"
+    _build(path)
+    [first, *_] = db.archive_months(keep_months=1, db_path=path)
+    month = first["month"]
+    pid = db.list_products(path)[0]["id"]
+    sale = db.record_order(pid, 2, order_date=f"{month}-15", db_path=path)
+    assert db.count_orders(path, date_iso=month) == first["sales"] + 1
+    assert db.list_orders(path, date_iso=month, limit=1)[0]["id"] == sale["id"]
+    # the newest row of a table always stays live
+    assert db.archive_months(keep_months=1, db_path=path) == []
+    db.record_order(pid, 1, db_path=path)
+
+    [again] = db.archive_months(keep_months=1, db_path=path)
+    assert (again["month"], again["sales"]) == (month, first["sales"] + 1)
+    assert again["file"] != first["file"] and not (db.archive_dir(path) / first["file"]).exists()
+    assert db.count_orders(path, date_iso=month) == first["sales"] + 1
+    assert db.list_orders(path, date_iso=month, limit=1)[0]["id"] == sale["id"]
+
+    with pytest.raises(ValueError):
+        db.archive_month(db.list_orders(path, limit=1)[0]["timestamp"][:7], db_path=path)
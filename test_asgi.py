@@ -0,0 +1,108 @@
+"""ASGI entry point checks: routes through the bounded executor, backpressure, SSE — run with pytest."""
+import asyncio
+import json
+import threading
+
+import pytest
+
+import asgi
+import db
+import events
+
+
+async def _request(server, method, path, body=b"", headers=()):
+    scope = {"type": "http", "method": method, "path": path, "query_string": b"", "root_path": "",
+             "headers": [(k.encode(), v.encode()) for k, v in headers], "http_version": "1.1",
+             "server": ("test", 80), "client": ("127.0.0.1", 1), "scheme": "http"}
+    sent = [{"type": "http.request", "body": body, "more_body": False}]
+    out = {"body": b""}
+
+    async def receive():
+        return sent.pop() if sent else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            out["status"] = message["status"]
+            out["headers"] = {k.decode(): v.decode() for k, v in message["headers"]}
+        else:
+            out["body"] += message.get("body", b"")
+
+    await server(scope, receive, send)
+    return out
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    path = tmp_path / "asgi.db"
+    monkeypatch.setattr(db, "get_db_path", lambda *a, **k: path)
+    db.init_db(path)
+    s = asgi.ERPServer(asgi.BoundedExecutor(workers=4, queue_limit=8, queue_timeout=5))
+    yield s
+    s.relay.detach()
+    s.executor.shutdown()
+
+
+def _login(server):
+    r = asyncio.run(_request(server, "POST", "/api/login", json.dumps({"username": "admin", "password": "admin"}).encode(),
+                             [("content-type", "application/json")]))
+    assert r["status"] == 200
+    return r["headers"]["set-cookie"].split(";", 1)[0]
+
+
+def test_same_routes_and_static_files(server):
+    assert asyncio.run(_request(server, "GET", "/api/products"))["status"] == 200
+    cookie = _login(server)
+    r = asyncio.run(_request(server, "GET", "/api/orders", headers=[("cookie", cookie)]))
+    assert r["status"] == 200 and json.loads(r["body"]) == []
+    page = asyncio.run(_request(server, "GET", "/login"))
+    assert page["status"] == 200 and b"<html" in page["body"].lower()
+
+
+def test_backpressure_rejects_when_queue_full():
+    ex = asgi.BoundedExecutor(workers=1, queue_limit=1, queue_timeout=5)
+    gate = threading.Event()
+
+    async def scenario():
+        first = asyncio.ensure_future(ex.run(gate.wait))
+        await asyncio.sleep(0.05)
+        queued = asyncio.ensure_future(ex.run(lambda: "queued"))
+        await asyncio.sleep(0.05)
+        with pytest.raises(asgi.Overloaded):
+            await ex.run(lambda: "rejected")
+        gate.set()
+        return await first, await queued
+
+    assert asyncio.run(scenario()) == (True, "queued")
+    assert ex.stats()["rejected"] == 1
+    ex.shutdown()
+
+
+def test_events_stream_without_a_thread(server, tmp_path):
+    cookie = _login(server)
+
+    async def scenario():
+        scope = {"type": "http", "method": "GET", "path": "/api/events", "query_string": b"",
+                 "headers": [(b"cookie", cookie.encode())]}
+        chunks, gone = [], asyncio.Event()
+
+        async def receive():
+            await gone.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                chunks.append(message["body"].decode())
+                if "source-adjusted" in chunks[-1]:
+                    gone.set()
+
+        task = asyncio.ensure_future(server(scope, receive, send))
+        await asyncio.sleep(0.05)
+        await asyncio.to_thread(db.adjust_source_quantity, 1, 5, db_path=tmp_path / "asgi.db")
+        await asyncio.wait_for(task, 5)
+        return chunks
+
+    chunks = asyncio.run(scenario())
+    assert chunks[0].startswith("retry")
+    assert "event: source-adjusted" in chunks[-1]
+    assert server.executor.stats()["running"] == 0
+    assert events.hub.subscribers == 0
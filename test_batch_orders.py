@@ -0,0 +1,40 @@
+"""Batch order ingestion checks — run with pytest."""
+import db
+
+
+def test_batch_commits_good_orders_and_reports_failures(tmp_path):
+    path = tmp_path / "batch.db"
+    db.init_db(path)
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    tank = db.list_sources(path)[0]["quantity"]
+    results = db.record_orders([
+        {"product_id": pid, "quantity": 2},
+        {"product_id": 99999, "quantity": 1},
+        {"product_id": pid, "quantity": tank},  # more than the tank holds
+        {"quantity": 1},
+        {"product_id": pid, "quantity": 1, "payment_method": "Mpesa", "created_by": 2},
+    ], created_by=1, db_path=path)
+    assert [r["ok"] for r in results] == [True, False, False, False, True]
+    assert "not found" in results[1]["error"]
+    assert "insufficient" in results[2]["error"]
+    assert results[0]["order"]["created_by"] == 1 and results[4]["order"]["created_by"] == 2
+    assert len(db.list_sales(path)) == 2
+    # only the two recorded orders (3 units of 5 L) left the tank
+    assert db.list_sources(path)[0]["quantity"] == tank - 15
+    assert db.count_movements(kind="source", db_path=path) == 2
+
+
+def test_batch_endpoint(tmp_path, monkeypatch):
+    import app as erp_app
+    path = tmp_path / "batch.db"
+    monkeypatch.setattr(db, "get_db_path", lambda *a, **k: path)
+    db.init_db(path)
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    c = erp_app.app.test_client()
+    c.post("/api/login", json={"username": "user", "password": "user"})
+    r = c.post("/api/orders/batch", json={"orders": [{"product_id": pid}, {"product_id": "x"}, {"product_id": str(pid), "quantity": "2"}]})
+    assert r.status_code == 200
+    res = r.get_json()["results"]
+    assert [x["ok"] for x in res] == [True, False, True]
+    assert res[1]["error"] == "invalid product_id"
+    assert res[2]["order"]["quantity"] == 2.0
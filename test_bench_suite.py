@@ -0,0 +1,44 @@
+"""Benchmark fixture and regression check — run with pytest."""
+import db
+from bench import fixtures, suite
+
+
+def test_fixture_is_realistic_and_reused(tmp_path):
+    path = tmp_path / "bench.db"
+    params = fixtures.build(path, days=14, sales_per_day=40, products=5, users=3)
+    assert fixtures.fixture_params(path) == params
+    conn = db.connect(path)
+    sales, days, users = conn.execute("SELECT COUNT(*), COUNT(DISTINCT substr(timestamp, 1, 10)), COUNT(DISTINCT created_by) FROM sales").fetchone()
+    order_moves = conn.execute("SELECT COUNT(*) FROM movements WHERE reason LIKE 'order:%'").fetchone()[0]
+    refills = conn.execute("SELECT COUNT(*) FROM movements WHERE reason = 'refill'").fetchone()[0]
+    conn.close()
+    assert days == 14 and users > 1
+    assert order_moves == sales and refills == 14 * params['refills_per_day']
+
+    def marked():
+        conn = db.connect(path)
+        n = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'marker'").fetchone()[0]
+        conn.close()
+        return n == 1
+
+    conn = db.connect(path)
+    conn.execute("CREATE TABLE marker (x)")
+    conn.commit()
+    conn.close()
+    fixtures.load_or_build(path, **params)
+    assert marked()
+    fixtures.load_or_build(path, **{**params, 'seed': 2})
+    assert not marked()
+
+
+def test_suite_times_every_case_and_flags_regressions(tmp_path):
+    path = tmp_path / "bench.db"
+    fixtures.build(path, days=5, sales_per_day=20)
+    results = suite.run(path, repeat=3)
+    assert set(results) == {'record_order', 'list_orders_day', 'list_orders_day_user', 'list_orders_latest',
+                            'daily_summary', 'list_movements', 'list_movements_source', 'list_inventory', 'stock_as_of'}
+    assert all(r['runs'] == 3 and r['min_ms'] <= r['median_ms'] <= r['p95_ms'] for r in results.values())
+
+    baseline = {'results': {'list_inventory': {'min_ms': 1.0}, 'daily_summary': {'min_ms': 1.0}}}
+    now = {'list_inventory': {'min_ms': 1.2}, 'daily_summary': {'min_ms': 2.0}}
+    assert suite.compare(now, baseline) == [('daily_summary', 1.0, 2.0)]
@@ -0,0 +1,53 @@
+"""Product catalog cache checks — run with pytest."""
+import sqlite3
+
+import db
+
+
+def _setup(tmp_path):
+    path = tmp_path / "catalog.db"
+    db.init_db(path)
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    db.list_products(path)  # warm the cache
+    return path, pid
+
+
+def test_order_path_makes_no_catalog_queries(tmp_path):
+    path, pid = _setup(tmp_path)
+    db.close_pool()
+    statements = []
+    conn = db.connect(path)
+    conn.set_trace_callback(statements.append)
+    conn.close()
+    db.record_order(product_id=pid, quantity=1, use_bottle=True, bottle_price=10, db_path=path)
+    assert statements, "expected the traced pooled connection to be reused"
+    catalog_reads = [s for s in statements if "FROM products" in s or "FROM product_sources" in s]
+    assert catalog_reads == []
+
+
+def test_writes_from_elsewhere_invalidate(tmp_path):
+    path, pid = _setup(tmp_path)
+    loads = db._catalog.loads
+    db.record_order(product_id=pid, quantity=1, db_path=path)
+    assert db._catalog.loads == loads
+    # another process changing the price directly still bumps the version
+    raw = sqlite3.connect(path)
+    raw.execute("UPDATE products SET unit_price = 55 WHERE id = ?", (pid,))
+    raw.commit()
+    raw.close()
+    assert db.record_order(product_id=pid, quantity=1, db_path=path)["unit_price"] == 55
+    db.update_product(pid, "5L water", 60, db_path=path)
+    assert db.record_order(product_id=pid, quantity=1, db_path=path)["unit_price"] == 60
+
+
+def test_mapping_changes_are_seen(tmp_path):
+    path, pid = _setup(tmp_path)
+    tank = db.list_sources(path)[0]
+    db.delete_product_source(pid, db_path=path)
+    db.set_inventory(pid, 3, db_path=path)
+    db.record_order(product_id=pid, quantity=1, db_path=path)
+    assert db.get_inventory_for_product(pid, path)["quantity"] == 2
+    assert db.list_sources(path)[0]["quantity"] == tank["quantity"]
+    db.set_product_source(pid, tank["id"], 5, db_path=path)
+    db.record_order(product_id=pid, quantity=1, db_path=path)
+    assert db.list_sources(path)[0]["quantity"] == tank["quantity"] - 5
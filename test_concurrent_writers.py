@@ -0,0 +1,68 @@
+"""Load test: several processes recording orders at once against one WAL database.
+
+Runs under pytest, or directly for a bigger run:
+    python test_concurrent_writers.py --writers 8 --orders 200
+"""
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import db
+
+
+def _writer(db_path: str, orders: int) -> tuple[int, list[str]]:
+    pid = next(p["id"] for p in db.list_products(db_path) if p["name"] == "5L water")
+    ok = 0
+    errors = []
+    for _ in range(orders):
+        try:
+            db.record_order(product_id=pid, quantity=1, db_path=db_path)
+            ok += 1
+        except Exception as e:
+            errors.append(str(e))
+    return ok, errors
+
+
+def run_load(db_path, writers: int, orders: int) -> dict:
+    db.init_db(db_path)
+    db.close_pool()
+    tank_before = db.list_sources(db_path)[0]["quantity"]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=writers) as ex:
+        results = list(ex.map(_writer, [str(db_path)] * writers, [orders] * writers))
+    elapsed = time.perf_counter() - start
+    done = sum(r[0] for r in results)
+    errors = [e for r in results for e in r[1]]
+    return {
+        "writers": writers,
+        "orders": done,
+        "errors": errors,
+        "seconds": elapsed,
+        "orders_per_sec": done / elapsed if elapsed else 0.0,
+        "tank_before": tank_before,
+        "tank_after": db.list_sources(db_path)[0]["quantity"],
+    }
+
+
+def test_concurrent_writers_without_lock_errors(tmp_path):
+    writers, orders = 6, 40
+    res = run_load(tmp_path / "load.db", writers, orders)
+    assert res["errors"] == []
+    assert res["orders"] == writers * orders
+    assert len(db.list_sales(tmp_path / "load.db")) == writers * orders
+    # every order took exactly 5 L from the main tank
+    assert res["tank_before"] - res["tank_after"] == 5.0 * writers * orders
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--writers", type=int, default=8)
+    ap.add_argument("--orders", type=int, default=200)
+    a = ap.parse_args()
+    with tempfile.TemporaryDirectory() as d:
+        res = run_load(Path(d) / "load.db", a.writers, a.orders)
+    print(f"{res['writers']} writers, {res['orders']} orders in {res['seconds']:.2f}s "
+          f"=> {res['orders_per_sec']:.0f} orders/s, {len(res['errors'])} errors")
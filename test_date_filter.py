@@ -0,0 +1,29 @@
+"""Date range filtering checks — run with pytest."""
+import pytest
+
+import db
+
+
+def test_date_range_bounds():
+    assert db.date_range("2024-02-28") == ("2024-02-28", "2024-02-29")
+    assert db.date_range("2024-12") == ("2024-12-01", "2025-01-01")
+    assert db.date_range("2024") == ("2024-01-01", "2025-01-01")
+    with pytest.raises(ValueError):
+        db.date_range("yesterday")
+
+
+def test_range_matches_prefix_and_uses_index(tmp_path):
+    path = tmp_path / "dates.db"
+    db.init_db(path)
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    for d in ("2024-03-01T23:59:59", "2024-03-02T00:00:00", "2024-03-02T12:30:00", "2024-03-03T00:00:00"):
+        db.record_order(product_id=pid, quantity=1, order_date=d, created_by=1, db_path=path)
+    orders = db.list_orders(path, date_iso="2024-03-02")
+    assert [o["timestamp"][:10] for o in orders] == ["2024-03-02", "2024-03-02"]
+    assert db.daily_summary("2024-03-02", path)["total_quantity"] == 2
+    assert len(db.list_orders(path, date_iso="2024-03", user_id=1)) == 4
+
+    conn = db.connect(path)
+    plan = " ".join(r[3] for r in conn.execute("EXPLAIN QUERY PLAN SELECT SUM(total) FROM sales WHERE timestamp >= ? AND timestamp < ?", db.date_range("2024-03-02")))
+    conn.close()
+    assert "idx_sales_timestamp" in plan
@@ -0,0 +1,68 @@
+"""Connection pool checks for db.py — run with pytest."""
+import threading
+
+import db
+
+
+def test_connections_are_reused(tmp_path):
+    path = tmp_path / "pool.db"
+    db.init_db(path)
+    before = db.pool_stats()
+    for _ in range(20):
+        db.list_products(path)
+    after = db.pool_stats()
+    assert after["misses"] == before["misses"]
+    assert after["hits"] - before["hits"] == 20
+
+
+def test_close_rolls_back_uncommitted_work(tmp_path):
+    path = tmp_path / "pool.db"
+    db.init_db(path)
+    conn = db.connect(path)
+    conn.execute("INSERT INTO products (name, unit_price) VALUES ('ghost', 1)")
+    conn.close()
+    names = [p["name"] for p in db.list_products(path)]
+    assert "ghost" not in names
+
+
+def test_failed_order_raises_and_leaves_stock(tmp_path):
+    path = tmp_path / "pool.db"
+    db.init_db(path)
+    tank = db.list_sources(path)[0]
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    try:
+        db.record_order(product_id=pid, quantity=tank["quantity"], db_path=path)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected insufficient stock")
+    assert db.list_sources(path)[0]["quantity"] == tank["quantity"]
+
+
+def test_threads_share_the_pool(tmp_path):
+    path = tmp_path / "pool.db"
+    db.init_db(path)
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(50):
+                db.list_inventory(path)
+        except Exception as e:  # pragma: no cover - surfaced by the assert below
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert db.pool_stats()["idle"] <= db.POOL_MAX_IDLE * 2
+
+
+def test_close_pool_then_reconnect(tmp_path):
+    path = tmp_path / "pool.db"
+    db.init_db(path)
+    db.close_pool()
+    assert db.pool_stats()["idle"] == 0
+    assert db.list_products(path)
@@ -0,0 +1,124 @@
+"""Event hub and /api/events SSE checks — run with pytest."""
+import json
+import threading
+
+import app as erp_app
+import db
+import events
+
+
+def _parse(chunk):
+    out = []
+    for block in chunk.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        if "event" in fields:
+            out.append((fields["event"], json.loads(fields["data"])))
+    return out
+
+
+def test_fan_out_resume_and_resync():
+    hub = events.EventHub(size=4)
+    streams = [hub.stream(heartbeat=5) for _ in range(50)]
+    assert all(next(s).startswith("retry") for s in streams)
+    got = []
+    readers = [threading.Thread(target=lambda s=s: got.append(next(s))) for s in streams]
+    for t in readers:
+        t.start()
+    hub.publish("order-created", {"order": {"id": 1}})
+    for t in readers:
+        t.join(5)
+    assert len(got) == 50 and all(_parse(c) == [("order-created", {"order": {"id": 1}})] for c in got)
+    assert hub.subscribers == 50
+
+    for i in range(2, 5):
+        hub.publish("inventory-changed", {"product_id": i})
+    assert [e[0] for e in hub.since(1)] == [2, 3, 4]
+    for i in range(5, 10):
+        hub.publish("inventory-changed", {"product_id": i})
+    # ids 2..5 have been dropped from a 4-slot buffer
+    assert hub.since(1) is None
+    late = hub.stream(last_id=1, heartbeat=0.01)
+    next(late)
+    assert "event: resync" in next(late)
+
+
+def test_owner_filter():
+    hub = events.EventHub()
+    hub.publish("order-created", {"order": {"id": 1}}, owner=2)
+    hub.publish("order-created", {"order": {"id": 2}}, owner=3)
+    hub.publish("source-adjusted", {"id": 1})
+    s = hub.stream(last_id=0, user_id=3, heartbeat=0.01)
+    next(s)
+    assert [e for e, _ in _parse(next(s))] == ["order-created", "source-adjusted"]
+
+
+def test_writes_publish_after_commit(tmp_path):
+    path = tmp_path / "events.db"
+    db.init_db(path)
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    start = events.hub.last_id
+    sale = db.record_order(product_id=pid, quantity=2, created_by=1, db_path=path)
+    db.adjust_source_quantity(1, 10, db_path=path)
+    db.set_inventory(pid, 3, db_path=path)
+    try:
+        db.record_order(product_id=pid, quantity=10**9, db_path=path)
+    except ValueError:
+        pass
+    got = [(e, json.loads(d)) for _, e, d, _ in events.hub.since(start)]
+    assert [e for e, _ in got] == ["order-created", "source-adjusted", "source-adjusted", "inventory-changed"]
+    assert got[0][1]["order"]["id"] == sale["id"]
+    assert got[1][1]["delta"] == -10.0
+    assert got[2][1]["quantity"] == db.get_source(1, path)["quantity"]
+
+
+def test_events_endpoint(tmp_path, monkeypatch):
+    path = tmp_path / "sse.db"
+    monkeypatch.setattr(db, "get_db_path", lambda *a, **k: path)
+    db.init_db(path)
+    c = erp_app.app.test_client()
+    assert c.get("/api/events").status_code == 401
+    c.post("/api/login", json={"username": "admin", "password": "admin"})
+    last = events.hub.last_id
+    db.update_source(1, quantity=123, db_path=path)
+    r = c.get("/api/events", headers={"Last-Event-ID": str(last)})
+    assert r.mimetype == "text/event-stream"
+    chunks = iter(r.response)
+    next(chunks)
+    body = next(chunks)
+    body = body.decode() if isinstance(body, bytes) else body
+    assert _parse(body)[0][0] == "source-adjusted" and _parse(body)[0][1]["quantity"] == 123
+
+    # past the per-process cap a stream is refused instead of taking a thread
+    monkeypatch.setattr(events, "MAX_STREAMS", events.hub.subscribers)
+    refused = c.get("/api/events")
+    assert refused.status_code == 503 and refused.headers["Retry-After"] == "30"
+    r.close()
+    monkeypatch.setattr(events, "MAX_STREAMS", events.hub.subscribers + 1)
+    assert c.get("/api/events").status_code == 200
+
+
+def test_bridge_replays_other_processes_events(tmp_path):
+    path = tmp_path / "erp.db-events"
+    hubs = [events.EventHub(size=3 * events.BUFFER_SIZE) for _ in range(2)]
+    # one hour between background polls, so the test polls by hand
+    bridges = [events.EventBridge(h, path, poll=3600, pid=pid) for h, pid in zip(hubs, (101, 102))]
+    for h, b in zip(hubs, bridges):
+        h.bridge = b
+    try:
+        hubs[0].publish("order-created", {"order": {"id": 7}}, owner=3)
+        hubs[1].publish("inventory-changed", {"product_id": 2})
+        assert bridges[0].poll_once() == 1 and bridges[1].poll_once() == 1
+        # each hub holds its own event and the other's, none twice
+        for h in hubs:
+            assert sorted((e, json.loads(d), o) for _, e, d, o in h.since(0)) == [
+                ("inventory-changed", {"product_id": 2}, None), ("order-created", {"order": {"id": 7}}, 3)]
+        assert bridges[0].poll_once() == 0
+
+        # a poller that fell behind the pruned rows is told to resync
+        for i in range(events.BUFFER_SIZE + 100):
+            hubs[1].publish("inventory-changed", {"product_id": i})
+        bridges[0].poll_once()
+        assert [e for _, e, _, _ in hubs[0].since(2)][0] == "resync"
+    finally:
+        for b in bridges:
+            b.close()
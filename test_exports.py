@@ -0,0 +1,43 @@
+"""Streaming export checks — run with pytest."""
+import csv
+import io
+import json
+import tracemalloc
+
+import db
+import exports
+
+
+def _seed(path, n):
+    db.init_db(path)
+    conn = db.connect(path)
+    conn.executemany(
+        "INSERT INTO sales (product_id, quantity, unit_price, total, payment_method, timestamp, created_by) VALUES (1, 1, 40, 40, 'Cash', ?, 1)",
+        ((f"2024-01-{1 + i % 28:02d}T10:00:00Z",) for i in range(n)),
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_ndjson_and_csv_round_trip(tmp_path):
+    path = tmp_path / "export.db"
+    _seed(path, 56)
+    lines = "".join(exports.stream_export("sales", "ndjson", "2024-01-01", "2024-01-02", db_path=path)).splitlines()
+    rows = [json.loads(line) for line in lines]
+    assert len(rows) == 4
+    assert all(r["timestamp"][:10] in ("2024-01-01", "2024-01-02") for r in rows)
+
+    text = "".join(exports.stream_export("sales", "csv", fields=["id", "total"], db_path=path))
+    parsed = list(csv.reader(io.StringIO(text)))
+    assert parsed[0] == ["id", "total"] and len(parsed) == 57
+
+
+def test_export_memory_is_flat(tmp_path):
+    path = tmp_path / "export.db"
+    _seed(path, 20_000)
+    tracemalloc.start()
+    count = sum(chunk.count("\n") for chunk in exports.stream_export("sales", "ndjson", db_path=path))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert count == 20_000
+    assert peak < 4 * 1024 * 1024
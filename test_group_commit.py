@@ -0,0 +1,99 @@
+"""Group-commit writer lane checks — run with pytest."""
+import os
+import threading
+
+import pytest
+
+import db
+
+
+def _product(path):
+    return next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+
+
+def test_concurrent_orders_share_transactions(tmp_path):
+    path = tmp_path / "group.db"
+    db.init_db(path)
+    pid = _product(path)
+    tank = db.list_sources(path)[0]["quantity"]
+    writer = db.GroupCommitWriter(path, max_batch=8, max_wait=0.05)
+    results = [None] * 20
+    start = threading.Barrier(20)
+
+    def till(n):
+        start.wait()
+        results[n] = writer.submit({"product_id": pid, "quantity": 1, "created_by": 1}).result(timeout=10)
+
+    threads = [threading.Thread(target=till, args=(n,)) for n in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    writer.close()
+
+    # each caller got its own sale, and they went through in fewer transactions
+    assert len({r["id"] for r in results}) == 20
+    assert writer.stats()["orders"] == 20 and writer.stats()["batches"] < 20
+    assert writer.stats()["largest"] <= 8
+    assert db.count_orders(db_path=path) == 20
+    assert db.list_sources(path)[0]["quantity"] == tank - 100
+
+
+def test_failed_order_does_not_sink_its_batch(tmp_path):
+    path = tmp_path / "group.db"
+    db.init_db(path)
+    pid = _product(path)
+    tank = db.list_sources(path)[0]["quantity"]
+    # a long wait so all three land in one batch
+    writer = db.GroupCommitWriter(path, max_batch=3, max_wait=5)
+    good = writer.submit({"product_id": pid, "quantity": 1})
+    greedy = writer.submit({"product_id": pid, "quantity": tank})
+    missing = writer.submit({"product_id": 99999})
+    assert good.result(timeout=10)["quantity"] == 1
+    with pytest.raises(ValueError, match="insufficient"):
+        greedy.result(timeout=10)
+    with pytest.raises(ValueError, match="not found"):
+        missing.result(timeout=10)
+    writer.close()
+    assert writer.stats()["batches"] == 1
+    assert db.count_orders(db_path=path) == 1
+
+
+def test_record_order_goes_through_the_lane_when_enabled(tmp_path, monkeypatch):
+    path = tmp_path / "group.db"
+    db.init_db(path)
+    pid = _product(path)
+    monkeypatch.setattr(db, "GROUP_COMMIT", True)
+    try:
+        sale = db.record_order(pid, 2, idempotency_key="k1", created_by=1, db_path=path)
+        assert db.record_order(pid, 2, idempotency_key="k1", db_path=path)["id"] == sale["id"]
+        with pytest.raises(ValueError, match="insufficient"):
+            db.record_order(pid, 10 ** 9, db_path=path)
+        assert db.group_writer(path).stats()["orders"] == 2
+    finally:
+        db.close_writers()
+    assert db.count_orders(db_path=path) == 1
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_forked_child_gets_its_own_lane(tmp_path):
+    path = tmp_path / "group.db"
+    db.init_db(path)
+    pid = _product(path)
+    writer = db.group_writer(path)
+    writer.submit({"product_id": pid, "quantity": 1}).result(timeout=10)
+
+    # as under a preloading server: the parent's thread is gone in the child
+    child = os.fork()
+    if child == 0:
+        try:
+            sale = db.group_writer(path).submit({"product_id": pid, "quantity": 2}).result(timeout=10)
+            os._exit(0 if sale["quantity"] == 2 and writer.stats()["orders"] == 1 else 1)
+        except BaseException:
+            os._exit(2)
+    _, status = os.waitpid(child, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert db.count_orders(db_path=path) == 2
+    writer.submit({"product_id": pid, "quantity": 1}).result(timeout=10)
+    assert writer.stats()["orders"] == 2
+    db.close_writers()
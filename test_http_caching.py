@@ -0,0 +1,58 @@
+"""ETag / Last-Modified handling on catalog and stock endpoints — run with pytest."""
+from datetime import datetime, timezone
+import time
+from wsgiref.handlers import format_date_time
+
+import pytest
+
+import db
+
+
+@pytest.mark.parametrize("url", ["/api/products", "/api/sources", "/api/stock", "/api/product_sources"])
+def test_revalidation_returns_304_until_a_write(client, db_path, url, monkeypatch):
+    c, path = client, db_path
+    first = c.get(url)
+    etag = first.headers["ETag"]
+    assert first.status_code == 200 and first.headers["Last-Modified"]
+
+    # a 304 is answered from cached versions; the listing itself is never run
+    monkeypatch.setattr(db, "list_products", lambda *a, **k: pytest.fail("listing ran"))
+    monkeypatch.setattr(db, "list_sources", lambda *a, **k: pytest.fail("listing ran"))
+    monkeypatch.setattr(db, "list_inventory", lambda *a, **k: pytest.fail("listing ran"))
+    monkeypatch.setattr(db, "list_product_sources", lambda *a, **k: pytest.fail("listing ran"))
+    again = c.get(url, headers={"If-None-Match": etag})
+    assert again.status_code == 304 and again.data == b""
+    monkeypatch.undo()
+    monkeypatch.setattr(db, "get_db_path", lambda *a, **k: path)
+
+    db.add_product("Empty 1L bottle", 5, db_path=path)
+    db.add_source("Spare Tank", quantity=10, db_path=path)
+    db.set_inventory(1, 1, db_path=path)
+    changed = c.get(url, headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+
+
+def test_orders_bump_stock_etag(client, db_path):
+    c, path = client, db_path
+    etag = c.get("/api/sources").headers["ETag"]
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    db.record_order(product_id=pid, quantity=1, db_path=path)
+    assert c.get("/api/sources", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_last_modified_covers_its_whole_second(client, monkeypatch):
+    versions = {"products": (5, "2024-05-01T10:00:00Z")}
+    monkeypatch.setattr(db, "table_versions", lambda *a, **k: versions)
+    first = client.get("/api/products")
+    assert first.headers["Last-Modified"] == "Wed, 01 May 2024 10:00:01 GMT"
+    since = {"If-Modified-Since": first.headers["Last-Modified"]}
+    assert client.get("/api/products", headers=since).status_code == 304
+    # If-None-Match wins even when If-Modified-Since would match
+    assert client.get("/api/products", headers={**since, "If-None-Match": '"products.4"'}).status_code == 200
+
+    # a change in a second that has not ended yet: its stamp may be shared by the next one
+    stamp = datetime.fromtimestamp(time.time() + 3600, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    versions["products"] = (6, stamp)
+    r = client.get("/api/products")
+    assert r.headers["Last-Modified"] == format_date_time(datetime.strptime(stamp, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp())
+    assert client.get("/api/products", headers={"If-Modified-Since": r.headers["Last-Modified"]}).status_code == 200
@@ -0,0 +1,63 @@
+"""Idempotent order creation checks — run with pytest."""
+import db
+import events
+
+
+def _setup(tmp_path):
+    path = tmp_path / "idem.db"
+    db.init_db(path)
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    return path, pid
+
+
+def test_repeated_key_returns_stored_sale_without_restocking(tmp_path):
+    path, pid = _setup(tmp_path)
+    tank = db.list_sources(path)[0]["quantity"]
+    first = db.record_order(product_id=pid, quantity=2, created_by=1, idempotency_key="k-1", db_path=path)
+    again = db.record_order(product_id=pid, quantity=2, created_by=1, idempotency_key="k-1", db_path=path)
+    assert again == first
+    res = db.record_orders([{"product_id": pid, "idempotency_key": "k-1"}, {"product_id": pid, "idempotency_key": "k-2"}, {"product_id": pid, "idempotency_key": "k-2"}], db_path=path)
+    assert res[0]["order"]["id"] == first["id"]
+    assert res[1]["order"]["id"] == res[2]["order"]["id"]
+    assert len(db.list_sales(path)) == 2
+    assert db.list_sources(path)[0]["quantity"] == tank - 15
+
+
+def test_replays_publish_no_events(tmp_path, monkeypatch):
+    path, pid = _setup(tmp_path)
+    batch = [{"product_id": pid, "idempotency_key": "o-1"}]
+    db.record_orders(batch, db_path=path)
+    last = events.hub.last_id
+    assert db.record_orders(batch, db_path=path)[0]["ok"]
+    # a key that lands between the fast-path lookup and the write lock
+    monkeypatch.setattr(db, "get_order_by_idempotency_key", lambda *a, **k: None)
+    db.record_order(product_id=pid, idempotency_key="o-1", db_path=path)
+    assert events.hub.last_id == last
+
+
+def test_purge_drops_old_keys_only(tmp_path):
+    path, pid = _setup(tmp_path)
+    db.record_order(product_id=pid, order_date="2020-01-01T10:00", idempotency_key="old", db_path=path)
+    db.record_order(product_id=pid, idempotency_key="new", db_path=path)
+    assert db.purge_idempotency_keys(30, db_path=path) == 1
+    assert db.get_order_by_idempotency_key("old", path) is None
+    assert db.get_order_by_idempotency_key("new", path) is not None
+
+
+def test_header_replay(tmp_path, monkeypatch):
+    import app as erp_app
+    path, pid = _setup(tmp_path)
+    monkeypatch.setattr(db, "get_db_path", lambda *a, **k: path)
+    c = erp_app.app.test_client()
+    c.post("/api/login", json={"username": "user", "password": "user"})
+    r1 = c.post("/api/orders", json={"product_id": pid}, headers={"Idempotency-Key": "abc"})
+    r2 = c.post("/api/orders", json={"product_id": pid}, headers={"Idempotency-Key": "abc"})
+    assert r1.status_code == r2.status_code == 200
+    assert r2.headers.get("Idempotent-Replayed") == "true"
+    assert r1.get_json()["id"] == r2.get_json()["id"]
+    # the same key belonging to another user's sale is refused
+    conn = db.connect(path)
+    conn.execute("UPDATE sales SET created_by = 1")
+    conn.commit()
+    conn.close()
+    assert c.post("/api/orders", json={"product_id": pid}, headers={"Idempotency-Key": "abc"}).status_code == 409
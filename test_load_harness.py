@@ -0,0 +1,64 @@
+"""HTTP load harness checks against a live in-process server — run with pytest."""
+import asyncio
+import json
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+
+import app as erp_app
+import db
+from bench import load
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    path = tmp_path / "load.db"
+    monkeypatch.setattr(db, "get_db_path", lambda *a, **k: path)
+    db.init_db(path)
+    httpd = make_server("127.0.0.1", 0, erp_app.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd.server_port, path
+    httpd.shutdown()
+
+
+def test_till_mix_logs_in_and_reports_a_level(server):
+    port, path = server
+    cookie = asyncio.run(load.login("127.0.0.1", port))
+    products = asyncio.run(load.sellable_products("127.0.0.1", port, cookie))
+    assert products and all(p["product_id"] in products for p in db.list_product_sources(path))
+
+    r = asyncio.run(load.run_level("127.0.0.1", port, cookie, clients=3, duration=0.5, products=products))
+    assert r["requests"] > 0 and r["errors"] == 0 and r["error_pct"] == 0
+    assert r["p50_ms"] <= r["p99_ms"] <= r["max_ms"]
+    assert set(r["routes"]) == {"POST /api/orders", "GET /api/orders", "GET /api/products", "GET /api/stock", "GET /api/daily_summary"}
+    assert db.count_orders(db_path=path) == r["routes"]["POST /api/orders"]["requests"]
+
+
+def test_recorded_traffic_is_replayed_in_order(server, tmp_path):
+    port, path = server
+    traffic = tmp_path / "traffic.jsonl"
+    traffic.write_text("\n".join(json.dumps(e) for e in [
+        {"method": "GET", "path": "/api/orders?date=$today"},
+        {"method": "POST", "path": "/api/orders", "body": {"product_id": "$product", "quantity": 1}},
+        {"path": "/api/no-such-route", "weight": 0},
+    ]) + "\n")
+    mix = load.load_traffic(traffic)
+    assert [m[1:3] for m in mix] == [("GET", "/api/orders?date=$today"), ("POST", "/api/orders"), ("GET", "/api/no-such-route")]
+
+    cookie = asyncio.run(load.login("127.0.0.1", port))
+    r = asyncio.run(load.run_level("127.0.0.1", port, cookie, clients=1, duration=0.3, mix=mix, products=[1], in_order=True))
+    # in order, so the zero-weight line is still sent, and it 404s
+    assert r["routes"]["GET /api/no-such-route"]["errors"] > 0
+    assert r["routes"]["POST /api/orders"]["requests"] > 0 and r["error_pct"] > 0
+
+    bad = tmp_path / "bad.jsonl"
+    bad.write_text('{"method": "GET"}\n')
+    with pytest.raises(ValueError, match="bad.jsonl:1"):
+        load.load_traffic(bad)
+
+
+def test_knee_is_where_throughput_flattens():
+    levels = [{"clients": c, "rps": rps} for c, rps in ((1, 100), (5, 400), (10, 700), (25, 720), (50, 690))]
+    assert load.knee(levels) == 10
+    assert load.knee(levels[:3]) is None
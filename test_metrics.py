@@ -0,0 +1,60 @@
+"""Request timing, SQL counting and /api/metrics checks — run with pytest."""
+import logging
+
+import pytest
+
+import app as erp_app
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def _fresh_registry():
+    metrics.registry.reset()
+
+
+def _samples(text):
+    out = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            out[name] = float(value)
+    return out
+
+
+def test_routes_are_timed_with_their_sql(client):
+    for _ in range(3):
+        assert client.get("/api/orders?limit=5").status_code == 200
+    r = client.post("/api/orders", json={"product_id": 1, "quantity": 1})
+    assert r.status_code == 200
+    timing = r.headers["Server-Timing"]
+    assert timing.startswith("db;dur=") and "queries" in timing and "total;dur=" in timing
+    client.get("/api/products/999/history")
+
+    body = client.get("/api/metrics")
+    assert body.status_code == 200 and body.mimetype == "text/plain"
+    s = _samples(body.get_data(as_text=True))
+    assert s['erp_http_requests_total{method="GET",route="/api/orders",status="200"}'] == 3
+    assert s['erp_http_request_duration_seconds_count{method="GET",route="/api/orders"}'] == 3
+    assert s['erp_http_request_duration_seconds_bucket{method="GET",route="/api/orders",le="+Inf"}'] == 3
+    # list + count per page
+    assert s['erp_request_sql_statements_sum{method="GET",route="/api/orders"}'] >= 6
+    assert s['erp_request_sql_statements_sum{method="POST",route="/api/orders"}'] > 0
+    # ids stay out of the labels
+    assert any('route="/api/products/<int:product_id>/history"' in k for k in s)
+    assert s["erp_sql_statements_total"] > 0 and s["erp_db_connections_opened_total"] >= 1
+
+
+def test_slow_queries_are_logged(client, monkeypatch, caplog):
+    monkeypatch.setattr(metrics, "SLOW_QUERY_MS", 0)
+    with caplog.at_level(logging.WARNING, logger="erp.sql"):
+        client.get("/api/orders?limit=5")
+    assert any("slow query" in r.getMessage() and "FROM sales" in r.getMessage() for r in caplog.records)
+    assert _samples(client.get("/api/metrics").get_data(as_text=True))["erp_sql_slow_total"] > 0
+
+
+def test_metrics_need_an_admin_or_the_token(client, monkeypatch):
+    anon = erp_app.app.test_client()
+    assert anon.get("/api/metrics").status_code == 403
+    monkeypatch.setattr(metrics, "TOKEN", "s3cret")
+    assert anon.get("/api/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 403
+    assert anon.get("/api/metrics", headers={"Authorization": "Bearer s3cret"}).status_code == 200
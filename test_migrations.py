@@ -0,0 +1,80 @@
+"""Schema migration runner checks — run with pytest."""
+import sqlite3
+
+import pytest
+
+import db
+
+
+def test_fresh_database_runs_each_migration_once(tmp_path):
+    path = tmp_path / "fresh.db"
+    assert db.init_db(path) == [v for v, _, _ in db.MIGRATIONS]
+    assert db.schema_version(path) == db.SCHEMA_VERSION
+    assert db.init_db(path) == []
+
+
+def test_warm_start_is_one_version_check(tmp_path):
+    path = tmp_path / "warm.db"
+    db.init_db(path)
+    db.close_pool()
+    statements = []
+    conn = db.connect(path)
+    conn.set_trace_callback(statements.append)
+    conn.close()
+    db.init_db(path)
+    conn = db.connect(path)
+    conn.set_trace_callback(None)
+    conn.close()
+    assert [s for s in statements if not s.startswith("PRAGMA journal_mode")] == ["SELECT MAX(version) FROM schema_version"]
+
+
+def test_restart_keeps_live_bottle_stock_and_mappings(tmp_path):
+    path = tmp_path / "stock.db"
+    db.init_db(path)
+    bottle = next(p["id"] for p in db.list_products(path) if p["name"] == "Empty 5L bottle")
+    water = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    db.set_inventory(bottle, 7, db_path=path)
+    db.set_product_source(water, 1, factor=5.5, db_path=path)
+    db.init_db(path)
+    assert db.get_inventory_for_product(bottle, path)["quantity"] == 7
+    assert db.get_product_source(water, path)["factor"] == 5.5
+
+
+def test_legacy_database_is_upgraded(tmp_path):
+    path = tmp_path / "legacy.db"
+    raw = sqlite3.connect(path)
+    raw.executescript(
+        """
+        CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT NOT NULL, unit_price REAL NOT NULL);
+        CREATE TABLE sales (id INTEGER PRIMARY KEY, product_id INTEGER NOT NULL, quantity INTEGER NOT NULL,
+            unit_price REAL NOT NULL, total REAL NOT NULL, payment_method TEXT DEFAULT 'Cash',
+            timestamp TEXT NOT NULL, created_by INTEGER);
+        INSERT INTO products VALUES (1, '5L water', 40);
+        INSERT INTO sales VALUES (1, 1, 2, 40, 80, 'Cash', '2023-05-01T08:00:00Z', 2);
+        """
+    )
+    raw.close()
+    db.init_db(path)
+    conn = db.connect(path)
+    qty_type = next(c[2] for c in conn.execute("PRAGMA table_info(sales)") if c[1] == "quantity")
+    row = conn.execute("SELECT quantity, created_by, bottles_used FROM sales WHERE id = 1").fetchone()
+    conn.close()
+    assert qty_type == "REAL" and tuple(row) == (2.0, 2, 0)
+    assert db.daily_summary("2023-05-01", path)["total_money"] == 80
+
+
+def test_failed_migration_rolls_back_and_is_retried(tmp_path, monkeypatch):
+    path = tmp_path / "fail.db"
+
+    def broken(cur):
+        cur.execute("CREATE TABLE half_done (id INTEGER)")
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(db, "MIGRATIONS", db.MIGRATIONS[:2] + ((3, "broken", broken),))
+    monkeypatch.setattr(db, "SCHEMA_VERSION", 3)
+    with pytest.raises(RuntimeError):
+        db.migrate(path)
+    assert db.schema_version(path) == 2
+    conn = db.connect(path)
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+    conn.close()
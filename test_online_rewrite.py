@@ -0,0 +1,98 @@
+"""Online, chunked table rewrite checks — run with pytest."""
+import sqlite3
+import time
+
+import pytest
+
+import db
+
+LEGACY_SALES = """
+    CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT NOT NULL, unit_price REAL NOT NULL);
+    CREATE TABLE sales (id INTEGER PRIMARY KEY, product_id INTEGER NOT NULL, quantity INTEGER NOT NULL,
+        unit_price REAL NOT NULL, total REAL NOT NULL, payment_method TEXT DEFAULT 'Cash',
+        timestamp TEXT NOT NULL, created_by INTEGER, bottles_used INTEGER DEFAULT 0);
+    CREATE INDEX idx_sales_timestamp ON sales(timestamp);
+    INSERT INTO products VALUES (1, '5L water', 40);
+"""
+
+
+def _legacy_db(path, rows):
+    raw = sqlite3.connect(path)
+    raw.executescript(LEGACY_SALES)
+    raw.execute(
+        "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+        "INSERT INTO sales (id, product_id, quantity, unit_price, total, timestamp, created_by, bottles_used) "
+        "SELECT i, 1, 1 + i % 3, 40, 40 * (1 + i % 3), printf('2023-%02d-%02dT10:00:00Z', 1 + i % 12, 1 + i % 28), 1 + i % 2, i % 2 FROM n",
+        (rows,),
+    )
+    raw.commit()
+    raw.close()
+
+
+def test_multi_million_row_rewrite_is_chunked(tmp_path, monkeypatch):
+    path = tmp_path / "big.db"
+    _legacy_db(path, 2_000_000)
+    monkeypatch.setattr(db, "REWRITE_CHUNK", 100_000)
+    monkeypatch.setattr(db, "REWRITE_PAUSE", 0)
+    seen = []
+    db.migrate(path, progress=lambda name, copied, total: seen.append((name, copied, total, time.perf_counter())))
+    assert len(seen) == 20 and seen[-1][1:3] == (2_000_000, 2_000_000)
+    assert {s[0] for s in seen} == {"sales.quantity as REAL"}
+    # no single chunk holds the write lock for long
+    gaps = [b[3] - a[3] for a, b in zip(seen, seen[1:])]
+    assert max(gaps) < 5
+    conn = db.connect(path)
+    cols = {c[1]: c[2] for c in conn.execute("PRAGMA table_info(sales)")}
+    n, qty, bottles = conn.execute("SELECT COUNT(*), SUM(quantity), SUM(bottles_used) FROM sales").fetchone()
+    indexes = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'sales'")}
+    conn.close()
+    assert cols["quantity"] == "REAL" and "bottles_used" in cols
+    assert n == 2_000_000 and qty == sum(1 + i % 3 for i in range(1, 2_000_001)) and bottles == 1_000_000
+    assert "idx_sales_timestamp" in indexes
+    assert db.rewrite_status("sales.quantity_real", path)["finished_at"]
+
+
+def test_concurrent_writes_during_copy_are_kept(tmp_path):
+    path = tmp_path / "live.db"
+    _legacy_db(path, 5_000)
+    writer = sqlite3.connect(path, timeout=5)
+    calls = []
+
+    def till(copied, total):
+        # another connection writes between chunks, as a till would
+        calls.append(copied)
+        n = len(calls)
+        writer.execute("INSERT INTO sales (product_id, quantity, unit_price, total, timestamp) VALUES (1, 2, 40, 80, '2024-01-01T00:00:00Z')")
+        writer.execute("UPDATE sales SET quantity = 9 WHERE id = ?", (n,))
+        writer.execute("DELETE FROM sales WHERE id = ?", (4_000 + n,))
+        writer.commit()
+
+    rows = db.rewrite_table("sales", db._SALES_TABLE_SQL.replace("FOREIGN KEY(product_id)", "bottles_used INTEGER DEFAULT 0,\n FOREIGN KEY(product_id)"),
+                            exprs={"quantity": "CAST(quantity AS REAL)"}, chunk_size=500, pause=0, progress=till, db_path=path)
+    writer.close()
+    assert len(calls) == 10
+    conn = db.connect(path)
+    assert rows == conn.execute("SELECT COUNT(*) FROM sales").fetchone()[0] == 5_000
+    assert conn.execute("SELECT COUNT(*) FROM sales WHERE quantity = 9").fetchone()[0] == 10
+    assert conn.execute("SELECT COUNT(*) FROM sales WHERE timestamp = '2024-01-01T00:00:00Z'").fetchone()[0] == 10
+    assert conn.execute("SELECT COUNT(*) FROM sales WHERE id > 4000 AND id <= 4010").fetchone()[0] == 0
+    conn.close()
+
+
+def test_interrupted_rewrite_resumes(tmp_path):
+    path = tmp_path / "resume.db"
+    _legacy_db(path, 10_000)
+    calls = []
+
+    def crash(copied, total):
+        calls.append(copied)
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+
+    create = db._SALES_TABLE_SQL.replace("FOREIGN KEY(product_id)", "bottles_used INTEGER DEFAULT 0,\n FOREIGN KEY(product_id)")
+    with pytest.raises(KeyboardInterrupt):
+        db.rewrite_table("sales", create, chunk_size=1_000, pause=0, progress=crash, db_path=path)
+    assert db.rewrite_status("sales", path)["last_id"] == 3_000
+    resumed = []
+    assert db.rewrite_table("sales", create, chunk_size=1_000, pause=0, progress=lambda c, t: resumed.append(c), db_path=path) == 10_000
+    assert resumed[0] == 4_000 and resumed[-1] == 10_000
@@ -0,0 +1,56 @@
+"""On-demand request profiling checks — run with pytest."""
+import sys
+
+import pytest
+
+import app as erp_app
+import profiling
+
+
+@pytest.fixture(autouse=True)
+def _fresh_profiles(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "store", profiling.ProfileStore(tmp_path / "profiles", keep=3))
+    monkeypatch.setattr(profiling, "sampling", profiling.Sampling())
+
+
+def test_admin_header_captures_collapsed_stacks(client):
+    r = client.get("/api/orders?limit=5", headers={"X-Profile": "1"})
+    assert r.status_code == 200 and sys.getprofile() is None
+    profile_id = r.headers["X-Profile-Id"]
+
+    listed = client.get("/api/profiles").get_json()
+    assert [p["id"] for p in listed] == [profile_id]
+    assert listed[0]["route"] == "/api/orders" and listed[0]["method"] == "GET" and listed[0]["status"] == 200
+
+    text = client.get(f"/api/profiles/{profile_id}").get_data(as_text=True)
+    lines = text.splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    # whole stacks, from the view down into db.py and sqlite3
+    assert any("api_orders (app.py" in line and "list_orders (db.py" in line and "execute" in line for line in lines)
+
+    assert client.get("/api/profiles/../../etc").status_code == 404
+    assert client.get("/api/profiles/20990101T000000000000Z-1").status_code == 404
+
+
+def test_off_by_default_and_header_needs_an_admin(client):
+    assert "X-Profile-Id" not in client.get("/api/orders").headers
+    for off in ("0", "false", "no", ""):
+        assert "X-Profile-Id" not in client.get("/api/orders", headers={"X-Profile": off}).headers
+    user = erp_app.app.test_client()
+    user.post("/api/login", json={"username": "user", "password": "user"})
+    assert "X-Profile-Id" not in user.get("/api/orders", headers={"X-Profile": "1"}).headers
+    assert user.get("/api/profiles").status_code == 403
+    assert client.get("/api/profiles").get_json() == []
+    assert "X-Profile-Id" in client.get("/api/orders", headers={"X-Profile": "True"}).headers
+
+
+def test_sampling_by_route_keeps_a_bounded_ring(client):
+    assert client.put("/api/profiles/sampling", json={"rate": 2}).status_code == 400
+    assert client.put("/api/profiles/sampling", json={"rate": 1, "route": "/api/products"}).get_json() == {"rate": 1.0, "route": "/api/products"}
+    assert "X-Profile-Id" not in client.get("/api/stock").headers
+    ids = [client.get("/api/products").headers["X-Profile-Id"] for _ in range(5)]
+    client.put("/api/profiles/sampling", json={"rate": 0})
+    assert "X-Profile-Id" not in client.get("/api/products").headers
+
+    assert [p["id"] for p in client.get("/api/profiles").get_json()] == ids[:-4:-1]
+    assert len(list(profiling.store.directory.iterdir())) == 6
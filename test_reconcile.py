@@ -0,0 +1,85 @@
+"""Stock ledger reconciliation checks — run with pytest."""
+import pytest
+
+import db
+
+
+def _drift(path, kind, ref_id, delta):
+    """Change a counter behind the ledger's back."""
+    table, key = db._STOCK_ROWS[kind]
+    conn = db.connect(path)
+    conn.execute(f"UPDATE {table} SET quantity = quantity + ? WHERE {key} = ?", (delta, ref_id))
+    conn.commit()
+    conn.close()
+
+
+def test_ledger_accounts_for_orders_and_sets(tmp_path):
+    path = tmp_path / "recon.db"
+    db.init_db(path)
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "10L water")
+    bottle = next(p["id"] for p in db.list_products(path) if p["name"] == "Empty 10L bottle")
+    db.record_order(pid, 3, use_bottle=True, db_path=path)
+    db.set_inventory(bottle, 50, db_path=path)
+    db.adjust_source_quantity(1, 250, db_path=path)
+    db.record_order(pid, 1, use_bottle=True, db_path=path)
+    report = db.reconcile_stock(db_path=path)
+    assert report["discrepancies"] == [] and report["repaired"] == 0
+    assert report["checked"] == len(db.list_sources(path)) + len(db.list_inventory(path))
+    assert report["movements"] == 2  # the two orders after the last set of each row
+
+    # drift is found even after a scheduled snapshot copied it
+    _drift(path, "source", 1, -40)
+    db.checkpoint_stock(path)
+    [d] = db.reconcile_stock(db_path=path)["discrepancies"]
+    assert (d["kind"], d["ref_id"], d["difference"]) == ("source", 1, -40)
+
+
+def test_repairs(tmp_path):
+    path = tmp_path / "recon.db"
+    db.init_db(path)
+    tank = db.list_sources(path)[0]
+    _drift(path, "source", tank["id"], -40)
+
+    # ledger: the counter stays, a movement explains the difference
+    report = db.reconcile_stock("ledger", user_id=1, db_path=path)
+    assert report["repaired"] == 1
+    assert db.list_sources(path)[0]["quantity"] == tank["quantity"] - 40
+    [m] = db.list_movements(kind="source", db_path=path)
+    assert (m["delta"], m["reason"], m["user_id"]) == (-40, "reconcile", 1)
+    assert db.reconcile_stock(db_path=path)["discrepancies"] == []
+    assert db.stock_as_of("source", tank["id"], "2999-01-01", path) == tank["quantity"] - 40
+
+    # counters: the ledger wins
+    _drift(path, "source", tank["id"], 15)
+    assert db.reconcile_stock("counters", db_path=path)["repaired"] == 1
+    assert db.list_sources(path)[0]["quantity"] == tank["quantity"] - 40
+    assert db.reconcile_stock(db_path=path)["discrepancies"] == []
+
+    # movements for a deleted tank are reported but cannot be repaired
+    spare = db.add_source("Spare", quantity=10, db_path=path)
+    conn = db.connect(path)
+    conn.execute("INSERT INTO movements (kind, ref_id, delta, reason, timestamp) VALUES ('source', ?, -1, 'test', '2020-01-01T00:00:00Z')", (spare["id"],))
+    conn.commit()
+    conn.close()
+    db.delete_source(spare["id"], db_path=path)
+    report = db.reconcile_stock("ledger", db_path=path)
+    assert [(d["ref_id"], d["actual"]) for d in report["discrepancies"]] == [(spare["id"], None)]
+    assert report["repaired"] == 0
+    with pytest.raises(ValueError):
+        db.reconcile_stock("everything", db_path=path)
+
+
+def test_reconcile_endpoint(tmp_path, monkeypatch):
+    import app as erp_app
+    path = tmp_path / "recon.db"
+    monkeypatch.setattr(db, "get_db_path", lambda *a, **k: path)
+    db.init_db(path)
+    _drift(path, "source", 1, 5)
+    c = erp_app.app.test_client()
+    c.post("/api/login", json={"username": "user", "password": "user"})
+    assert c.get("/api/stock/reconcile").status_code == 403
+    c.post("/api/login", json={"username": "admin", "password": "admin"})
+    assert len(c.get("/api/stock/reconcile").get_json()["discrepancies"]) == 1
+    assert c.post("/api/stock/reconcile", json={}).status_code == 400
+    assert c.post("/api/stock/reconcile", json={"repair": "counters"}).get_json()["repaired"] == 1
+    assert c.get("/api/stock/reconcile").get_json()["discrepancies"] == []
@@ -0,0 +1,52 @@
+"""Daily sales rollup checks — run with pytest."""
+import db
+
+
+def _raw_totals(path):
+    conn = db.connect(path)
+    rows = conn.execute("SELECT substr(timestamp, 1, 10) as day, COUNT(*), SUM(quantity), SUM(total) FROM sales GROUP BY 1 ORDER BY 1").fetchall()
+    conn.close()
+    return [tuple(r) for r in rows]
+
+
+def _report_totals(path):
+    return [(r["day"], r["orders"], r["quantity"], r["total"]) for r in db.sales_report("day", db_path=path)]
+
+
+def test_rollup_tracks_orders_and_rebuild_matches(tmp_path):
+    path = tmp_path / "rollup.db"
+    db.init_db(path)
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    for d, user, pay in (("2024-05-01T09:00", 1, "Cash"), ("2024-05-01T10:00", 2, "Mpesa"), ("2024-05-02T08:00", 1, "Cash")):
+        db.record_order(product_id=pid, quantity=2, payment_method=pay, order_date=d, created_by=user, db_path=path)
+    db.record_order(product_id=pid, quantity=1, use_bottle=True, bottle_price=50, order_date="2024-05-02T09:00", db_path=path)
+
+    incremental = _report_totals(path)
+    assert incremental == _raw_totals(path)
+    assert db.daily_summary("2024-05-01", path) == {"date": "2024-05-01", "total_quantity": 4, "total_money": 160.0}
+
+    assert db.rebuild_rollup(db_path=path) == 4
+    assert _report_totals(path) == incremental
+
+    by_pay = {r["payment_method"]: r["total"] for r in db.sales_report("payment_method", "2024-05-01", "2024-05-01", db_path=path)}
+    assert by_pay == {"Cash": 80.0, "Mpesa": 80.0}
+    by_day_pay = db.sales_report("day", split="payment_method", db_path=path)
+    assert [(r["day"], r["payment_method"], r["orders"]) for r in by_day_pay] == [
+        ("2024-05-01", "Cash", 1), ("2024-05-01", "Mpesa", 1), ("2024-05-02", "Cash", 2)]
+    assert sum(r["total"] for r in by_day_pay) == sum(t for *_, t in incremental)
+    mine = db.sales_report("day", user_id=2, db_path=path)
+    assert [(r["day"], r["orders"]) for r in mine] == [("2024-05-01", 1)]
+
+
+def test_init_db_backfills_existing_sales(tmp_path):
+    path = tmp_path / "rollup.db"
+    db.init_db(path)
+    conn = db.connect(path)
+    conn.execute("INSERT INTO sales (product_id, quantity, unit_price, total, payment_method, timestamp) VALUES (1, 3, 40, 120, 'Cash', '2023-01-05T10:00:00Z')")
+    # a database from before the rollup and schema versioning existed
+    conn.execute("DROP TABLE sales_daily_rollup")
+    conn.execute("DROP TABLE schema_version")
+    conn.commit()
+    conn.close()
+    db.init_db(path)
+    assert _report_totals(path) == [("2023-01-05", 1, 3.0, 120.0)]
@@ -0,0 +1,29 @@
+"""Sales schema registry checks — run with pytest."""
+import db
+
+
+def test_hot_paths_do_not_reintrospect(tmp_path, monkeypatch):
+    path = tmp_path / "schema.db"
+    db.init_db(path)
+    calls = []
+    real = db._build_sales_schema
+    monkeypatch.setattr(db, "_build_sales_schema", lambda conn: calls.append(1) or real(conn))
+    pid = db.list_products(path)[0]["id"]
+    sale = db.record_order(product_id=pid, quantity=1, created_by=1, db_path=path)
+    db.list_sales(path)
+    db.list_orders(path, date_iso=sale["timestamp"][:10], user_id=1)
+    assert calls == []
+    assert sale["created_by"] == 1 and "bottle_price" in sale
+
+
+def test_invalidate_picks_up_new_columns(tmp_path):
+    path = tmp_path / "schema.db"
+    db.init_db(path)
+    assert "note" not in db.sales_schema(path)["columns"]
+    conn = db.connect(path)
+    conn.execute("ALTER TABLE sales ADD COLUMN note TEXT")
+    conn.commit()
+    conn.close()
+    assert "note" not in db.sales_schema(path)["columns"]
+    db.invalidate_schema(path)
+    assert "note" in db.sales_schema(path)["columns"]
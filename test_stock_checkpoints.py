@@ -0,0 +1,92 @@
+"""Point-in-time stock levels from checkpoints — run with pytest."""
+from datetime import datetime, timedelta
+
+import db
+
+
+def _move(path, kind, ref_id, delta, when):
+    """A movement at `when`, applied to the counter like an order would."""
+    table, key = db._STOCK_ROWS[kind]
+    conn = db.connect(path)
+    db.begin_write(conn)
+    conn.execute("INSERT INTO movements (kind, ref_id, delta, reason, timestamp) VALUES (?, ?, ?, 'test', ?)", (kind, ref_id, delta, when.isoformat() + 'Z'))
+    conn.execute(f"UPDATE {table} SET quantity = quantity + ? WHERE {key} = ?", (delta, ref_id))
+    conn.commit()
+    conn.close()
+
+
+def test_levels_between_checkpoints_and_sets(tmp_path):
+    path = tmp_path / "cp.db"
+    db.init_db(path)
+    tank = db.list_sources(path)[0]
+    full = tank["quantity"]
+    start = datetime.utcnow() - timedelta(days=10)
+    # history written straight into the ledger, so move the migration's anchor after it
+    conn = db.connect(path)
+    conn.execute("DELETE FROM stock_checkpoints")
+    conn.commit()
+    conn.close()
+    for day in range(8):
+        _move(path, "source", tank["id"], -100 if day < 5 else -10, start + timedelta(days=day, hours=1))
+    assert db.checkpoint_stock(path) >= 1
+    assert db.checkpoint_stock(path) == 0  # nothing moved since
+    assert db.backfill_checkpoints(every_days=1, db_path=path) >= 8
+
+    assert db.stock_as_of("source", tank["id"], start, path) == full
+    assert db.stock_as_of("source", tank["id"], (start + timedelta(days=2)).date(), path) == full - 200
+    assert db.stock_as_of("source", tank["id"], start + timedelta(days=6, hours=2), path) == full - 520
+    assert db.stock_as_of("source", tank["id"], datetime.utcnow(), path) == full - 530
+
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    sold_at = datetime.utcnow()
+    db.record_order(pid, 1, db_path=path)
+    assert db.stock_as_of("source", tank["id"], sold_at, path) == full - 530
+    assert db.stock_as_of("source", tank["id"], datetime.utcnow(), path) == full - 535
+
+    # a set writes no movement but leaves a checkpoint, so history on both sides holds
+    before_set = datetime.utcnow()
+    db.update_source(tank["id"], quantity=5000, db_path=path)
+    assert db.stock_as_of("source", tank["id"], before_set, path) == full - 535
+    assert db.stock_as_of("source", tank["id"], datetime.utcnow(), path) == 5000
+    assert db.stock_as_of("source", 9999, datetime.utcnow(), path) is None
+
+
+def test_backfill_matches_the_ledger(tmp_path):
+    from bench import fixtures
+    path = tmp_path / "cp.db"
+    fixtures.build(path, days=40, sales_per_day=60, products=4, sources=2, users=2)
+    conn = db.connect(path)
+    written = conn.execute("SELECT COUNT(*) FROM stock_checkpoints").fetchone()[0]
+    sources = conn.execute("SELECT id, quantity FROM sources").fetchall()
+    assert written > len(sources)
+    assert db.backfill_checkpoints(db_path=path) == 0  # reruns add nothing
+
+    today = datetime.utcnow().date()
+    days = [(today - timedelta(days=n)).isoformat() + "T23:59:59.999999" for n in range(45)]
+    for sid, live in sources:
+        levels = db.stock_levels("source", sid, days, path)
+        for ts, level in zip(days, levels):
+            later = conn.execute("SELECT TOTAL(delta) FROM movements WHERE kind = 'source' AND ref_id = ? AND timestamp > ?", (sid, ts + "Z")).fetchone()[0]
+            assert abs(level - (live - later)) < 1e-6
+    conn.close()
+
+
+def test_history_endpoint(tmp_path, monkeypatch):
+    import app as erp_app
+    path = tmp_path / "cp.db"
+    monkeypatch.setattr(db, "get_db_path", lambda *a, **k: path)
+    db.init_db(path)
+    tank = db.list_sources(path)[0]
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    db.record_order(pid, 2, db_path=path)
+    c = erp_app.app.test_client()
+    c.post("/api/login", json={"username": "user", "password": "user"})
+    r = c.get(f"/api/stock/history?kind=source&ref_id={tank['id']}&days=3")
+    assert r.status_code == 200
+    rows = r.get_json()
+    assert [row["date"] for row in rows][-1] == datetime.utcnow().date().isoformat()
+    assert rows[-1]["quantity"] == tank["quantity"] - 10 and rows[0]["quantity"] == tank["quantity"]
+    r = c.get(f"/api/stock/as_of?kind=source&ref_id={tank['id']}")
+    assert r.get_json()["quantity"] == tank["quantity"] - 10
+    assert c.get("/api/stock/as_of?kind=source&ref_id=x").status_code == 400
+    assert c.get(f"/api/stock/history?kind=tanks&ref_id={tank['id']}").status_code == 400
@@ -0,0 +1,126 @@
+"""Stress test: many writers racing for the last units of stock must never oversell.
+
+Runs under pytest, or directly for a bigger run:
+    python test_stock_contention.py --writers 8 --orders 100
+"""
+import argparse
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import db
+import metrics
+
+
+def _buyer(db_path: str, orders: int) -> tuple[int, int, list[str], float]:
+    pid = next(p["id"] for p in db.list_products(db_path) if p["name"] == "5L water")
+    ok = refused = 0
+    errors = []
+    busy = 0.0
+    for _ in range(orders):
+        t = time.perf_counter()
+        try:
+            db.record_order(product_id=pid, quantity=1, use_bottle=True, db_path=db_path)
+            ok += 1
+        except ValueError as e:
+            if "insufficient" not in str(e):
+                errors.append(str(e))
+            refused += 1
+        except Exception as e:
+            errors.append(str(e))
+        busy += time.perf_counter() - t
+    return ok, refused, errors, busy
+
+
+def run_race(db_path, writers: int, orders: int, tank_litres: float, bottles: int) -> dict:
+    db.init_db(db_path)
+    main_tank = db.list_sources(db_path)[0]["id"]
+    bottle_pid = next(p["id"] for p in db.list_products(db_path) if p["name"] == "Empty 5L bottle")
+    db.update_source(main_tank, quantity=tank_litres, db_path=db_path)
+    db.set_inventory(bottle_pid, bottles, db_path=db_path)
+    db.close_pool()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=writers) as ex:
+        results = list(ex.map(_buyer, [str(db_path)] * writers, [orders] * writers))
+    elapsed = time.perf_counter() - start
+    done = sum(r[0] for r in results)
+    return {
+        "sold": done,
+        "refused": sum(r[1] for r in results),
+        "errors": [e for r in results for e in r[2]],
+        "seconds": elapsed,
+        "ms_per_order": 1000 * sum(r[3] for r in results) / (writers * orders),
+        "tank_after": db.list_sources(db_path)[0]["quantity"],
+        "bottles_after": db.get_inventory_for_product(bottle_pid, db_path)["quantity"],
+    }
+
+
+def test_racing_orders_never_oversell(tmp_path):
+    path = tmp_path / "race.db"
+    # enough water for 100 orders but only 70 bottles: the bottle row is the one that runs out
+    res = run_race(path, writers=6, orders=25, tank_litres=500, bottles=70)
+    assert res["errors"] == []
+    assert res["sold"] == 70 and res["refused"] == 6 * 25 - 70
+    assert res["bottles_after"] == 0 and res["tank_after"] == 500 - 5 * 70
+    assert len(db.list_sales(path)) == 70
+    # a movement per sold bottle and per tank draw, none for refused orders
+    assert db.count_movements("inventory", db_path=path) == 70
+    assert db.count_movements("source", db_path=path) == 70
+
+
+def test_guarded_decrement_holds_in_deferred_transactions(tmp_path):
+    path = tmp_path / "deferred.db"
+    db.init_db(path)
+    bottle_pid = next(p["id"] for p in db.list_products(path) if p["name"] == "Empty 10L bottle")
+    db.set_inventory(bottle_pid, 50, db_path=path)
+    taken = []
+
+    def worker():
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+        for _ in range(20):
+            # plain BEGIN: no write lock until the UPDATE itself
+            conn.execute("BEGIN")
+            try:
+                db._change_stock(conn.cursor(), "inventory", bottle_pid, -1, "2024-01-01T00:00:00Z")
+                conn.execute("COMMIT")
+                taken.append(1)
+            except ValueError:
+                conn.execute("ROLLBACK")
+        conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(taken) == 50
+    assert db.get_inventory_for_product(bottle_pid, path)["quantity"] == 0
+
+
+def test_each_stock_row_is_changed_by_one_statement(tmp_path, monkeypatch):
+    path = tmp_path / "statements.db"
+    db.init_db(path)
+    pid = next(p["id"] for p in db.list_products(path) if p["name"] == "5L water")
+    db.record_order(product_id=pid, quantity=1, db_path=path)
+    seen = []
+    monkeypatch.setattr(metrics, "observe_sql", lambda sql, seconds, statement=True: statement and seen.append(" ".join(sql.split())))
+    db.record_order(product_id=pid, quantity=2, use_bottle=True, db_path=path)
+    stock = [s for s in seen if "sources" in s.split(" WHERE")[0] or "inventory" in s.split(" WHERE")[0]]
+    assert not any(s.startswith("SELECT quantity") for s in seen)
+    assert len(stock) == 2 and all(s.startswith("UPDATE") and "quantity >= ?" in s for s in stock)
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--writers", type=int, default=8)
+    ap.add_argument("--orders", type=int, default=100)
+    a = ap.parse_args()
+    with tempfile.TemporaryDirectory() as d:
+        stock = a.writers * a.orders // 2
+        res = run_race(Path(d) / "race.db", a.writers, a.orders, tank_litres=5 * stock, bottles=stock)
+    print(f"{a.writers} writers: {res['sold']} sold of {stock}, {res['refused']} refused, {len(res['errors'])} errors, "
+          f"tank left {res['tank_after']}, bottles left {res['bottles_after']}, {res['ms_per_order']:.2f} ms per attempt")
@@ -0,0 +1,56 @@
+"""Production launcher settings — run with pytest."""
+import sys
+
+import pytest
+
+import wsgi
+
+
+def test_autosizing_and_overrides(monkeypatch):
+    monkeypatch.delenv("ERP_WEB_WORKERS", raising=False)
+    monkeypatch.delenv("ERP_WEB_MAX_WORKERS", raising=False)
+    assert wsgi.default_workers(1) == 3
+    assert wsgi.default_workers(16) == 8
+    monkeypatch.setenv("PORT", "8123")
+    monkeypatch.setenv("ERP_WEB_MAX_REQUESTS", "500")
+    cfg = wsgi.settings(threads=16, workers=None)
+    assert cfg["bind"] == "0.0.0.0:8123" and cfg["preload_app"] is True
+    assert cfg["threads"] == 16 and cfg["workers"] == wsgi.default_workers()
+    assert cfg["max_requests"] == 500 and cfg["max_requests_jitter"] == 50
+    monkeypatch.setenv("ERP_WEB_WORKERS", "2")
+    assert wsgi.settings()["workers"] == 2
+
+
+def test_reload_without_server(tmp_path, monkeypatch):
+    monkeypatch.setenv("ERP_WEB_PIDFILE", str(tmp_path / "none.pid"))
+    with pytest.raises(RuntimeError):
+        wsgi.reload()
+
+
+def test_serve_fails_without_gunicorn(monkeypatch):
+    import main
+    # a process manager running `python -m main serve` must see a failure
+    monkeypatch.setitem(sys.modules, "gunicorn", None)
+    with pytest.raises(SystemExit) as exc:
+        main.cmd_serve(None)
+    assert "gunicorn" in str(exc.value.code)
+
+
+def test_workers_share_events(tmp_path, monkeypatch):
+    monkeypatch.setattr(wsgi.db, "get_db_path", lambda: tmp_path / "erp.db")
+    # restored afterwards; _post_fork sets it from the thread count
+    monkeypatch.setattr(wsgi.events, "MAX_STREAMS", 0)
+    server = type("Server", (), {"cfg": type("Cfg", (), {"workers": 3, "threads": 8})()})()
+    try:
+        wsgi._post_fork(server, None)
+        assert wsgi.events.stats()["shared"] == f"{tmp_path / 'erp.db'}-events"
+        assert wsgi.events.MAX_STREAMS == 2
+    finally:
+        wsgi.events.unshare()
+
+
+def test_event_streams_stay_below_threads(monkeypatch):
+    monkeypatch.delenv("ERP_EVENTS_MAX_STREAMS", raising=False)
+    assert [wsgi.max_streams(t) for t in (1, 4, 8, 16)] == [1, 1, 2, 4]
+    monkeypatch.setenv("ERP_EVENTS_MAX_STREAMS", "3")
+    assert wsgi.max_streams(4) == 3
@@ -7,6 +7,65 @@ async function fetchJSON(url, opts){
   return r.json();
 }
 
+// Every row of a paged list such as /api/orders: follows X-Next-After-Id until the last page
+async function fetchAllPages(url){
+  const rows = [];
+  const sep = url.includes('?') ? '&' : '?';
+  let next = null;
+  do{
+    const r = await fetch(next ? `${url}${sep}after_id=${next}` : url, {credentials: 'same-origin'});
+    if(!r.ok) throw new Error('HTTP '+r.status);
+    rows.push(...await r.json());
+    next = r.headers.get('X-Next-After-Id');
+  }while(next);
+  return rows;
+}
+
+// Random key identifying one order submission (see Idempotency-Key on /api/orders)
+function newIdempotencyKey(){
+  if(window.crypto && typeof window.crypto.randomUUID === 'function') return window.crypto.randomUUID();
+  return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2) + Math.random().toString(36).slice(2);
+}
+
+// Sections that show data changed by each /api/events event type
+const LIVE_SECTIONS = {
+  'order-created': ['dashboard_daily_sales','dashboard_revenue','sales_my_orders','reports_daily_sales','reports_weekly_sales','reports_monthly_sales','reports_pl'],
+  'source-adjusted': ['dashboard_water_volume','inventory_water_stock','reports_inventory'],
+  'inventory-changed': ['inventory_bottle_stock','reports_inventory']
+};
+
+// ms between reconnect attempts (and panel reloads) while /api/events is refused
+const EVENTS_RETRY_MS = 30000;
+
+// Reload the visible section when the server pushes a change it displays,
+// instead of polling; bursts of events collapse into one reload.
+function subscribeEvents(){
+  if(!window.EventSource || window._events) return;
+  const es = new EventSource('/api/events');
+  window._events = es;
+  let timer = null;
+  const refresh = (types)=>{
+    const cur = window.currentSection;
+    if(!cur || !types.some(t=>(LIVE_SECTIONS[t]||[]).includes(cur))) return;
+    clearTimeout(timer);
+    timer = setTimeout(()=>{ try{ showDashboardSection(window.currentSection); }catch(e){} }, 500);
+  };
+  Object.keys(LIVE_SECTIONS).forEach(t=>es.addEventListener(t, ()=>refresh([t])));
+  es.addEventListener('resync', ()=>refresh(Object.keys(LIVE_SECTIONS)));
+  // refused (the worker's stream cap, 503) or gone for good: reload the panel
+  // now and try again later, which polls slowly until a stream is accepted
+  es.onerror = ()=>{
+    if(es.readyState !== EventSource.CLOSED || window._events !== es) return;
+    window._events = null;
+    refresh(Object.keys(LIVE_SECTIONS));
+    setTimeout(()=>{ if(window.currentUser && !window._events) subscribeEvents(); }, EVENTS_RETRY_MS);
+  };
+}
+
+function unsubscribeEvents(){
+  if(window._events){ window._events.close(); window._events = null; }
+}
+
 // Update the header auth button text/state based on `window.currentUser`
 function updateAuthButton(){
   try{
@@ -110,6 +169,7 @@ async function initDashboard(){
         const handler = async ()=>{
           if(window.currentUser){
             try{ await fetch('/api/logout', {method:'POST'}); }catch(e){}
+            unsubscribeEvents();
             window.currentUser = null;
             updateAuthButton();
             showView('home');
@@ -125,6 +185,7 @@ async function initDashboard(){
     }catch(e){}
     // Show default dashboard section
     try{ showDashboardSection('dashboard_daily_sales'); }catch(e){}
+    try{ subscribeEvents(); }catch(e){}
   }catch(e){ console.error('initDashboard', e); }
 }
 
@@ -220,6 +281,7 @@ function exitSingleView(){
 // show specific dashboard section with new menu structure
 function showDashboardSection(name){
   console.log('showDashboardSection called with:', name);
+  window.currentSection = name;
   // hide all content cards
   const allCardIds = [
     // Legacy
@@ -359,19 +421,20 @@ async function loadSales(){
       return;
     }
     const date = (document.getElementById('salesDate') && document.getElementById('salesDate').value) || null;
-    const url = date ? `/api/orders?date=${encodeURIComponent(date)}` : '/api/orders';
-    const sales = await fetchJSON(url);
+    // per-day totals by payment method from the rollup, however many orders there are
+    const range = date ? `&from=${encodeURIComponent(date)}&to=${encodeURIComponent(date)}` : '';
+    const rows = await fetchJSON(`/api/reports/daily?split=payment_method${range}`);
     const el = document.getElementById('salesList');
     el.innerHTML = '';
     // Prepare aggregated data by date (YYYY-MM-DD) and by payment method
     const totalsCashByDate = {};
     const totalsMpesaByDate = {};
     const qtyByDate = {};
-    (sales || []).forEach(s => {
-      const d = (s.timestamp || '').slice(0,10) || new Date().toISOString().slice(0,10);
-      const t = parseFloat(s.total || 0);
-      const q = parseFloat(s.quantity || 0);
-      const pm = (s.payment_method || '').toLowerCase();
+    (rows || []).forEach(r => {
+      const d = r.day;
+      const t = parseFloat(r.total || 0);
+      const q = parseFloat(r.quantity || 0);
+      const pm = (r.payment_method || '').toLowerCase();
       if(pm === 'mpesa' || pm === 'm-pesa' || pm === 'm pesa'){
         totalsMpesaByDate[d] = (totalsMpesaByDate[d] || 0) + t;
       } else {
@@ -511,7 +574,7 @@ async function loadDailySummary(){
     // For richer breakdown (cash vs mpesa), fetch orders for the date and aggregate client-side.
     const date = (document.getElementById('dailyDate') && document.getElementById('dailyDate').value) || null;
     const url = date ? `/api/orders?date=${encodeURIComponent(date)}` : '/api/orders';
-    const orders = await fetchJSON(url);
+    const orders = await fetchAllPages(url);
     const el = document.getElementById('dailySummary');
     // aggregate
     let qty = 0; let cash = 0; let mpesa = 0;
@@ -734,12 +797,12 @@ async function loadReportsWeekly(){
   if(!outEl) return;
   outEl.innerHTML = 'Loading weekly report...';
   try{
-    const orders = await fetchJSON('/api/orders').catch(()=>null);
-    if(!orders) { outEl.innerHTML = '<div class="muted">No data — backend unreachable. Start the server (python app.py).</div>'; return; }
     const days = 7; const now = new Date(); const labels = []; const map = {};
     for(let i=days-1;i>=0;i--){ const d=new Date(now); d.setDate(now.getDate()-i); const key=d.toISOString().slice(0,10); labels.push(key); map[key]=0; }
+    const rows = await fetchJSON(`/api/reports/daily?from=${labels[0]}&to=${labels[labels.length-1]}`).catch(()=>null);
+    if(!rows) { outEl.innerHTML = '<div class="muted">No data — backend unreachable. Start the server (python app.py).</div>'; return; }
     let qty = 0;
-    (orders||[]).forEach(o=>{ const d=(o.timestamp||'').slice(0,10); if(d in map){ map[d] += parseFloat(o.total||0); qty += parseFloat(o.quantity||0); } });
+    rows.forEach(r=>{ if(r.day in map){ map[r.day] += parseFloat(r.total||0); qty += parseFloat(r.quantity||0); } });
     const data = labels.map(l=>parseFloat((map[l]||0).toFixed(2)));
     const total = data.reduce((a,b)=>a+b,0);
     outEl.innerHTML = `<p><strong>Last ${days} days</strong> • Total litres: <strong>${qty.toFixed(2)} L</strong> • Total amount: <strong>${total.toFixed(2)} KSH</strong></p><div id="reportsWeeklyChartWrap"></div>`;
@@ -757,10 +820,10 @@ async function loadReportsMonthly(){
     const daysInMonth = new Date(year, month+1, 0).getDate();
     const labels = []; const map = {};
     for(let d=1; d<=daysInMonth; d++){ const dd=new Date(year, month, d); const key=dd.toISOString().slice(0,10); labels.push(key); map[key]=0; }
-    const orders = await fetchJSON('/api/orders').catch(()=>null);
-    if(!orders){ outEl.innerHTML = '<div class="muted">No data — backend unreachable. Start the server (python app.py).</div>'; return; }
+    const rows = await fetchJSON(`/api/reports/daily?from=${labels[0]}&to=${labels[labels.length-1]}`).catch(()=>null);
+    if(!rows){ outEl.innerHTML = '<div class="muted">No data — backend unreachable. Start the server (python app.py).</div>'; return; }
     let qty = 0;
-    (orders||[]).forEach(o=>{ const d=(o.timestamp||'').slice(0,10); if(d in map){ map[d] += parseFloat(o.total||0); qty += parseFloat(o.quantity||0); } });
+    rows.forEach(r=>{ if(r.day in map){ map[r.day] += parseFloat(r.total||0); qty += parseFloat(r.quantity||0); } });
     const data = labels.map(l=>parseFloat((map[l]||0).toFixed(2)));
     const total = data.reduce((a,b)=>a+b,0);
     outEl.innerHTML = `<p><strong>This month</strong> • Total litres: <strong>${qty.toFixed(2)} L</strong> • Total amount: <strong>${total.toFixed(2)} KSH</strong></p><div id="reportsMonthlyChartWrap"></div>`;
@@ -776,9 +839,9 @@ async function loadRevenueChart(){
   try{
     const days = 30; const now = new Date(); const labels = []; const map = {};
     for(let i=days-1;i>=0;i--){ const d=new Date(now); d.setDate(now.getDate()-i); const key=d.toISOString().slice(0,10); labels.push(key); map[key]=0; }
-    const orders = await fetchJSON('/api/orders').catch(()=>null);
-    if(!orders){ outEl.innerHTML = '<div class="muted">No data — backend unreachable. Start the server (python app.py).</div>'; return; }
-    (orders||[]).forEach(o=>{ const d=(o.timestamp||'').slice(0,10); if(d in map) map[d] += parseFloat(o.total||0); });
+    const rows = await fetchJSON(`/api/reports/daily?from=${labels[0]}&to=${labels[labels.length-1]}`).catch(()=>null);
+    if(!rows){ outEl.innerHTML = '<div class="muted">No data — backend unreachable. Start the server (python app.py).</div>'; return; }
+    rows.forEach(r=>{ if(r.day in map) map[r.day] += parseFloat(r.total||0); });
     const data = labels.map(l=>parseFloat((map[l]||0).toFixed(2)));
     outEl.innerHTML = '<div id="revenueChartWrap"></div>';
     renderSalesTrend('revenueChartWrap', labels, data, {label:'Revenue (KSH)'});
@@ -807,9 +870,14 @@ async function loadReportsDaily(dateStr){
     const chartWrap = document.getElementById('reportsDailyChartWrap');
     const ordersEl = document.getElementById('reportsDailyOrders');
     summaryEl.innerHTML = 'Computing...'; chartWrap.innerHTML=''; ordersEl.innerHTML='';
-    const orders = await fetchJSON('/api/orders').catch(()=>null);
-    if(!orders){ summaryEl.innerHTML = '<div class="muted">No data — backend unreachable.</div>'; return; }
-    const dayOrders = (orders||[]).filter(o => (o.timestamp||'').slice(0,10) === dateISO);
+    // the day's orders page by page; the previous day only needs its total, from the rollup
+    const d = new Date(dateISO);
+    const prev = new Date(d); prev.setDate(d.getDate()-1); const prevISO = prev.toISOString().slice(0,10);
+    const [dayOrders, prevRows] = await Promise.all([
+      fetchAllPages(`/api/orders?date=${encodeURIComponent(dateISO)}`),
+      fetchJSON(`/api/reports/daily?from=${prevISO}&to=${prevISO}`),
+    ]).catch(()=>[null, null]);
+    if(!dayOrders){ summaryEl.innerHTML = '<div class="muted">No data — backend unreachable.</div>'; return; }
     const totalAmount = dayOrders.reduce((s,o)=>s + parseFloat(o.total||0), 0);
     const totalQty = dayOrders.reduce((s,o)=>s + parseFloat(o.quantity||0), 0);
     
@@ -843,10 +911,7 @@ async function loadReportsDaily(dateStr){
     });
     const hourData = Object.keys(hourMap).map(k=>parseFloat((hourMap[k]||0).toFixed(2)));
     // previous day comparison
-    const d = new Date(dateISO);
-    const prev = new Date(d); prev.setDate(d.getDate()-1); const prevISO = prev.toISOString().slice(0,10);
-    const prevOrders = (orders||[]).filter(o => (o.timestamp||'').slice(0,10) === prevISO);
-    const prevTotal = prevOrders.reduce((s,o)=>s + parseFloat(o.total||0), 0);
+    const prevTotal = prevRows.reduce((s,r)=>s + parseFloat(r.total||0), 0);
     const delta = prevTotal === 0 ? null : ((totalAmount - prevTotal)/prevTotal * 100);
 
     // payment method breakdown
@@ -936,11 +1001,11 @@ async function loadPLSummary(){
     return {from, to};
   }
 
+  // YYYY-MM-DD of a local date, as the rollup keys its days
+  function dayKey(d){ return `${d.getFullYear()}-${String(d.getMonth()+1).padStart(2,'0')}-${String(d.getDate()).padStart(2,'0')}`; }
+
   async function renderPL(range, refDateStr){
     const area = document.getElementById('plSummaryArea'); area.innerHTML = 'Computing...';
-    const orders = await fetchJSON('/api/orders').catch(()=>null);
-    if(!orders){ area.innerHTML = '<div class="muted">No data — backend unreachable.</div>'; return; }
-
     const refDate = refDateStr ? new Date(refDateStr) : new Date();
     const {from,to} = getRangeDates(range, refDate);
     const prevFrom = new Date(from); const prevTo = new Date(to);
@@ -948,12 +1013,21 @@ async function loadPLSummary(){
     const shift = to.getTime() - from.getTime() + 1;
     prevFrom.setTime(prevFrom.getTime() - shift); prevTo.setTime(prevTo.getTime() - shift);
 
-    function inRange(ts, a,b){ const t = new Date(ts); return t >= a && t <= b; }
-    const selOrders = (orders||[]).filter(o => inRange(o.timestamp, from, to));
-    const prevOrders = (orders||[]).filter(o => inRange(o.timestamp, prevFrom, prevTo));
-    const total = selOrders.reduce((s,o)=>s + parseFloat(o.total||0), 0);
-    const qty = selOrders.reduce((s,o)=>s + parseFloat(o.quantity||0), 0);
-    const prevTotal = prevOrders.reduce((s,o)=>s + parseFloat(o.total||0), 0);
+    // trend: last 30 days irrespective of range
+    const days = 30; const labels = []; const map = {};
+    const now = new Date(to);
+    for(let i=days-1;i>=0;i--){ const d2 = new Date(now); d2.setDate(now.getDate()-i); const k = dayKey(d2); labels.push(k); map[k]=0; }
+    // daily totals from the rollup, covering both periods and the trend
+    const first = [dayKey(prevFrom), labels[0]].sort()[0];
+    const rows = await fetchJSON(`/api/reports/daily?from=${first}&to=${dayKey(to)}`).catch(()=>null);
+    if(!rows){ area.innerHTML = '<div class="muted">No data — backend unreachable.</div>'; return; }
+
+    function inRange(day, a,b){ return day >= dayKey(a) && day <= dayKey(b); }
+    const selRows = rows.filter(r => inRange(r.day, from, to));
+    const prevRows = rows.filter(r => inRange(r.day, prevFrom, prevTo));
+    const total = selRows.reduce((s,r)=>s + parseFloat(r.total||0), 0);
+    const qty = selRows.reduce((s,r)=>s + parseFloat(r.quantity||0), 0);
+    const prevTotal = prevRows.reduce((s,r)=>s + parseFloat(r.total||0), 0);
     const delta = prevTotal === 0 ? null : ((total - prevTotal)/prevTotal * 100);
 
     area.innerHTML = `
@@ -968,11 +1042,7 @@ async function loadPLSummary(){
       </div>
     `;
 
-    // render trend: last 30 days irrespective of range
-    const days = 30; const labels = []; const map = {};
-    const now = new Date(to);
-    for(let i=days-1;i>=0;i--){ const d2 = new Date(now); d2.setDate(now.getDate()-i); const k = d2.toISOString().slice(0,10); labels.push(k); map[k]=0; }
-    (orders||[]).forEach(o=>{ const k=(o.timestamp||'').slice(0,10); if(k in map) map[k]+= parseFloat(o.total||0); });
+    rows.forEach(r=>{ if(r.day in map) map[r.day] += parseFloat(r.total||0); });
     const data = labels.map(l=>parseFloat((map[l]||0).toFixed(2)));
     renderSalesTrend('plTrendChartWrap', labels.map(l=>l.slice(5)), data, {label:'Revenue (last 30 days)'});
   }
@@ -1194,34 +1264,33 @@ async function loadStock(){
     const chartWrap2 = document.createElement('div'); chartWrap2.className = 'sales-chart-wrapper mb-2'; chartWrap2.innerHTML = `<canvas id="stockChartCanvas" class="sales-chart"></canvas>`;
     body.appendChild(chartWrap2);
 
+    // /api/stock/history returns at most 366 days and the chart asks for one more than it shows
+    const STOCK_CHART_MAX_DAYS = 365;
+    function stockChartSummary(){
+      let summaryEl = document.getElementById('stockChartSummary');
+      if(!summaryEl){ summaryEl = document.createElement('div'); summaryEl.id = 'stockChartSummary'; summaryEl.className = 'mb-2 muted'; chartWrap2.parentNode.insertBefore(summaryEl, chartWrap2); }
+      return summaryEl;
+    }
+
     async function reloadStockChart(){
       try{
         const sid = document.getElementById('chartSourceSelect').value;
-        const days = parseInt(document.getElementById('chartDays').value || '30');
+        const daysInput = document.getElementById('chartDays');
+        const days = Math.min(STOCK_CHART_MAX_DAYS, Math.max(1, parseInt(daysInput.value) || 30));
+        daysInput.value = days;
         if(!sid) return;
         // fetch source current quantity
         const src = await fetchJSON(`/api/sources`);
         const found = src.find(x=>String(x.id)===String(sid));
         const curQty = found ? parseFloat(found.quantity||0) : 0;
-        // fetch movements for source (large limit)
-        const rows = await fetchJSON(`/api/movements?kind=source&ref_id=${encodeURIComponent(sid)}&limit=1000`);
-        // aggregate by date (YYYY-MM-DD)
-        const byDate = {};
-        (rows||[]).forEach(r=>{
-          const d = (r.timestamp||'').slice(0,10) || new Date().toISOString().slice(0,10);
-          byDate[d] = (byDate[d]||0) + parseFloat(r.delta||0);
-        });
-        // build date list for last `days` days
-        const dates = [];
-        const today = new Date();
-        for(let i=days-1;i>=0;i--){ const dd = new Date(today); dd.setDate(today.getDate()-i); dates.push(dd.toISOString().slice(0,10)); }
-        const daily = dates.map(d=> parseFloat((byDate[d]||0).toFixed(2)) );
-        // Compute stock series (end-of-day) from daily deltas in a straightforward way:
-        // Let totalDelta = sum(daily[0..n-1]). Let prefix[i] = sum(daily[0..i]).
-        // Then end-of-day stock for day i = curQty - (totalDelta - prefix[i]).
-        const totalDelta = daily.reduce((a,b)=>a+b, 0);
-        let running = 0;
-        const stockSeries = daily.map((d,i)=>{ running += d; return parseFloat((curQty - (totalDelta - running)).toFixed(2)); });
+        // end-of-day levels, computed server-side from stock checkpoints; one day more than
+        // shown, so the level before the window's first day anchors the net change
+        const history = await fetchJSON(`/api/stock/history?kind=source&ref_id=${encodeURIComponent(sid)}&days=${days+1}`);
+        const before = (history||[]).length ? history[0].quantity : null;
+        const shown = (history||[]).slice(1);
+        const dates = shown.map(h=>h.date);
+        // null before the source existed: leave a gap rather than plotting 0
+        const stockSeries = shown.map(h=> h.quantity === null ? null : parseFloat(h.quantity.toFixed(2)) );
         // stockSeries is end-of-day stock; ensure numeric
         // render Chart.js: line for stock (green), optional bars for daily deltas (subtle)
         try{ if(window.stockChart) { window.stockChart.destroy(); window.stockChart = null; } }catch(e){}
@@ -1241,12 +1310,12 @@ async function loadStock(){
         }
         });
   // also show current quantity above chart and the net change over the period
-  const summaryElId = 'stockChartSummary';
-  let summaryEl = document.getElementById(summaryElId);
-  if(!summaryEl){ summaryEl = document.createElement('div'); summaryEl.id = summaryElId; summaryEl.className = 'mb-2 muted'; chartWrap2.parentNode.insertBefore(summaryEl, chartWrap2); }
-  const netChange = totalDelta;
-  summaryEl.innerHTML = `<strong>Current ${found ? found.name : 'Source'}:</strong> ${curQty.toFixed(2)} L — Net change (period): ${netChange.toFixed(2)} L`;
-      }catch(e){ console.error('reloadStockChart', e); }
+  const netChange = curQty - (before || 0);
+  stockChartSummary().innerHTML = `<strong>Current ${found ? found.name : 'Source'}:</strong> ${curQty.toFixed(2)} L — Net change (period): ${netChange.toFixed(2)} L`;
+      }catch(e){
+        console.error('reloadStockChart', e);
+        stockChartSummary().innerHTML = `<span class="text-danger">Failed to load stock history (${e.message})</span>`;
+      }
     }
     document.getElementById('chartRefresh').addEventListener('click', async ()=>{ await reloadStockChart(); });
     // initial chart load (first source)
@@ -1683,13 +1752,15 @@ async function submitNewOrder(){
       }
     }
     
+    // same key is kept if the order ends up in the offline outbox, so a replay cannot double-count
+    payload.idempotency_key = newIdempotencyKey();
     console.log('Submitting order:', payload);
     
     let resp, body;
     try{
       resp = await fetch('/api/orders', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': payload.idempotency_key },
         body: JSON.stringify(payload),
         credentials: 'same-origin'
       });
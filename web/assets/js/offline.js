@@ -21,6 +21,10 @@
   }
 
   async function save(item){
+    // every queued order carries an idempotency key so replays after a lost response are harmless
+    if(item && !item.idempotency_key){
+      item.idempotency_key = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : (Date.now().toString(36) + '-' + Math.random().toString(36).slice(2));
+    }
     const d = await openDB();
     return new Promise((resolve,reject)=>{
       const tx = d.transaction(STORE,'readwrite');
@@ -64,27 +68,42 @@
     });
   }
 
-  // flush outbox by posting each payload to /api/orders; on success delete.
+  // orders sent per /api/orders/batch request when flushing
+  const FLUSH_CHUNK = 50;
+
+  // flush outbox in chunks via /api/orders/batch; delete the items the server recorded.
   async function flush(){
     try{
       const items = await all();
       if(!items || items.length === 0) return 0;
-      for(const it of items){
+      for(let i = 0; i < items.length; i += FLUSH_CHUNK){
+        const chunk = items.slice(i, i + FLUSH_CHUNK);
+        let resp;
         try{
-          const resp = await fetch('/api/orders', { method: 'POST', headers: {'content-type':'application/json'}, body: JSON.stringify(it.payload), credentials: 'same-origin' });
-          if(resp && resp.ok){
-            await remove(it.id);
-            // optionally notify user; we'll dispatch a custom event
-            window.dispatchEvent(new CustomEvent('outbox:flushed', { detail: { id: it.id, payload: it.payload } }));
-          } else {
-            // if server rejects, skip deletion and leave for manual handling
-            console.warn('Failed to send outbox item', it, resp && resp.status);
-          }
+          resp = await fetch('/api/orders/batch', { method: 'POST', headers: {'content-type':'application/json'}, body: JSON.stringify({ orders: chunk.map(it => it.payload) }), credentials: 'same-origin' });
         }catch(e){
           console.warn('Network or fetch failed while flushing outbox', e);
           // stop trying further if network is down
           break;
         }
+        if(!resp || !resp.ok){
+          // if server rejects the whole batch, leave the items for manual handling
+          console.warn('Failed to send outbox batch', chunk, resp && resp.status);
+          continue;
+        }
+        const body = await resp.json();
+        const results = (body && body.results) || [];
+        for(let j = 0; j < chunk.length; j++){
+          const it = chunk[j]; const res = results[j];
+          if(res && res.ok){
+            await remove(it.id);
+            // optionally notify user; we'll dispatch a custom event
+            window.dispatchEvent(new CustomEvent('outbox:flushed', { detail: { id: it.id, payload: it.payload, order: res.order } }));
+          } else {
+            // if server rejects an order, skip deletion and leave for manual handling
+            console.warn('Failed to send outbox item', it, res && res.error);
+          }
+        }
       }
       return true;
     }catch(e){ console.error('flush outbox failed', e); return false; }
@@ -1,4 +1,4 @@
-const CACHE_NAME = 'water-erp-v1';
+const CACHE_NAME = 'water-erp-v2';
 const ASSETS_TO_CACHE = [
   '/',
   '/index.html',
@@ -26,6 +26,8 @@ self.addEventListener('activate', (event) => {
 self.addEventListener('fetch', (event) => {
   // Simple network-first for API routes, cache-first for static assets
   const url = new URL(event.request.url);
+  // leave the live event stream to the browser
+  if(url.pathname === '/api/events') return;
   if(url.pathname.startsWith('/api/')){
     event.respondWith(
       fetch(event.request).catch(() => caches.match(event.request))
@@ -0,0 +1,114 @@
+"""Production WSGI launcher: gunicorn with the Flask app preloaded.
+
+Run:
+  python -m main serve                 # what the Procfile runs
+  python -m main reload                # graceful worker restart (SIGHUP)
+
+The master imports `app` and runs `db.init_db()` once, then closes its pooled
+connections before forking, so workers start with a ready schema and no
+shared SQLite handles. With more than one worker, each shares its event hub
+through `<database>-events` (see events.py). Workers use the threaded (gthread) worker and are
+recycled after a capped number of requests.
+
+Sizing (environment, read when the server starts):
+- ERP_WEB_WORKERS       processes (default 2 x CPUs + 1, at most ERP_WEB_MAX_WORKERS)
+- ERP_WEB_MAX_WORKERS   upper bound for the default (8); SQLite allows one writer
+- ERP_WEB_THREADS       threads per worker (default 4)
+- ERP_EVENTS_MAX_STREAMS  /api/events streams per worker (default a quarter of
+  the threads, at least 1); more get 503 and the dashboard polls instead.
+  Serve through asgi.py for many open dashboards: its streams hold no thread
+- ERP_WEB_MAX_REQUESTS  requests before a worker is replaced (default 2000, +10% jitter)
+- ERP_WEB_TIMEOUT       seconds a silent worker may take before it is killed (60)
+- ERP_WEB_PIDFILE       master pid file used by `main reload` (data/gunicorn.pid)
+- PORT                  listen port (5000)
+
+SIGHUP (`main reload`) starts fresh workers and lets the old ones finish
+their requests within the graceful timeout. With the app preloaded the
+code itself is not re-imported; deploy new code with a restart.
+"""
+import os
+import signal
+from pathlib import Path
+
+import db
+import events
+
+
+def default_workers(cpus: int | None = None) -> int:
+    cpus = cpus or os.cpu_count() or 1
+    return min(2 * cpus + 1, int(os.environ.get("ERP_WEB_MAX_WORKERS", 8)))
+
+
+def pidfile() -> Path:
+    return Path(os.environ.get("ERP_WEB_PIDFILE", Path(__file__).parent / "data" / "gunicorn.pid"))
+
+
+def settings(**overrides) -> dict:
+    """Gunicorn settings from the environment; keyword arguments win when not None."""
+    max_requests = int(os.environ.get("ERP_WEB_MAX_REQUESTS", 2000))
+    cfg = {
+        'bind': f"0.0.0.0:{os.environ.get('PORT', 5000)}",
+        'workers': int(os.environ.get("ERP_WEB_WORKERS", 0)) or default_workers(),
+        'threads': int(os.environ.get("ERP_WEB_THREADS", 4)),
+        'worker_class': 'gthread',
+        'preload_app': True,
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests // 10,
+        'timeout': int(os.environ.get("ERP_WEB_TIMEOUT", 60)),
+        'graceful_timeout': 30,
+        'keepalive': 5,
+        'pidfile': str(pidfile()),
+        'accesslog': os.environ.get("ERP_WEB_ACCESSLOG"),
+    }
+    cfg.update({k: v for k, v in overrides.items() if v is not None})
+    return cfg
+
+
+def max_streams(threads: int) -> int:
+    """/api/events streams a worker accepts: each holds one of its `threads` for as long as it is open."""
+    return int(os.environ.get("ERP_EVENTS_MAX_STREAMS", 0)) or max(1, threads // 4)
+
+
+def _post_fork(server, worker):
+    # the pool is fork-aware already; this just makes the hand-over explicit
+    db.close_pool()
+    events.MAX_STREAMS = max_streams(server.cfg.threads)
+    if server.cfg.workers > 1:
+        # each worker's event hub only sees its own writes otherwise
+        events.share(f"{db.get_db_path()}-events")
+
+
+def serve(**overrides):
+    """Run gunicorn in the foreground until it is stopped."""
+    from gunicorn.app.base import BaseApplication
+
+    class ERPApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                if key in self.cfg.settings and value is not None:
+                    self.cfg.set(key, value)
+            self.cfg.set('post_fork', _post_fork)
+
+        def load(self):
+            # runs once in the master because preload_app is set
+            from app import app
+            db.init_db()
+            db.close_pool()
+            return app
+
+    pidfile().parent.mkdir(parents=True, exist_ok=True)
+    ERPApplication(settings(**overrides)).run()
+
+
+def reload() -> int:
+    """Send SIGHUP to the running master for a graceful worker restart. Returns its pid."""
+    try:
+        pid = int(pidfile().read_text().strip())
+    except (OSError, ValueError):
+        raise RuntimeError(f"no running server (pid file {pidfile()} missing)")
+    os.kill(pid, signal.SIGHUP)
+    return pid